@@ -35,6 +35,7 @@ except ImportError:
 # project
 from checks.check_status import CollectorStatus
 from checks.collector import Collector
+from checks.scheduler import next_deadline
 from config import (
     get_config,
     get_jmx_pipe_path,
@@ -54,7 +55,7 @@ from jmxfetch import get_jmx_checks, JMXFetch
 from utils.cloud_metadata import EC2
 from utils.configcheck import configcheck, sd_configcheck
 from utils.flare import Flare
-from utils.hostname import get_hostname
+from utils.hostname import get_hostname, invalidate_hostname_cache
 from utils.jmx import jmx_command
 from utils.pidfile import PidFile
 from utils.platform import Platform
@@ -129,6 +130,7 @@ class Agent(Daemon):
         """Reload the agent configuration and checksd configurations.
            Can also reload only an explicit set of checks."""
         log.info("Attempting a configuration reload...")
+        invalidate_hostname_cache()
         hostname = get_hostname(self._agentConfig)
         jmx_sd_configs = None
 
@@ -308,6 +310,8 @@ class Agent(Daemon):
         # Configure the watchdog.
         self.check_frequency = int(self._agentConfig['check_freq'])
         watchdog = self._get_watchdog(self.check_frequency)
+        # Check instances only run between collections when opted in
+        self.short_check_intervals = _is_affirmative(self._agentConfig.get('short_check_intervals', False))
 
         # Initialize the auto-restarter
         self.restart_interval = int(self._agentConfig.get('restart_interval', RESTART_INTERVAL))
@@ -317,6 +321,7 @@ class Agent(Daemon):
 
         profiled = False
         collector_profiled_runs = 0
+        next_collection = time.time()
 
         # Run the main loop.
         while self.run_forever:
@@ -391,8 +396,10 @@ class Agent(Daemon):
                     watchdog.reset()
                 if profiled:
                     collector_profiled_runs += 1
-                log.debug("Sleeping for {0} seconds".format(self.check_frequency))
-                time.sleep(self.check_frequency)
+                # Collections happen on a fixed grid, a slow run doesn't delay the next ones
+                next_collection = next_deadline(next_collection, self.check_frequency, time.time())
+                log.debug("Sleeping for {0:.2f} seconds".format(next_collection - time.time()))
+                self._wait_for_collection(next_collection)
 
         # Now clean-up.
         try:
@@ -484,6 +491,24 @@ class Agent(Daemon):
         else:
             log.info("JMX SD Configs submitted via named pipe successfully: %s", names)
 
+    def _wait_for_collection(self, deadline):
+        """
+        Sleep until the next collection, running in the meantime the check
+        instances that are scheduled more often than `check_freq` when
+        `short_check_intervals` is on. Otherwise due instances wait for the
+        next collection.
+        """
+        while self.run_forever:
+            now = time.time()
+            if now >= deadline:
+                return
+            next_check_run = self.collector.next_check_run() if self.short_check_intervals else None
+            if next_check_run is None or next_check_run >= deadline:
+                time.sleep(deadline - now)
+            else:
+                time.sleep(max(0, next_check_run - now))
+                self.collector.run_scheduled_checks()
+
     def _should_restart(self):
         if time.time() - self.agent_start > self.restart_interval:
             return True
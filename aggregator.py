@@ -8,6 +8,7 @@ from time import time
 
 # project
 from checks.metric_types import MetricTypes
+from utils.strings import string_validator
 
 log = logging.getLogger(__name__)
 
@@ -420,6 +421,8 @@ class Aggregator(object):
         recent_point_threshold = recent_point_threshold or RECENT_POINT_THRESHOLD_DEFAULT
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
+        # Samples submitted to the aggregator since it was created
+        self.sample_count = 0
 
         # Additional config passed when instantiating metric configs
         self.metric_config = {
@@ -434,6 +437,15 @@ class Aggregator(object):
     def deduplicate_tags(self, tags):
         return sorted(set(tags))
 
+    def create_metric(self, metric_class, name, tags, hostname, device_name):
+        """
+        Create the metric of a new context. Its strings are validated there, once per
+        context, so that flushed payloads can be serialized in a single pass.
+        """
+        validate = string_validator.validate
+        return metric_class(self.formatter, validate(name), string_validator.validate_tags(tags),
+            validate(hostname), validate(device_name), self.metric_config.get(metric_class))
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -795,9 +807,8 @@ class MetricsBucketAggregator(Aggregator):
                 self.current_mbc = metric_by_context
 
             if context not in metric_by_context:
-                metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                    hostname, device_name, self.metric_config.get(metric_class))
+                metric_by_context[context] = self.create_metric(self.metric_type_to_class[mtype], name, tags,
+                    hostname, device_name)
 
             metric_by_context[context].sample(value, sample_rate, timestamp)
 
@@ -811,7 +822,7 @@ class MetricsBucketAggregator(Aggregator):
             else:
                 # The expiration currently only applies to Counters
                 # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
+                metric = self.create_metric(Counter, context[0], context[1], context[2], context[3])
                 metrics += metric.flush(flush_timestamp, self.interval)
 
     def flush(self):
@@ -910,15 +921,52 @@ class MetricsAggregator(Aggregator):
             tags = tuple(self.deduplicate_tags(tags))
             context = (name, tags, hostname, device_name)
         if context not in self.metrics:
-            metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
-                hostname, device_name, self.metric_config.get(metric_class))
+            self.metrics[context] = self.create_metric(self.metric_type_to_class[mtype], name, tags,
+                hostname, device_name)
         cur_time = time()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
             log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
             self.metrics[context].sample(value, sample_rate, timestamp)
+            self.sample_count += 1
+
+    def submit_metrics(self, mtype, samples, tags=None, hostname=None,
+                       device_name=None, timestamp=None):
+        """
+        Submit a batch of samples of the same type. `samples` yields (name, value) or
+        (name, value, tags) tuples, the tags of a sample are added to the shared `tags`.
+        Tags are canonicalized once per distinct set and the time read once per batch.
+        """
+        hostname = hostname if hostname is not None else self.hostname
+        if timestamp is not None and time() - int(timestamp) > self.recent_point_threshold:
+            discarded = sum(1 for _ in samples)
+            log.debug("Discarding %s samples - ts = %s" % (discarded, timestamp))
+            self.num_discarded_old_points += discarded
+            return
+
+        shared_tags = None if tags is None else tuple(self.deduplicate_tags(tags))
+        metrics = self.metrics
+        metric_class = self.metric_type_to_class[mtype]
+        merged_tags = {}
+        count = 0
+        for count, sample in enumerate(samples, 1):
+            name, value = sample[0], sample[1]
+            if len(sample) > 2 and sample[2]:
+                key = tuple(sample[2])
+                sample_tags = merged_tags.get(key)
+                if sample_tags is None:
+                    sample_tags = merged_tags[key] = tuple(self.deduplicate_tags((shared_tags or ()) + key))
+            else:
+                sample_tags = shared_tags
+
+            context = (name, sample_tags or (), hostname, device_name)
+            metric = metrics.get(context)
+            if metric is None:
+                metric = metrics[context] = self.create_metric(metric_class, name, sample_tags,
+                    hostname, device_name)
+            metric.sample(value, 1, timestamp)
+        self.sample_count += count
 
     def gauge(self, name, value, tags=None, hostname=None, device_name=None, timestamp=None):
         self.submit_metric(name, value, 'g', tags, hostname, device_name, timestamp)
@@ -15,7 +15,6 @@ import numbers
 import os
 import re
 import time
-import timeit
 import traceback
 from types import ListType, TupleType
 import unicodedata
@@ -33,8 +32,9 @@ from config import AGENT_VERSION, _is_affirmative
 from util import get_next_id
 from utils.hostname import get_hostname
 from utils.proxy import get_proxy
-from utils.profile import pretty_statistics
+from utils.profile import InstanceProfile, SAMPLING_INTERVAL, pretty_hotspots, pretty_statistics
 from utils.proxy import get_no_proxy_from_env, config_proxy_skip
+from utils.strings import string_validator
 from utils.ddyaml import yLoader
 
 
@@ -45,6 +45,9 @@ DEFAULT_PSUTIL_METHODS = ['memory_info', 'io_counters']
 
 AGENT_METRICS_CHECK_NAME = 'agent_metrics'
 
+# Number of normalized names remembered by a check, it starts over once full
+NORMALIZE_CACHE_SIZE = 10000
+
 
 # Konstants
 class CheckException(Exception):
@@ -81,6 +84,14 @@ class Check(object):
     * only log error messages once (instead of each time they occur)
 
     """
+    # Metric name normalization
+    METRIC_CHARS_RE = re.compile(r"[,\@\+\*\-/()\[\]{}\s]")
+    MULTIPLE_UNDERSCORES_RE = re.compile(r"__+")
+    LEADING_UNDERSCORE_RE = re.compile(r"^_")
+    TRAILING_UNDERSCORE_RE = re.compile(r"_$")
+    DOT_UNDERSCORE_RE = re.compile(r"\._")
+    UNDERSCORE_DOT_RE = re.compile(r"_\.")
+
     def __init__(self, logger):
         # where to store samples, indexed by metric_name
         # metric_name: {("sorted", "tags"): [(ts, value), (ts, value)],
@@ -95,21 +106,23 @@ class Check(object):
         """Turn a metric into a well-formed metric name
         prefix.b.c
         """
-        name = re.sub(r"[,\@\+\*\-/()\[\]{}\s]", "_", metric)
-        # Eliminate multiple _
-        name = re.sub(r"__+", "_", name)
-        # Don't start/end with _
-        name = re.sub(r"^_", "", name)
-        name = re.sub(r"_$", "", name)
-        # Drop ._ and _.
-        name = re.sub(r"\._", ".", name)
-        name = re.sub(r"_\.", ".", name)
+        name = self._clean_metric_name(self.METRIC_CHARS_RE.sub("_", metric))
 
         if prefix is not None:
             return prefix + "." + name
         else:
             return name
 
+    def _clean_metric_name(self, name):
+        # Eliminate multiple _
+        name = self.MULTIPLE_UNDERSCORES_RE.sub("_", name)
+        # Don't start/end with _
+        name = self.LEADING_UNDERSCORE_RE.sub("", name)
+        name = self.TRAILING_UNDERSCORE_RE.sub("", name)
+        # Drop ._ and _.
+        name = self.DOT_UNDERSCORE_RE.sub(".", name)
+        return self.UNDERSCORE_DOT_RE.sub(".", name)
+
     def normalize_device_name(self, device_name):
         return device_name.strip().lower().replace(' ', '_')
 
@@ -302,6 +315,12 @@ class AgentCheck(object):
 
     DEFAULT_MIN_COLLECTION_INTERVAL = 0
 
+    # Instances are passed to `check` as they are, and compared with a copy made on
+    # their first run afterwards. A check found modifying them gets a deep copy of
+    # its instances from then on. Checks that modify them on purpose can skip the
+    # comparison by setting this, or `deepcopy_instances: true` in their `init_config`.
+    DEEPCOPY_INSTANCES = False
+
     _enabled_checks = []
 
     @classmethod
@@ -360,6 +379,24 @@ class AgentCheck(object):
         self.historate_dict = {}
         self.manifest_path = None
 
+        self.deepcopy_instances = self.DEEPCOPY_INSTANCES or \
+            _is_affirmative(self.init_config.get('deepcopy_instances', False))
+        self._normalize_cache = {}
+        self._normalize_cache_hits = 0
+        self._normalize_cache_misses = 0
+
+        # Instance id -> cost of its last runs
+        self._instance_profiles = defaultdict(InstanceProfile)
+        # Seconds between two samples of the stack of the check, when it's profiled
+        self.sampling_interval = None
+        if _is_affirmative(self.init_config.get('sampling_profiler', False)):
+            self.sampling_interval = float(self.init_config.get('sampling_interval', SAMPLING_INTERVAL))
+
+        # Instance id -> (instance, pristine copy of it, time the copy took)
+        self._pristine_instances = {}
+        # Estimated time saved by not copying instances during the last run
+        self.instance_copy_saved = 0.0
+
         # Set proxy settings
         self.proxy_settings = get_proxy(self.agentConfig)
         self._use_proxy = False if init_config is None else init_config.get("use_agent_proxy", True)
@@ -427,6 +464,20 @@ class AgentCheck(object):
         """
         self.aggregator.gauge(metric, value, tags, hostname, device_name, timestamp)
 
+    def gauges(self, metrics, tags=None, hostname=None, device_name=None, timestamp=None):
+        """
+        Record the values of several gauges at once, sharing tags, hostname and
+        device name. Much cheaper than calling `gauge` for each of them when a
+        check submits thousands of metrics.
+
+        :param metrics: An iterable of (name, value) or (name, value, tags) tuples
+        :param tags: (optional) A list of tags for all the metrics, added to their own
+        :param hostname: (optional) A hostname for the metrics. Defaults to the current hostname.
+        :param device_name: (optional) The device name for the metrics
+        :param timestamp: (optional) The timestamp for the metric values
+        """
+        self.aggregator.submit_metrics('g', metrics, tags, hostname, device_name, timestamp)
+
     def increment(self, metric, value=1, tags=None, hostname=None, device_name=None):
         """
         Increment a counter with optional tags, hostname and device name.
@@ -463,6 +514,17 @@ class AgentCheck(object):
         """
         self.aggregator.submit_count(metric, value, tags, hostname, device_name)
 
+    def counts(self, metrics, tags=None, hostname=None, device_name=None):
+        """
+        Submit several raw counts at once, see `gauges`.
+
+        :param metrics: An iterable of (name, value) or (name, value, tags) tuples
+        :param tags: (optional) A list of tags for all the metrics, added to their own
+        :param hostname: (optional) A hostname for the metrics. Defaults to the current hostname.
+        :param device_name: (optional) The device name for the metrics
+        """
+        self.aggregator.submit_metrics('ct', metrics, tags, hostname, device_name)
+
     def monotonic_count(self, metric, value=0, tags=None,
                         hostname=None, device_name=None):
         """
@@ -479,6 +541,17 @@ class AgentCheck(object):
         self.aggregator.count_from_counter(metric, value, tags,
                                            hostname, device_name)
 
+    def monotonic_counts(self, metrics, tags=None, hostname=None, device_name=None):
+        """
+        Submit several monotonic counts at once, see `gauges`.
+
+        :param metrics: An iterable of (name, value) or (name, value, tags) tuples
+        :param tags: (optional) A list of tags for all the metrics, added to their own
+        :param hostname: (optional) A hostname for the metrics. Defaults to the current hostname.
+        :param device_name: (optional) The device name for the metrics
+        """
+        self.aggregator.submit_metrics('ct-c', metrics, tags, hostname, device_name)
+
     def rate(self, metric, value, tags=None, hostname=None, device_name=None):
         """
         Submit a point for a metric that will be calculated as a rate on flush.
@@ -493,6 +566,17 @@ class AgentCheck(object):
         """
         self.aggregator.rate(metric, value, tags, hostname, device_name)
 
+    def rates(self, metrics, tags=None, hostname=None, device_name=None):
+        """
+        Submit points for several rates at once, see `gauges`.
+
+        :param metrics: An iterable of (name, value) or (name, value, tags) tuples
+        :param tags: (optional) A list of tags for all the metrics, added to their own
+        :param hostname: (optional) A hostname for the metrics. Defaults to the current hostname.
+        :param device_name: (optional) The device name for the metrics
+        """
+        self.aggregator.submit_metrics('_dd-r', metrics, tags, hostname, device_name)
+
     def histogram(self, metric, value, tags=None, hostname=None, device_name=None):
         """
         Sample a histogram value, with optional tags, hostname and device name.
@@ -624,9 +708,9 @@ class AgentCheck(object):
         if message is not None:
             message = unicode(message) # ascii converts to unicode but not viceversa
         if tags:
-            tags = sorted(set(tags))
+            tags = string_validator.validate_tags(sorted(set(tags)))
         self.service_checks.append(
-            create_service_check(check_name, status, tags, timestamp,
+            create_service_check(string_validator.validate(check_name), status, tags, timestamp,
                                  hostname, check_run_id, message)
         )
 
@@ -783,7 +867,15 @@ class AgentCheck(object):
 
     def _set_internal_profiling_stats(self, before, after):
         if self.allow_profiling:
-            self._internal_profiling_stats = {'before': before, 'after': after}
+            self._internal_profiling_stats = {
+                'before': before,
+                'after': after,
+                'normalize_cache': {
+                    'hits': self._normalize_cache_hits,
+                    'misses': self._normalize_cache_misses,
+                    'size': len(self._normalize_cache),
+                },
+            }
 
     def _get_internal_profiling_stats(self):
         """
@@ -795,8 +887,15 @@ class AgentCheck(object):
         self._internal_profiling_stats = None
         return stats
 
-    def run(self):
-        """ Run all instances. """
+    def run(self, instance_ids=None, progress=None):
+        """
+        Run all instances, or only the ones in `instance_ids` when the
+        collector's scheduler already decided that they are due.
+
+        `progress`, if given, is told of each instance as it starts and
+        completes with its `start_instance(instance_id)` and
+        `complete_instance(instance_status)` methods.
+        """
 
         # Store run statistics if needed
         before, after = None, None
@@ -807,41 +906,59 @@ class AgentCheck(object):
                 self.log.debug("Failed to collect Agent Stats before check {0}".format(self.name))
 
         instance_statuses = []
-        for i, instance in enumerate(self.instances):
+        self.instance_copy_saved = 0.0
+        if instance_ids is None:
+            instance_ids = xrange(len(self.instances))
+            scheduled = False
+        else:
+            scheduled = True
+        for i in instance_ids:
+            instance = self.instances[i]
+            profile = None
             try:
                 min_collection_interval = instance.get('min_collection_interval', self.min_collection_interval)
 
                 now = time.time()
-                if now - self.last_collection_time[i] < min_collection_interval:
+                if not scheduled and now - self.last_collection_time[i] < min_collection_interval:
                     self.log.debug("Not running instance #{0} of check {1} as it ran less than {2}s ago".format(i, self.name, min_collection_interval))
                     continue
 
                 self.last_collection_time[i] = now
+                if progress is not None:
+                    progress.start_instance(i)
 
-                check_start_time = None
-                if self.in_developer_mode:
-                    check_start_time = timeit.default_timer()
-                self.check(copy.deepcopy(instance))
+                profile = self._instance_profiles[i]
+                sample_count = self.aggregator.sample_count
+                profile.start(self.sampling_interval)
+                try:
+                    self._check_instance(i, instance)
+                finally:
+                    run_stats = profile.stop(self.aggregator.sample_count - sample_count)
+                    if profile.hotspots:
+                        self.log.info("Check %s instance #%s hotspots:\n%s", self.name, i,
+                                      "\n".join(pretty_hotspots(profile.hotspots)))
 
                 instance_check_stats = None
-                if check_start_time is not None:
-                    instance_check_stats = {'run_time': timeit.default_timer() - check_start_time}
+                if self.in_developer_mode:
+                    instance_check_stats = {'run_time': run_stats['wall_time']}
 
                 if self.has_warnings():
                     instance_status = check_status.InstanceStatus(
                         i, check_status.STATUS_WARNING,
-                        warnings=self.get_warnings(), instance_check_stats=instance_check_stats
+                        warnings=self.get_warnings(), instance_check_stats=instance_check_stats,
+                        profile=profile.summary()
                     )
                 else:
                     instance_status = check_status.InstanceStatus(
                         i, check_status.STATUS_OK,
-                        instance_check_stats=instance_check_stats
+                        instance_check_stats=instance_check_stats, profile=profile.summary()
                     )
             except Exception as e:
                 self.log.exception("Check '%s' instance #%s failed" % (self.name, i))
                 instance_status = check_status.InstanceStatus(
                     i, check_status.STATUS_ERROR,
-                    error=str(e), tb=traceback.format_exc()
+                    error=str(e), tb=traceback.format_exc(),
+                    profile=profile.summary() if profile is not None else None
                 )
             finally:
                 self._roll_up_instance_metadata()
@@ -849,6 +966,8 @@ class AgentCheck(object):
                 self.get_warnings()
 
             instance_statuses.append(instance_status)
+            if progress is not None:
+                progress.complete_instance(instance_status)
 
         if self.in_developer_mode and self.name != AGENT_METRICS_CHECK_NAME:
             try:
@@ -861,6 +980,38 @@ class AgentCheck(object):
 
         return instance_statuses
 
+    def _check_instance(self, instance_id, instance):
+        """
+        Run `check` on an instance without copying it, see `DEEPCOPY_INSTANCES`.
+        """
+        if self.deepcopy_instances:
+            return self.check(copy.deepcopy(instance))
+
+        pristine = self._pristine_instances.get(instance_id)
+        copied = pristine is None or pristine[0] is not instance
+        if copied:
+            start = time.time()
+            pristine = self._pristine_instances[instance_id] = (instance, copy.deepcopy(instance), time.time() - start)
+        _, pristine_copy, copy_time = pristine
+
+        try:
+            self.check(instance)
+        finally:
+            start = time.time()
+            try:
+                modified = instance != pristine_copy
+            except Exception:
+                modified = True
+
+            if modified:
+                self.log.warning("Check %s modified instance #%s, its instances are copied for every run "
+                                 "from now on", self.name, instance_id)
+                self.instances[instance_id] = pristine_copy
+                self.deepcopy_instances = True
+                self._pristine_instances = {}
+            elif not copied:
+                self.instance_copy_saved += copy_time - (time.time() - start)
+
     def check(self, instance):
         """
         Overriden by the check class. This will be called to run the check.
@@ -899,19 +1050,49 @@ class AgentCheck(object):
             check = cls(check_name, config.get('init_config') or {}, agentConfig or {})
         return check, config.get('instances', [])
 
+    # Metric name normalization, same patterns as `Check`
+    METRIC_CHARS_RE = Check.METRIC_CHARS_RE
+    DEVICE_CHARS_RE = re.compile(r"[,\@\+\*\-\()\[\]{}\s]")
+    MULTIPLE_UNDERSCORES_RE = Check.MULTIPLE_UNDERSCORES_RE
+    LEADING_UNDERSCORE_RE = Check.LEADING_UNDERSCORE_RE
+    TRAILING_UNDERSCORE_RE = Check.TRAILING_UNDERSCORE_RE
+    DOT_UNDERSCORE_RE = Check.DOT_UNDERSCORE_RE
+    UNDERSCORE_DOT_RE = Check.UNDERSCORE_DOT_RE
+    _clean_metric_name = Check._clean_metric_name.im_func
+
     def normalize_device_name(self, device_name):
-        return re.sub(r"[,\@\+\*\-\()\[\]{}\s]", "_", device_name)
+        return self.DEVICE_CHARS_RE.sub("_", device_name)
 
     def normalize(self, metric, prefix=None, fix_case=False):
         """
         Turn a metric into a well-formed metric name
         prefix.b.c
 
+        Checks normalize the same names at every run, so the results are cached.
+
         :param metric The metric name to normalize
         :param prefix A prefix to to add to the normalized name, default None
         :param fix_case A boolean, indicating whether to make sure that
                         the metric name returned is in underscore_case
         """
+        key = (metric, prefix, fix_case)
+        try:
+            name = self._normalize_cache[key]
+            self._normalize_cache_hits += 1
+            return name
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable name, e.g. a list
+            return self._normalize(metric, prefix, fix_case)
+
+        self._normalize_cache_misses += 1
+        if len(self._normalize_cache) >= NORMALIZE_CACHE_SIZE:
+            self._normalize_cache = {}
+        name = self._normalize_cache[key] = self._normalize(metric, prefix, fix_case)
+        return name
+
+    def _normalize(self, metric, prefix, fix_case):
         if isinstance(metric, unicode):
             metric_name = unicodedata.normalize('NFKD', metric).encode('ascii','ignore')
         else:
@@ -922,15 +1103,8 @@ class AgentCheck(object):
             if prefix is not None:
                 prefix = self.convert_to_underscore_separated(prefix)
         else:
-            name = re.sub(r"[,\@\+\*\-/()\[\]{}\s]", "_", metric_name)
-        # Eliminate multiple _
-        name = re.sub(r"__+", "_", name)
-        # Don't start/end with _
-        name = re.sub(r"^_", "", name)
-        name = re.sub(r"_$", "", name)
-        # Drop ._ and _.
-        name = re.sub(r"\._", ".", name)
-        name = re.sub(r"_\.", ".", name)
+            name = self.METRIC_CHARS_RE.sub("_", metric_name)
+        name = self._clean_metric_name(name)
 
         if prefix is not None:
             return prefix + "." + name
@@ -33,7 +33,7 @@ from utils.jmx import JMXFiles
 from utils.ntp import NTPUtil
 from utils.pidfile import PidFile
 from utils.platform import Platform
-from utils.profile import pretty_statistics
+from utils.profile import pretty_instance_profile, pretty_statistics
 from utils.proxy import get_proxy
 
 
@@ -317,7 +317,7 @@ class AgentStatus(object):
 class InstanceStatus(object):
 
     def __init__(self, instance_id, status, error=None, tb=None, warnings=None, metric_count=None,
-                 instance_check_stats=None):
+                 instance_check_stats=None, profile=None):
         self.instance_id = instance_id
         self.status = status
         if error is not None:
@@ -328,6 +328,8 @@ class InstanceStatus(object):
         self.warnings = warnings
         self.metric_count = metric_count
         self.instance_check_stats = instance_check_stats
+        # Summary of the cost of the last runs of the instance, see `InstanceProfile`
+        self.profile = profile
 
     def has_error(self):
         return self.status == STATUS_ERROR
@@ -371,11 +373,13 @@ class CheckStatus(object):
 
 class EmitterStatus(object):
 
-    def __init__(self, name, error=None):
+    def __init__(self, name, error=None, timings=None):
         self.name = name
         self.error = None
         if error:
             self.error = repr(error)
+        # Time spent posting to each endpoint, for emitters that report it
+        self.timings = timings if isinstance(timings, dict) else {}
 
     @property
     def status(self):
@@ -438,6 +442,7 @@ class CollectorStatus(AgentStatus):
                     line += " Last run duration: %s" % s.instance_check_stats.get('run_time')
 
                 check_lines.append(line)
+                check_lines.extend("        %s" % l for l in pretty_instance_profile(s.profile))
 
                 if s.has_warnings():
                     for warning in s.warnings:
@@ -583,6 +588,7 @@ class CollectorStatus(AgentStatus):
                             line += " Last run duration: %s" % s.instance_check_stats.get('run_time')
 
                         check_lines.append(line)
+                        check_lines.extend("        %s" % l for l in pretty_instance_profile(s.profile))
 
                         if s.has_warnings():
                             for warning in s.warnings:
@@ -673,6 +679,8 @@ class CollectorStatus(AgentStatus):
                 if es.status != STATUS_OK:
                     line += ": %s" % es.error
                 lines.append(line)
+                for endpoint, duration in sorted(es.timings.iteritems()):
+                    lines.append("      %s: %.3fs" % (endpoint, duration))
 
         return lines
 
@@ -716,6 +724,8 @@ class CollectorStatus(AgentStatus):
                         status_info['checks'][cs.name]['instances'][s.instance_id]['error'] = s.error
                     if s.has_warnings():
                         status_info['checks'][cs.name]['instances'][s.instance_id]['warnings'] = s.warnings
+                    if s.profile:
+                        status_info['checks'][cs.name]['instances'][s.instance_id]['profile'] = s.profile
                 status_info['checks'][cs.name]['metric_count'] = cs.metric_count
                 status_info['checks'][cs.name]['event_count'] = cs.event_count
                 status_info['checks'][cs.name]['service_check_count'] = cs.service_check_count
@@ -730,6 +740,8 @@ class CollectorStatus(AgentStatus):
             }
             if es.has_error():
                 check_status['error'] = es.error
+            if es.timings:
+                check_status['timings'] = es.timings
             status_info['emitter'].append(check_status)
 
         osname = config.get_os()
@@ -816,7 +828,8 @@ class ForwarderStatus(AgentStatus):
     NAME = 'Forwarder'
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
-                 transactions_flushed=0, transactions_rejected=0):
+                 transactions_flushed=0, transactions_rejected=0, flush_rate=None,
+                 max_parallelism=None, transactions_coalesced=0, priority_stats=None):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
@@ -826,6 +839,10 @@ class ForwarderStatus(AgentStatus):
         self.hidden_username = None
         self.hidden_password = None
         self.transactions_rejected = transactions_rejected
+        self.flush_rate = flush_rate
+        self.max_parallelism = max_parallelism
+        self.transactions_coalesced = transactions_coalesced
+        self.priority_stats = priority_stats or {}
 
     def body_lines(self):
         lines = [
@@ -835,6 +852,17 @@ class ForwarderStatus(AgentStatus):
             "Transactions received: %s" % self.transactions_received,
             "Transactions flushed: %s" % self.transactions_flushed,
             "Transactions rejected: %s" % self.transactions_rejected,
+            "Transactions coalesced: %s" % self.transactions_coalesced,
+        ]
+        if self.flush_rate is not None:
+            lines.append("Flush rate: %s transactions/s" % self.flush_rate)
+        if self.max_parallelism is not None:
+            lines.append("Parallel flushes: %s" % self.max_parallelism)
+        for priority, stats in sorted(self.priority_stats.iteritems()):
+            lines.append("Queue [%s]: %s transaction%s, %s bytes, %s flushed, %s evicted" % (
+                priority, stats['count'], plural(stats['count']), stats['size'],
+                stats['flushed'], stats['evicted']))
+        lines += [
             "API Key Status: %s" % validate_api_key(config=get_config()),
             "",
         ]
@@ -852,7 +880,11 @@ class ForwarderStatus(AgentStatus):
             'queue_size': self.queue_size,
             'transactions_rejected': self.transactions_rejected,
             'transactions_received': self.transactions_received,
-            'transactions_flushed': self.transactions_flushed
+            'transactions_flushed': self.transactions_flushed,
+            'transactions_coalesced': self.transactions_coalesced,
+            'priority_stats': self.priority_stats,
+            'flush_rate': self.flush_rate,
+            'max_parallelism': self.max_parallelism,
         })
         return status_info
 
@@ -4,11 +4,13 @@
 
 # stdlib
 import collections
+import inspect
 import locale
 import logging
 import pprint
 import socket
 import sys
+import threading
 import time
 
 # 3p
@@ -25,27 +27,34 @@ from checks.check_status import (
     CheckStatus,
     CollectorStatus,
     EmitterStatus,
+    InstanceStatus,
     STATUS_ERROR,
     STATUS_OK,
 )
 from checks.datadog import Dogstreams
 from checks.ganglia import Ganglia
+from checks.libs.thread_pool import Pool
+from checks.scheduler import CheckScheduler
 from config import (
     A7_COMPATIBILITY_ATTR,
     A7_COMPATIBILITY_READY,
     AGENT_VERSION,
+    DEFAULT_CHECK_FREQUENCY,
+    _is_affirmative,
     get_system_stats,
     get_version,
 )
 import checks.system.unix as u
 import checks.system.win32 as w32
+from emitter import SERIES_ENDPOINT
 import modules
 from util import get_uuid
 from utils.cloud_metadata import GCE, EC2, CloudFoundry, Azure
+from utils.compression import get_compressor
 from utils.logger import log_exceptions, RedactedLogRecord
 from utils.jmx import JMXFiles
 from utils.platform import Platform, get_os
-from utils.subprocess_output import get_subprocess_output
+from utils.subprocess_output import get_subprocess_output, subprocess_stats
 from utils.timer import Timer
 from utils.orchestrator import MetadataCollector
 
@@ -57,6 +66,14 @@ FLUSH_LOGGING_PERIOD = 10
 FLUSH_LOGGING_INITIAL = 5
 DD_CHECK_TAG = 'dd_check:{0}'
 
+# Number of threads running the checks.d checks (1 runs them serially in the main thread)
+DEFAULT_CHECK_WORKERS = 1
+# How often the main thread wakes up to enforce `check_timeout` while waiting on a check
+CHECK_WAIT_INTERVAL = 0.1
+# Number of check metrics buffered before they're sent, when `stream_check_metrics` is enabled.
+# It counts metrics rather than bytes, post_payload splits the batches by compressed size
+DEFAULT_STREAM_BATCH_SIZE = 10000
+
 def a7_compatible_to_int(status):
     if status == A7_COMPATIBILITY_READY:
         return 1
@@ -146,9 +163,8 @@ class AgentPayload(collections.MutableMapping):
                 if not continue_running:
                     return statuses
                 name = emitter.__name__
-                emitter_status = EmitterStatus(name)
                 try:
-                    emitter(payload, log, config, endpoint)
+                    emitter_status = EmitterStatus(name, timings=emitter(payload, log, config, endpoint))
                 except Exception as e:
                     log.exception("Error running emitter: %s"
                                   % emitter.__name__)
@@ -165,6 +181,227 @@ class AgentPayload(collections.MutableMapping):
         return statuses
 
 
+def runs_scheduled_instances(check):
+    """
+    Whether the `run` of a check takes the instances picked by the scheduler.
+    Checks overriding it without these arguments run all their instances.
+    """
+    try:
+        args = inspect.getargspec(check.run).args
+    except TypeError:
+        return False
+    return 'instance_ids' in args and 'progress' in args
+
+
+class CheckRun(object):
+    """
+    The outcome of a single run of a checks.d check. It is filled in by the
+    thread running the check and merged into the payload by the main thread.
+
+    The check reports each instance as it starts and completes, so that the
+    collector can tell which one overran its deadline, see `deadline`.
+    """
+    def __init__(self, check, instance_ids=None, default_timeout=0):
+        self.check = check
+        self.instance_ids = instance_ids
+        self.default_timeout = default_timeout
+        self.instance_statuses = []
+        self.metrics = []
+        self.events = []
+        self.service_metadata = []
+        self.check_stats = None
+        self.start_time = None
+        self.run_time = None
+        self.instance_copy_saved = 0.0
+        # Metrics already sent by the collector, when it streams them
+        self.streamed_metric_count = 0
+        # (instance_id, start time) of the instance being run
+        self.current_instance = None
+        # Statuses of the instances done so far, readable while the check runs
+        self.completed_statuses = []
+        self.timed_out = False
+        self.abandoned = False
+        # Stand-in for a check that had nothing due since the last collection
+        self.skipped = False
+
+    def execute(self):
+        self.start_time = time.time()
+        check = self.check
+        try:
+            # Run the check.
+            if self.instance_ids is None or not runs_scheduled_instances(check):
+                instance_statuses = check.run()
+            else:
+                instance_statuses = check.run(instance_ids=self.instance_ids, progress=self)
+                self.current_instance = None
+            self.instance_copy_saved = getattr(check, 'instance_copy_saved', 0.0)
+
+            # Collect the metrics, events and metadata.
+            metrics = check.get_metrics()
+            events = check.get_events()
+            check_stats = check._get_internal_profiling_stats()
+            service_metadata = check.get_service_metadata()
+        except Exception:
+            log.exception("Error running check %s" % check.name)
+        else:
+            self.instance_statuses = instance_statuses
+            self.metrics = metrics
+            self.events = events
+            self.check_stats = check_stats
+            # One metadata dict per instance status, even if the check saved fewer
+            self.service_metadata = (service_metadata + [{}] * len(instance_statuses))[:len(instance_statuses)]
+
+        self.run_time = time.time() - self.start_time
+        return self
+
+    def start_instance(self, instance_id):
+        self.current_instance = (instance_id, time.time())
+
+    def complete_instance(self, instance_status):
+        self.completed_statuses.append(instance_status)
+
+    def instance_timeout(self, instance_id):
+        """
+        `check_timeout` of an instance, from the instance itself, the check's
+        `init_config` or the agent configuration. 0 means no timeout.
+        """
+        init_config = getattr(self.check, 'init_config', None) or {}
+        instance = self.check.instances[instance_id]
+        timeout = instance.get('check_timeout', init_config.get('check_timeout', self.default_timeout))
+        try:
+            return float(timeout or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def deadline(self):
+        """
+        Time by which the instance being run should be done, None if there's none.
+        """
+        current_instance = self.current_instance
+        if current_instance is None:
+            return None
+        instance_id, start_time = current_instance
+        timeout = self.instance_timeout(instance_id)
+        return start_time + timeout if timeout else None
+
+    def has_timeout(self):
+        return any(self.instance_timeout(i) for i in xrange(len(self.check.instances or [])))
+
+    def absorb(self, other):
+        """
+        Fold in the results of a later run of the same check, when the check
+        ran more than once since the last collection.
+        """
+        statuses = self.instance_results()
+        statuses.update(other.instance_results())
+        self.set_instance_results(statuses)
+        self.metrics = self.metrics + other.metrics
+        self.events = self.events + other.events
+        self.check_stats = other.check_stats or self.check_stats
+        self.run_time += other.run_time
+        self.instance_copy_saved += other.instance_copy_saved
+        self.streamed_metric_count += other.streamed_metric_count
+
+    def instance_results(self):
+        """
+        (status, service metadata) of every instance that ran, keyed by instance id
+        """
+        return dict((s.instance_id, (s, m)) for s, m in zip(self.instance_statuses, self.service_metadata))
+
+    def set_instance_results(self, results):
+        instance_ids = sorted(results)
+        self.instance_statuses = [results[i][0] for i in instance_ids]
+        self.service_metadata = [results[i][1] for i in instance_ids]
+
+    @property
+    def metric_count(self):
+        return len(self.metrics) + self.streamed_metric_count
+
+    def is_serial(self):
+        """
+        Checks can opt out of the worker pool with `run_serially: true` in
+        their `init_config`, e.g. when they aren't thread-safe.
+        """
+        init_config = getattr(self.check, 'init_config', None) or {}
+        return _is_affirmative(init_config.get('run_serially', False))
+
+
+class MetadataRefresher(threading.Thread):
+    """
+    Keeps the latest snapshot of slow-to-gather metadata (gohai, cloud
+    provider metadata, host tags...) refreshed in the background, so that
+    collection runs only attach it to the payload.
+
+    `sources` maps a name to a (function, push time) pair, the push time being
+    the collector's `push_times` entry of the payload the snapshot goes in.
+    Each snapshot is refreshed shortly ahead of the payload's next send.
+    """
+    # Shortest sleep between two refreshes, e.g. when a source keeps failing
+    MIN_WAIT = 1
+    # How long ahead of the send to refresh, as a share of the send interval
+    REFRESH_LEAD_RATIO = 0.1
+    # ...capped, so that long intervals don't get stale snapshots either
+    MAX_REFRESH_LEAD = 60
+
+    def __init__(self, sources):
+        threading.Thread.__init__(self, name='MetadataRefresher')
+        self.daemon = True
+        self._sources = sources
+        self._snapshots = {}
+        self._last_refresh = dict((name, 0) for name in sources)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def get(self, name):
+        """
+        Latest snapshot of `name`. The first time, before the background
+        refresh got to it, it's gathered right away.
+        """
+        with self._lock:
+            if name in self._snapshots:
+                return self._snapshots[name]
+        return self.refresh(name)
+
+    def refresh(self, name):
+        func = self._sources[name][0]
+        start = time.time()
+        try:
+            snapshot = func()
+        except Exception:
+            log.exception("Unable to refresh %s metadata", name)
+            snapshot = None
+        with self._lock:
+            self._snapshots[name] = snapshot
+            self._last_refresh[name] = start
+        log.debug("Refreshed %s metadata in %.2fs", name, time.time() - start)
+        return snapshot
+
+    def _next_refresh(self, name):
+        """
+        When to refresh `name` next: ahead of its next send, or once that send
+        happened if the snapshot for it is already there.
+        """
+        push_time = self._sources[name][1]
+        send_at = push_time['start'] + push_time['interval']
+        refresh_at = send_at - min(push_time['interval'] * self.REFRESH_LEAD_RATIO, self.MAX_REFRESH_LEAD)
+        if self._last_refresh[name] < refresh_at:
+            return refresh_at
+        return max(send_at, time.time() + self.MIN_WAIT)
+
+    def run(self):
+        while not self._stop.is_set():
+            for name in self._sources:
+                if self._stop.is_set():
+                    return
+                if time.time() >= self._next_refresh(name):
+                    self.refresh(name)
+            wait = min(self._next_refresh(name) for name in self._sources) - time.time()
+            self._stop.wait(max(wait, self.MIN_WAIT))
+
+    def stop(self):
+        self._stop.set()
+
+
 class Collector(object):
     """
     The collector is responsible for collecting data from each check and
@@ -181,6 +418,25 @@ class Collector(object):
         self.plugins = None
         self.emitters = emitters
         self.check_timings = agentConfig.get('check_timings')
+        self.check_workers = int(agentConfig.get('check_workers', DEFAULT_CHECK_WORKERS))
+        self.check_timeout = float(agentConfig.get('check_timeout', 0))
+        self._check_pool = None
+        self.scheduler = CheckScheduler(
+            int(agentConfig.get('check_freq', DEFAULT_CHECK_FREQUENCY)),
+            short_intervals=_is_affirmative(agentConfig.get('short_check_intervals', False)))
+        # Check runs submitted to the pool and not merged yet, keyed by check
+        self._running_checks = {}
+        # Results of the check runs completed since the last collection, keyed by check
+        self._check_runs = {}
+        # Last (status, service metadata) of every instance that ran, keyed by check then instance id
+        self._instance_statuses = {}
+        # Send the metrics of the checks as they complete, instead of with the payload
+        self.stream_check_metrics = _is_affirmative(agentConfig.get('stream_check_metrics', False))
+        self.stream_batch_size = int(agentConfig.get('stream_batch_size', DEFAULT_STREAM_BATCH_SIZE))
+        if self.stream_check_metrics and not self._emitters_accept_series():
+            log.warning("Not all the emitters accept partial series payloads, check metrics won't be streamed")
+        # Metrics of the completed checks, waiting for the batch to fill up
+        self._streamed_metrics = []
         self.push_times = {
             'host_metadata': {
                 'start': time.time(),
@@ -199,6 +455,13 @@ class Collector(object):
                 'interval': int(agentConfig.get('processes_interval', 60))
             }
         }
+        metadata_sources = {
+            'gohai': (self._run_gohai_metadata, self.push_times['host_metadata']),
+            'host_metadata': (self._collect_host_metadata, self.push_times['host_metadata']),
+        }
+        if not Platform.is_windows():
+            metadata_sources['gohai_processes'] = (self._run_gohai_processes, self.push_times['processes'])
+        self._metadata_refresher = MetadataRefresher(metadata_sources)
         socket.setdefaulttimeout(15)
         self.run_count = 0
         self.continue_running = True
@@ -261,8 +524,12 @@ class Collector(object):
         # in which case we'll get a misleading error in the logs.
         # Best to not even try.
         self.continue_running = False
+        self._metadata_refresher.stop()
         for check in self.initialized_checks_d:
             check.stop()
+        if self._check_pool is not None:
+            self._check_pool.terminate()
+            self._check_pool = None
 
     @staticmethod
     def _stats_for_display(raw_stats):
@@ -379,7 +646,7 @@ class Collector(object):
 
         # process collector of gohai (compliant with payload of legacy "resources checks")
         if not Platform.is_windows() and self._should_send_additional_data('processes'):
-            gohai_processes = self._run_gohai_processes()
+            gohai_processes = self._metadata_refresher.get('gohai_processes')
             if gohai_processes:
                 try:
                     gohai_processes_json = json.loads(gohai_processes)
@@ -409,50 +676,41 @@ class Collector(object):
 
         # checks.d checks
         check_statuses = []
-        for check in self.initialized_checks_d:
-            if not self.continue_running:
-                return
-            log_at_first_run("Running check %s", check.name)
-            instance_statuses = []
-            metric_count = 0
-            event_count = 0
-            service_check_count = 0
-            check_start_time = time.time()
-            check_stats = None
-
-            try:
-                # Run the check.
-                instance_statuses = check.run()
-
-                # Collect the metrics and events.
-                current_check_metrics = check.get_metrics()
-                current_check_events = check.get_events()
-                check_stats = check._get_internal_profiling_stats()
-
-                # Collect metadata
-                current_check_metadata = check.get_service_metadata()
-
-                # Save metrics & events for the payload.
-                metrics.extend(current_check_metrics)
-                if current_check_events:
-                    if check.name not in events:
-                        events[check.name] = current_check_events
-                    else:
-                        events[check.name] += current_check_events
-
-                # Save the status of the check.
-                metric_count = len(current_check_metrics)
-                event_count = len(current_check_events)
+        # Schedule relative to the start of the collection, which follows the agent's loop
+        check_runs = self._run_checks_d(log_at_first_run, timer.started)
+        if check_runs is None:
+            return
+        for check_run in check_runs:
+            check = check_run.check
+            if check_run.timed_out:
+                check_statuses.append(self._timed_out_check_status(check_run, service_checks))
+                continue
+            if check_run.skipped:
+                # Nothing ran, report the last known statuses but no new service check
+                if check_run.instance_statuses:
+                    check_statuses.append(CheckStatus(
+                        check.name, check_run.instance_statuses, 0, 0, 0,
+                        service_metadata=check_run.service_metadata,
+                        library_versions=check.get_library_info(),
+                        source_type_name=check.SOURCE_TYPE_NAME or check.name,
+                        check_version=check.check_version
+                    ))
+                continue
 
-            except Exception:
-                log.exception("Error running check %s" % check.name)
+            # Save metrics & events for the payload.
+            metrics.extend(check_run.metrics)
+            if check_run.events:
+                if check.name not in events:
+                    events[check.name] = check_run.events
+                else:
+                    events[check.name] += check_run.events
 
             check_status = CheckStatus(
-                check.name, instance_statuses, metric_count,
-                event_count, service_check_count, service_metadata=current_check_metadata,
+                check.name, check_run.instance_statuses, check_run.metric_count,
+                len(check_run.events), 0, service_metadata=check_run.service_metadata,
                 library_versions=check.get_library_info(),
                 source_type_name=check.SOURCE_TYPE_NAME or check.name,
-                check_stats=check_stats, check_version=check.check_version
+                check_stats=check_run.check_stats, check_version=check.check_version
             )
 
             # Service check for Agent checks failures
@@ -474,7 +732,7 @@ class Collector(object):
             check_status.service_check_count = service_check_count
             check_statuses.append(check_status)
 
-            check_run_time = time.time() - check_start_time
+            check_run_time = check_run.run_time
             log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
 
             # Intrument check run timings if enabled.
@@ -482,6 +740,9 @@ class Collector(object):
                 metric = 'datadog.agent.check_run_time'
                 meta = {'tags': ["check:%s" % check.name]}
                 metrics.append((metric, time.time(), check_run_time, meta))
+                # Time saved by not copying the instances of the check
+                metrics.append(('datadog.agent.check_instance_copy_saved', time.time(),
+                                check_run.instance_copy_saved, meta))
 
             if hasattr(check, A7_COMPATIBILITY_ATTR) and isinstance(getattr(check, A7_COMPATIBILITY_ATTR), str):
                 metric = 'datadog.agent.check_ready'
@@ -498,6 +759,24 @@ class Collector(object):
                 # 1: is compatible with A7
                 metrics.append((metric, time.time(), a7_compatible_to_int(status), meta))
 
+        # Metrics of the last completed checks that didn't fill a batch go with the payload
+        metrics.extend(self._streamed_metrics)
+        self._streamed_metrics = []
+
+        # Intrument the commands run by the collector and the checks if enabled.
+        if self.check_timings:
+            now = time.time()
+            for command, stats in sorted(subprocess_stats.flush().iteritems()):
+                meta = {'tags': ["command:%s" % command]}
+                for name in ('count', 'errors', 'timeouts', 'run_time'):
+                    metrics.append(('datadog.agent.subprocess.%s' % name, now, stats[name], meta))
+
+            # Payloads compressed by the emitter since the previous run
+            compression = get_compressor(self.agentConfig).flush()
+            if compression['payloads']:
+                for name in ('ratio', 'time', 'raw_bytes', 'compressed_bytes'):
+                    metrics.append(('datadog.agent.compression.%s' % name, now, compression[name], {}))
+
         for check_name, info in self.init_failed_checks_d.iteritems():
             if not self.continue_running:
                 return
@@ -576,8 +855,211 @@ class Collector(object):
             log.debug("Finished run #%s. Collection time: %ss. Emit time: %ss" %
                       (self.run_count, round(collect_duration, 2), round(self.emit_duration, 2)))
 
+        # The first run gathered the metadata itself, keep it fresh from now on
+        if self._is_first_run():
+            self._metadata_refresher.start()
+
         return payload
 
+    def next_check_run(self):
+        """ Time at which `run_scheduled_checks` should be called next, None if nothing is scheduled. """
+        return self.scheduler.next_run()
+
+    def run_scheduled_checks(self, log_at_first_run=log.debug, now=None):
+        """
+        Run the checks.d check instances that are due according to the scheduler.
+        Their results are kept until the next collection run.
+        Returns False if the collector is stopping.
+        """
+        now = time.time() if now is None else now
+        self.scheduler.sync(self.initialized_checks_d, now)
+        self._collect_finished_checks()
+
+        if self._check_pool is None and self._needs_pool():
+            self._check_pool = Pool(max(self.check_workers, 1), name='Collector', daemon=True)
+
+        serial_runs = []
+        for check, instance_ids in self.scheduler.pop_due(now):
+            if check in self._running_checks:
+                log.debug("Check %s is still running, skipping its scheduled run", check.name)
+                continue
+            check_run = CheckRun(check, instance_ids, self.check_timeout)
+            if self._check_pool is None or check_run.is_serial():
+                serial_runs.append(check_run)
+                continue
+            log_at_first_run("Running check %s", check.name)
+            result = self._check_pool.apply_async(check_run.execute)
+            self._running_checks[check] = (check_run, result)
+
+        # Serial checks run in the main thread while the pool is busy
+        for check_run in serial_runs:
+            if not self.continue_running:
+                return False
+            log_at_first_run("Running check %s", check_run.check.name)
+            self._add_check_run(check_run.execute())
+
+        return True
+
+    def _needs_pool(self):
+        """
+        Checks run in worker threads when running several at once, or when
+        they have a timeout: the main thread can't give up on a check it runs.
+        """
+        if self.check_workers > 1 or self.check_timeout:
+            return True
+        return any(CheckRun(check).has_timeout() for check in self.initialized_checks_d)
+
+    def _collect_finished_checks(self):
+        for check, (check_run, result) in self._running_checks.items():
+            if result.ready():
+                self._finish_check_run(check)
+
+    def _finish_check_run(self, check):
+        check_run, _ = self._running_checks.pop(check)
+        if check_run.abandoned:
+            log.info("Check %s completed after timing out", check.name)
+            # The worker that replaced this one isn't needed anymore
+            if self._check_pool is not None:
+                self._check_pool.remove_worker()
+        check_run.timed_out = False
+        self._add_check_run(check_run)
+
+    def _abandon_check_run(self, check_run):
+        """
+        Leave an overrunning check to its worker thread, which keeps running
+        it since threads can't be killed, and start a new worker in its place
+        so that other checks keep running.
+        """
+        check_run.timed_out = True
+        if check_run.abandoned:
+            return
+        check_run.abandoned = True
+        instance_id = check_run.current_instance[0]
+        log.warning("Instance #%s of check %s didn't complete within %ss, moving on",
+                    instance_id, check_run.check.name, check_run.instance_timeout(instance_id))
+        self._check_pool.add_worker()
+
+    def _add_check_run(self, check_run):
+        if self.stream_check_metrics and check_run.metrics and self._emitters_accept_series():
+            self._streamed_metrics.extend(check_run.metrics)
+            check_run.streamed_metric_count += len(check_run.metrics)
+            check_run.metrics = []
+            if len(self._streamed_metrics) >= self.stream_batch_size:
+                self._stream_check_metrics()
+
+        previous_run = self._check_runs.get(check_run.check)
+        if previous_run is None:
+            self._check_runs[check_run.check] = check_run
+        else:
+            previous_run.absorb(check_run)
+
+    def _stream_check_metrics(self):
+        """
+        Send the metrics of the checks completed so far without waiting for the
+        others. The rest of the payload, metadata included, is still sent once
+        per collection.
+        """
+        metrics, self._streamed_metrics = self._streamed_metrics, []
+        payload = {
+            'apiKey': self.agentConfig['api_key'],
+            'internalHostname': self.hostname,
+            'metrics': metrics,
+        }
+        log.debug("Sending the %s metrics of the completed checks", len(metrics))
+        self._emit(payload, SERIES_ENDPOINT)
+
+    def _emitters_accept_series(self):
+        """
+        Streamed metrics are left out of the payload, so they're only streamed when
+        every emitter opts in to the partial payloads of the series endpoint.
+        """
+        return all(getattr(emitter, 'accepts_series', False) for emitter in self.emitters)
+
+    def _run_checks_d(self, log_at_first_run, now=None):
+        """
+        Run the due checks.d checks and return one `CheckRun` per check, in the
+        order of `initialized_checks_d` so that the payload doesn't depend on which
+        check finishes first. Returns None if the collector is stopping.
+
+        With `check_workers` > 1 the checks run concurrently in a thread pool.
+        An instance still running after its `check_timeout` is left to its
+        worker and the check is reported as timed out; it isn't scheduled
+        again until that run completes, and the results of that run are
+        merged then.
+        """
+        if not self.run_scheduled_checks(log_at_first_run, now):
+            return None
+
+        for check in self.initialized_checks_d:
+            if check not in self._running_checks:
+                continue
+            check_run, result = self._running_checks[check]
+            while not result.ready() and self.continue_running:
+                deadline = check_run.deadline()
+                if deadline is not None and time.time() > deadline:
+                    self._abandon_check_run(check_run)
+                    break
+                result.wait(CHECK_WAIT_INTERVAL)
+                # Pick up the other checks as they complete, so their metrics can be streamed
+                self._collect_finished_checks()
+            if not self.continue_running:
+                return None
+            if result.ready() and check in self._running_checks:
+                self._finish_check_run(check)
+
+        check_runs = []
+        for check in self.initialized_checks_d:
+            if check in self._running_checks:
+                # Results completed earlier are kept for the next collection
+                check_runs.append(self._running_checks[check][0])
+                continue
+            check_run = self._check_runs.pop(check, None)
+            if check_run is None:
+                # Nothing completed since the last collection
+                check_run = CheckRun(check)
+                check_run.run_time = 0
+                check_run.skipped = True
+            # Instances that didn't run keep their last status and metadata
+            results = self._instance_statuses.setdefault(check, {})
+            results.update(check_run.instance_results())
+            check_run.set_instance_results(results)
+            check_runs.append(check_run)
+
+        # Forget the results of checks that were unscheduled in the meantime
+        checks = set(self.initialized_checks_d)
+        self._check_runs = dict((c, r) for c, r in self._check_runs.iteritems() if c in checks)
+        self._instance_statuses = dict((c, s) for c, s in self._instance_statuses.iteritems() if c in checks)
+
+        return check_runs
+
+    def _timed_out_check_status(self, check_run, service_checks):
+        """
+        Status of a check whose run is still in progress. The check itself is
+        left alone, since its worker thread may still be using it.
+        """
+        check = check_run.check
+        instance_statuses = list(check_run.completed_statuses)
+        current_instance = check_run.current_instance
+        if current_instance is not None:
+            instance_id, start_time = current_instance
+            error = "Instance #%s timed out after %ss, running for %ds" % (
+                instance_id, check_run.instance_timeout(instance_id), time.time() - start_time)
+            instance_statuses.append(InstanceStatus(instance_id, STATUS_ERROR, error=error))
+        else:
+            error = "Check timed out"
+        # The metadata of this run is only read once it completes, use the last known one
+        last_results = self._instance_statuses.get(check, {})
+        service_metadata = [last_results.get(s.instance_id, (None, {}))[1] for s in instance_statuses]
+        service_checks.append(create_service_check(
+            'datadog.agent.check_status', AgentCheck.CRITICAL,
+            tags=["check:%s" % check.name], hostname=self.hostname, message=error))
+        return CheckStatus(
+            check.name, instance_statuses, 0, 0, 0, service_metadata=service_metadata,
+            library_versions=check.get_library_info(),
+            source_type_name=check.SOURCE_TYPE_NAME or check.name,
+            check_version=check.check_version
+        )
+
     @staticmethod
     def run_single_check(check, verbose=True):
         log.info("Running check %s" % check.name)
@@ -622,7 +1104,7 @@ class Collector(object):
 
         return check_status
 
-    def _emit(self, payload):
+    def _emit(self, payload, endpoint=AgentPayload.COMMON_ENDPOINT):
         """ Send the payload via the emitters. """
         statuses = []
         for emitter in self.emitters:
@@ -630,9 +1112,8 @@ class Collector(object):
             if not self.continue_running:
                 return statuses
             name = emitter.__name__
-            emitter_status = EmitterStatus(name)
             try:
-                emitter(payload, log, self.agentConfig)
+                emitter_status = EmitterStatus(name, timings=emitter(payload, log, self.agentConfig, endpoint))
             except Exception as e:
                 log.exception("Error running emitter: %s" % emitter.__name__)
                 emitter_status = EmitterStatus(name, e)
@@ -683,20 +1164,17 @@ class Collector(object):
         # Periodically send the host metadata.
         if self._should_send_additional_data('host_metadata'):
             # gather metadata with gohai
-            gohai_metadata = self._run_gohai_metadata()
+            gohai_metadata = self._metadata_refresher.get('gohai')
             if gohai_metadata:
                 payload['gohai'] = gohai_metadata
 
-            payload['systemStats'] = get_system_stats(
-                proc_path=self.agentConfig.get('procfs_path', '/proc').rstrip('/')
-            )
+            host_metadata = self._metadata_refresher.get('host_metadata') or {}
+            payload['systemStats'] = host_metadata.get('systemStats')
 
-            if self.agentConfig['collect_orchestrator_tags']:
-                host_container_metadata = MetadataCollector().get_host_metadata()
-                if host_container_metadata:
-                    payload['container-meta'] = host_container_metadata
+            if host_metadata.get('container-meta'):
+                payload['container-meta'] = host_metadata['container-meta']
 
-            payload['meta'] = self._get_hostname_metadata()
+            payload['meta'] = host_metadata.get('meta')
 
             self.hostname_metadata_cache = payload['meta']
             # Add static tags from the configuration file
@@ -705,13 +1183,7 @@ class Collector(object):
                 host_tags.extend([unicode(tag.strip())
                                  for tag in self.agentConfig['tags'].split(",")])
 
-            if self.agentConfig['collect_ec2_tags']:
-                host_tags.extend(EC2.get_tags(self.agentConfig))
-
-            if self.agentConfig['collect_orchestrator_tags']:
-                host_docker_tags = MetadataCollector().get_host_tags()
-                if host_docker_tags:
-                    host_tags.extend(host_docker_tags)
+            host_tags.extend(host_metadata.get('host_tags', []))
 
             if host_tags:
                 payload['host-tags']['system'] = host_tags
@@ -727,7 +1199,7 @@ class Collector(object):
 
                 payload['host-tags']['system'].extend(app_tags_list)
 
-            GCE_tags = GCE.get_tags(self.agentConfig)
+            GCE_tags = host_metadata.get('gce_tags')
             if GCE_tags is not None:
                 payload['host-tags'][GCE.SOURCE_TYPE_NAME] = GCE_tags
 
@@ -781,6 +1253,34 @@ class Collector(object):
             payload['agent_checks'] = agent_checks
             payload['meta'] = self.hostname_metadata_cache  # add hostname metadata
 
+    def _collect_host_metadata(self):
+        """
+        Gather the host metadata that involves system calls, subprocesses or
+        HTTP requests to cloud providers. Run by the metadata refresher.
+        """
+        host_metadata = {
+            'systemStats': get_system_stats(
+                proc_path=self.agentConfig.get('procfs_path', '/proc').rstrip('/')
+            ),
+            'meta': self._get_hostname_metadata(),
+            'host_tags': [],
+        }
+
+        if self.agentConfig['collect_orchestrator_tags']:
+            host_metadata['container-meta'] = MetadataCollector().get_host_metadata()
+
+        if self.agentConfig['collect_ec2_tags']:
+            host_metadata['host_tags'].extend(EC2.get_tags(self.agentConfig))
+
+        if self.agentConfig['collect_orchestrator_tags']:
+            host_docker_tags = MetadataCollector().get_host_tags()
+            if host_docker_tags:
+                host_metadata['host_tags'].extend(host_docker_tags)
+
+        host_metadata['gce_tags'] = GCE.get_tags(self.agentConfig)
+
+        return host_metadata
+
     def _get_hostname_metadata(self):
         """
         Returns a dictionnary that contains hostname metadata.
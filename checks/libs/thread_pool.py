@@ -20,6 +20,7 @@
 # The methods of a Pool object use all these concepts and expose
 # them to their caller in a very simple way.
 # stdlib
+import itertools
 import Queue
 import sys
 import threading
@@ -72,16 +73,22 @@ class Pool(object):
     few different ways
     """
 
-    def __init__(self, nworkers, name="Pool"):
+    def __init__(self, nworkers, name="Pool", daemon=False):
         """
         \param nworkers (integer) number of worker threads to start
         \param name (string) prefix for the worker threads' name
+        \param daemon (bool) whether the worker threads are daemonic, so
+        that a stuck job doesn't prevent the interpreter from exiting
         """
         self._workq = Queue.Queue()
         self._closed = False
         self._workers = []
+        self._name = name
+        self._daemon = daemon
+        self._worker_ids = itertools.count(nworkers)
         for idx in xrange(nworkers):
             thr = PoolWorker(self._workq, name="Worker-%s-%d" % (name, idx))
+            thr.daemon = daemon
             try:
                 thr.start()
             except:
@@ -91,6 +98,20 @@ class Pool(object):
             else:
                 self._workers.append(thr)
 
+    def add_worker(self):
+        """Start an extra worker thread, e.g. to replace one that is
+        stuck on a job"""
+        thr = PoolWorker(self._workq, name="Worker-%s-%d" % (self._name, next(self._worker_ids)))
+        thr.daemon = self._daemon
+        thr.start()
+        self._workers = [w for w in self._workers if w.is_alive()]
+        self._workers.append(thr)
+
+    def remove_worker(self):
+        """Make one worker thread exit once it's done with its current
+        job"""
+        self._workq.put(SENTINEL)
+
     def get_nworkers(self):
         return len([w for w in self._workers if w.running])
 
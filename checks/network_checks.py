@@ -32,6 +32,8 @@ class NetworkCheck(AgentCheck):
     SOURCE_TYPE_NAME = 'servicecheck'
     SERVICE_CHECK_PREFIX = 'network_check'
     _global_current_pool_size = 0
+    # Instances are processed asynchronously, after `check` returns
+    DEEPCOPY_INSTANCES = True
 
     STATUS_TO_SERVICE_CHECK = {
         Status.UP : AgentCheck.OK,
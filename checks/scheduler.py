@@ -0,0 +1,102 @@
+# (C) Datadog, Inc. 2010-2017
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+# stdlib
+from collections import defaultdict
+import heapq
+import itertools
+import math
+import random
+import time
+
+# Deadlines this close to the current time are considered due, so that runs
+# aligned with the collection loop aren't pushed back a whole interval by noise
+SCHEDULING_TOLERANCE = 1.0
+
+
+def next_deadline(deadline, interval, now):
+    """
+    Next occurrence of a periodic deadline strictly after `now`. Deadlines stay
+    on the original grid, so a late run doesn't push back the following ones,
+    and missed occurrences are skipped instead of run in a burst.
+    """
+    deadline += interval
+    if deadline <= now:
+        deadline += interval * (math.floor((now - deadline) / interval) + 1)
+    return deadline
+
+
+class CheckScheduler(object):
+    """
+    Keeps the next run time of every instance of every checks.d check in a heap.
+
+    An instance runs every `default_interval` (`check_freq`) seconds, or every
+    `min_collection_interval` seconds when it's longer. Shorter intervals are only
+    honored with `short_intervals`, the instance then runs between collections.
+    Instances with an interval longer than the default one start at a random
+    offset within their interval, so that expensive checks don't all run during
+    the same collection.
+    """
+    def __init__(self, default_interval, jitter=True, short_intervals=False):
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self.short_intervals = short_intervals
+        self._heap = []
+        self._checks = set()
+        self._counter = itertools.count()
+
+    def interval(self, check, instance):
+        interval = instance.get('min_collection_interval', check.min_collection_interval)
+        try:
+            interval = float(interval)
+        except (TypeError, ValueError):
+            interval = 0
+        if interval <= 0 or (interval < self.default_interval and not self.short_intervals):
+            return self.default_interval
+        return interval
+
+    def sync(self, checks, now=None):
+        """
+        Schedule the checks that aren't yet and forget the ones that are gone,
+        e.g. after a configuration reload.
+        """
+        now = time.time() if now is None else now
+        checks = set(checks)
+        for check in checks - self._checks:
+            for instance_id, instance in enumerate(check.instances or []):
+                interval = self.interval(check, instance)
+                start = now
+                if self.jitter and interval > self.default_interval:
+                    start += random.uniform(0, interval)
+                self._push(start, check, instance_id, interval)
+
+        if self._checks - checks:
+            self._heap = [entry for entry in self._heap if entry[2] in checks]
+            heapq.heapify(self._heap)
+        self._checks = checks
+
+    def next_run(self):
+        """ Time of the earliest scheduled instance run, None if nothing is scheduled. """
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """
+        Return the instances due at `now` as a list of (check, instance_ids),
+        and schedule their next run.
+        """
+        now = time.time() if now is None else now
+        due = defaultdict(list)
+        order = []
+        while self._heap and self._heap[0][0] <= now + SCHEDULING_TOLERANCE:
+            deadline, _, check, instance_id, interval = heapq.heappop(self._heap)
+            if check not in due:
+                order.append(check)
+            due[check].append(instance_id)
+            self._push(next_deadline(deadline, interval, now), check, instance_id, interval)
+
+        return [(c, sorted(due[c])) for c in order]
+
+    def _push(self, deadline, check, instance_id, interval):
+        # The counter breaks ties so that checks themselves are never compared
+        heapq.heappush(self._heap, (deadline, next(self._counter), check, instance_id, interval))
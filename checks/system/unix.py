@@ -7,7 +7,9 @@ Unix system checks.
 """
 # stdlib
 import operator
+import os
 import platform
+import pwd
 import re
 import sys
 import time
@@ -29,6 +31,15 @@ from utils.subprocess_output import get_subprocess_output
 # locale-resilient float converter
 to_float = lambda s: float(s.replace(",", "."))
 
+# /proc/diskstats sectors are always 512 bytes, whatever the device
+DISKSTATS_SECTOR_KB = 0.5
+
+
+def read_proc_uptime(proc_location):
+    """ Seconds since boot, from /proc/uptime """
+    with open(os.path.join(proc_location, 'uptime'), 'r') as f:
+        return float(f.readline().split()[0])
+
 
 class IO(Check):
 
@@ -37,6 +48,10 @@ class IO(Check):
         self.header_re = re.compile(r'([%\\/\-_a-zA-Z0-9]+)[\s+]?')
         self.item_re = re.compile(r'^([\-a-zA-Z0-9\/]+)')
         self.value_re = re.compile(r'\d+\.\d+')
+        # Read /proc/diskstats on Linux instead of running iostat, until it fails
+        self.use_proc = True
+        # (uptime, {device: counters}) of the previous /proc/diskstats sample
+        self._last_diskstats = None
 
     def _cap_io_util_value(self, val):
         # Cap system.io.util metric value to 102%
@@ -87,6 +102,79 @@ class IO(Check):
 
         return ioStats
 
+    def _read_diskstats(self, proc_location):
+        """
+        Cumulative I/O counters of the devices iostat reports by default: whole
+        devices (the ones under /sys/block, when it's available) that did some I/O.
+
+        @return {"device": (reads, reads_merged, sectors_read, ms_reading, writes,
+                 writes_merged, sectors_written, ms_writing, in_progress, ms_io,
+                 weighted_ms_io)}
+        """
+        sys_block = os.path.join(os.path.dirname(proc_location), 'sys', 'block')
+        try:
+            block_devices = set(os.listdir(sys_block))
+        except OSError:
+            block_devices = None
+
+        diskstats = {}
+        with open(os.path.join(proc_location, 'diskstats'), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 14:
+                    continue
+                device = fields[2]
+                if block_devices is not None and device.replace('/', '!') not in block_devices:
+                    continue
+                counters = tuple(int(v) for v in fields[3:14])
+                if counters[0] or counters[4]:
+                    diskstats[device] = counters
+        return diskstats
+
+    def _compute_linux_io(self, previous, current, interval):
+        """
+        iostat -x -k statistics over `interval` seconds, from two /proc/diskstats
+        samples. Values are formatted the way _parse_linux2 returns them.
+        """
+        io = {}
+        for device, counters in current.iteritems():
+            prev = previous.get(device, (0,) * len(counters))
+            (reads, rmerged, rsectors, rticks, writes, wmerged, wsectors, wticks,
+             _, io_ticks, weighted_ticks) = [c - p for c, p in zip(counters, prev)]
+            ios = reads + writes
+            values = {
+                'rrqm/s': rmerged / interval,
+                'wrqm/s': wmerged / interval,
+                'r/s': reads / interval,
+                'w/s': writes / interval,
+                'rkB/s': rsectors * DISKSTATS_SECTOR_KB / interval,
+                'wkB/s': wsectors * DISKSTATS_SECTOR_KB / interval,
+                'avgrq-sz': float(rsectors + wsectors) / ios if ios else 0.0,
+                'avgqu-sz': weighted_ticks / 1000.0 / interval,
+                'await': float(rticks + wticks) / ios if ios else 0.0,
+                'r_await': float(rticks) / reads if reads else 0.0,
+                'w_await': float(wticks) / writes if writes else 0.0,
+                'svctm': float(io_ticks) / ios if ios else 0.0,
+            }
+            io[device] = dict((name, '%.2f' % value) for name, value in values.iteritems())
+            io[device]['%util'] = self._cap_io_util_value(round(io_ticks / interval / 10.0, 2))
+        return io
+
+    def _check_linux_proc(self, proc_location):
+        """
+        Capture io stats from /proc/diskstats, since the previous call (or since
+        boot on the first one) instead of sampling one second with iostat.
+        """
+        uptime = read_proc_uptime(proc_location)
+        diskstats = self._read_diskstats(proc_location)
+        last_uptime, last_diskstats = self._last_diskstats or (0.0, {})
+        self._last_diskstats = (uptime, diskstats)
+
+        interval = uptime - last_uptime
+        if interval <= 0:
+            return {}
+        return self._compute_linux_io(last_diskstats, diskstats, interval)
+
     def _parse_darwin(self, output):
         lines = [l.split() for l in output.split("\n") if len(l) > 0]
         disks = lines[0]
@@ -130,24 +218,33 @@ class IO(Check):
         io = {}
         try:
             if Platform.is_linux():
-                stdout, _, _ = get_subprocess_output(['iostat', '-d', '1', '2', '-x', '-k'], self.logger)
+                if self.use_proc:
+                    try:
+                        io.update(self._check_linux_proc(agentConfig.get('procfs_path', '/proc').rstrip('/')))
+                    except Exception:
+                        self.logger.exception("Cannot read /proc/diskstats, falling back to iostat")
+                        self.use_proc = False
+
+                if not self.use_proc:
+                    stdout, _, _ = get_subprocess_output(['iostat', '-d', '1', '2', '-x', '-k'], self.logger)
+
+                    #                 Linux 2.6.32-343-ec2 (ip-10-35-95-10)   12/11/2012      _x86_64_        (2 CPU)
+                    #
+                    # Device:         rrqm/s   wrqm/s     r/s     w/s    rkB/s    wkB/s avgrq-sz avgqu-sz   await  svctm  %util
+                    # sda1              0.00    17.61    0.26   32.63     4.23   201.04    12.48     0.16    4.81   0.53   1.73
+                    # sdb               0.00     2.68    0.19    3.84     5.79    26.07    15.82     0.02    4.93   0.22   0.09
+                    # sdg               0.00     0.13    2.29    3.84   100.53    30.61    42.78     0.05    8.41   0.88   0.54
+                    # sdf               0.00     0.13    2.30    3.84   100.54    30.61    42.78     0.06    9.12   0.90   0.55
+                    # md0               0.00     0.00    0.05    3.37     1.41    30.01    18.35     0.00    0.00   0.00   0.00
+                    #
+                    # Device:         rrqm/s   wrqm/s     r/s     w/s    rkB/s    wkB/s avgrq-sz avgqu-sz   await  svctm  %util
+                    # sda1              0.00     0.00    0.00   10.89     0.00    43.56     8.00     0.03    2.73   2.73   2.97
+                    # sdb               0.00     0.00    0.00    2.97     0.00    11.88     8.00     0.00    0.00   0.00   0.00
+                    # sdg               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
+                    # sdf               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
+                    # md0               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
+                    io.update(self._parse_linux2(stdout))
 
-                #                 Linux 2.6.32-343-ec2 (ip-10-35-95-10)   12/11/2012      _x86_64_        (2 CPU)
-                #
-                # Device:         rrqm/s   wrqm/s     r/s     w/s    rkB/s    wkB/s avgrq-sz avgqu-sz   await  svctm  %util
-                # sda1              0.00    17.61    0.26   32.63     4.23   201.04    12.48     0.16    4.81   0.53   1.73
-                # sdb               0.00     2.68    0.19    3.84     5.79    26.07    15.82     0.02    4.93   0.22   0.09
-                # sdg               0.00     0.13    2.29    3.84   100.53    30.61    42.78     0.05    8.41   0.88   0.54
-                # sdf               0.00     0.13    2.30    3.84   100.54    30.61    42.78     0.06    9.12   0.90   0.55
-                # md0               0.00     0.00    0.05    3.37     1.41    30.01    18.35     0.00    0.00   0.00   0.00
-                #
-                # Device:         rrqm/s   wrqm/s     r/s     w/s    rkB/s    wkB/s avgrq-sz avgqu-sz   await  svctm  %util
-                # sda1              0.00     0.00    0.00   10.89     0.00    43.56     8.00     0.03    2.73   2.73   2.97
-                # sdb               0.00     0.00    0.00    2.97     0.00    11.88     8.00     0.00    0.00   0.00   0.00
-                # sdg               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
-                # sdf               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
-                # md0               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
-                io.update(self._parse_linux2(stdout))
 
             elif sys.platform == "sunos5":
                 output, _, _ = get_subprocess_output(["iostat", "-x", "-d", "1", "2"], self.logger)
@@ -603,8 +700,138 @@ class Memory(Check):
 
 class Processes(Check):
 
+    MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+              'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+    def __init__(self, logger):
+        Check.__init__(self, logger)
+        # Read /proc on Linux instead of running ps, until it fails
+        self.use_proc = True
+        self._users = {}
+
+    def _get_user(self, uid):
+        if uid not in self._users:
+            try:
+                self._users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self._users[uid] = str(uid)
+        return self._users[uid]
+
+    @staticmethod
+    def _format_tty(tty_nr):
+        major = (tty_nr >> 8) & 0xfff
+        minor = (tty_nr & 0xff) | ((tty_nr >> 12) & 0xfff00)
+        if 136 <= major <= 143:
+            return 'pts/%d' % (minor + (major - 136) * 256)
+        if major == 4:
+            return 'tty%d' % minor if minor < 64 else 'ttyS%d' % (minor - 64)
+        return '?'
+
+    def _format_start(self, start, now):
+        """ Start time the way ps displays it: time, date, or year if it's older """
+        start_tm = time.localtime(start)
+        now_tm = time.localtime(now)
+        if start_tm.tm_year == now_tm.tm_year and start_tm.tm_yday == now_tm.tm_yday:
+            return time.strftime('%H:%M', start_tm)
+        if start_tm.tm_year == now_tm.tm_year:
+            return '%s%02d' % (self.MONTHS[start_tm.tm_mon - 1], start_tm.tm_mday)
+        return str(start_tm.tm_year)
+
+    def _read_user_and_command(self, proc_location, pid, comm):
+        """
+        Read at every pass: processes change their user with setuid, and their
+        command line with exec or by rewriting their title (setproctitle).
+        """
+        pid_dir = os.path.join(proc_location, pid)
+        user = self._get_user(os.stat(pid_dir).st_uid)
+        with open(os.path.join(pid_dir, 'cmdline'), 'r') as f:
+            args = [a for a in f.read().split('\0') if a]
+        if args:
+            return (user, args[0], ' '.join(args))
+        # Kernel threads and zombies don't have a command line
+        return (user, '[%s]' % comm, '[%s]' % comm)
+
+    def _read_proc_processes(self, proc_location, exclude_args=False):
+        """
+        The rows of `ps auxww` (`ps aux` with `exclude_process_args`, without the
+        arguments), read from /proc/<pid>/stat and cmdline.
+        """
+        clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+        page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+        uptime = read_proc_uptime(proc_location)
+        now = time.time()
+        boot_time = now - uptime
+        with open(os.path.join(proc_location, 'meminfo'), 'r') as f:
+            mem_total_kb = next(int(l.split()[1]) for l in f if l.startswith('MemTotal:'))
+
+        processes = []
+        for pid in os.listdir(proc_location):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(proc_location, pid, 'stat'), 'r') as f:
+                    stat = f.read()
+                # The command name can contain spaces and parentheses
+                comm = stat[stat.find('(') + 1:stat.rfind(')')]
+                fields = stat[stat.rfind(')') + 2:].split()
+                starttime = int(fields[19])
+                user, command, args = self._read_user_and_command(proc_location, pid, comm)
+            except (IOError, OSError):
+                # The process exited in the meantime
+                continue
+
+            state = fields[0]
+            pgrp, session, tty_nr, tpgid = [int(v) for v in fields[2:6]]
+            cpu_time = (int(fields[11]) + int(fields[12])) / clock_ticks
+            nice = int(fields[16])
+            num_threads = int(fields[17])
+            vsz_kb = int(fields[20]) / 1024
+            rss_kb = int(fields[21]) * page_kb
+
+            if nice < 0:
+                state += '<'
+            elif nice > 0:
+                state += 'N'
+            if session == int(pid):
+                state += 's'
+            if num_threads > 1:
+                state += 'l'
+            if tpgid == pgrp:
+                state += '+'
+
+            # ps truncates percentages to one decimal, it doesn't round them
+            elapsed = uptime - starttime / clock_ticks
+            pcpu = int(1000 * cpu_time / elapsed) if elapsed > 0 else 0
+            pmem = 1000 * rss_kb / mem_total_kb if mem_total_kb else 0
+            processes.append([
+                user,
+                pid,
+                '%d.%d' % divmod(pcpu, 10),
+                '%d.%d' % divmod(pmem, 10),
+                str(vsz_kb),
+                str(rss_kb),
+                self._format_tty(tty_nr),
+                state,
+                self._format_start(boot_time + starttime / clock_ticks, now),
+                '%d:%02d' % divmod(int(cpu_time), 60),
+                command if exclude_args else args,
+            ])
+
+        return processes
+
     def check(self, agentConfig):
         process_exclude_args = agentConfig.get('exclude_process_args', False)
+        if Platform.is_linux() and self.use_proc:
+            try:
+                processes = self._read_proc_processes(
+                    agentConfig.get('procfs_path', '/proc').rstrip('/'), process_exclude_args)
+                return {'processes':   processes,
+                        'apiKey':      agentConfig['api_key'],
+                        'host':        get_hostname(agentConfig)}
+            except Exception:
+                self.logger.exception("Cannot read processes from /proc, falling back to ps")
+                self.use_proc = False
+
         if process_exclude_args:
             ps_arg = 'aux'
         else:
@@ -632,13 +859,63 @@ class Processes(Check):
 
 class Cpu(Check):
 
+    def __init__(self, logger):
+        Check.__init__(self, logger)
+        # Read /proc/stat on Linux instead of running mpstat, until it fails
+        self.use_proc = True
+        # CPU time counters of the previous /proc/stat sample
+        self._last_cpu_times = None
+
+    @staticmethod
+    def _format_results(us, sy, wa, idle, st, guest=None):
+        data = {'cpuUser': us, 'cpuSystem': sy, 'cpuWait': wa, 'cpuIdle': idle, 'cpuStolen': st, 'cpuGuest': guest}
+        return dict((k, v) for k, v in data.iteritems() if v is not None)
+
+    def _read_cpu_times(self, proc_location):
+        """ Counters of the aggregated `cpu` line of /proc/stat, in jiffies """
+        with open(os.path.join(proc_location, 'stat'), 'r') as f:
+            for line in f:
+                if line.startswith('cpu '):
+                    return [int(v) for v in line.split()[1:]]
+        raise ValueError("No aggregated cpu line in /proc/stat")
+
+    def _check_linux_proc(self, proc_location):
+        """
+        CPU usage since the previous call (or since boot on the first one),
+        computed the way mpstat does, instead of sampling 3 seconds with it.
+        """
+        cpu_times = self._read_cpu_times(proc_location)
+        last_cpu_times = self._last_cpu_times or [0] * len(cpu_times)
+        self._last_cpu_times = cpu_times
+
+        # Older kernels don't have the steal and guest columns
+        deltas = [max(c - p, 0) for c, p in zip(cpu_times, last_cpu_times)] + [0] * 10
+        user, nice, system, idle, iowait, irq, softirq, steal, guest, guest_nice = deltas[:10]
+        # user and nice already account for the time spent running guests
+        total = user + nice + system + idle + iowait + irq + softirq + steal
+        if not total:
+            return False
+
+        pct = lambda v: round(100.0 * max(v, 0) / total, 2)
+        return self._format_results(pct(user - guest) + pct(nice - guest_nice),
+                                    pct(system) + pct(irq) + pct(softirq),
+                                    pct(iowait),
+                                    pct(idle),
+                                    pct(steal),
+                                    pct(guest))
+
     def check(self, agentConfig):
         """Return an aggregate of CPU stats across all CPUs
         When figures are not available, False is sent back.
         """
-        def format_results(us, sy, wa, idle, st, guest=None):
-            data = {'cpuUser': us, 'cpuSystem': sy, 'cpuWait': wa, 'cpuIdle': idle, 'cpuStolen': st, 'cpuGuest': guest}
-            return dict((k, v) for k, v in data.iteritems() if v is not None)
+        format_results = self._format_results
+
+        if Platform.is_linux() and self.use_proc:
+            try:
+                return self._check_linux_proc(agentConfig.get('procfs_path', '/proc').rstrip('/'))
+            except Exception:
+                self.logger.exception("Cannot read /proc/stat, falling back to mpstat")
+                self.use_proc = False
 
         def get_value(legend, data, name, filter_value=None):
             "Using the legend and a metric name, get the value or None from the data line"
@@ -16,6 +16,7 @@ initialize_logging('forwarder')
 # stdlib
 import copy
 from datetime import timedelta
+from hashlib import md5
 import logging
 import os
 from Queue import Full, Queue
@@ -52,13 +53,26 @@ from config import (
     _is_affirmative
 )
 import modules
-from transaction import Transaction, TransactionManager
+from transaction import (
+    ADAPTIVE_MAX_PARALLELISM,
+    ADAPTIVE_MAX_RATE,
+    AdaptiveThrottler,
+    DEFAULT_QUEUE_SHARES,
+    PRIORITIES,
+    PRIORITY_EVENTS,
+    PRIORITY_METADATA,
+    PRIORITY_METRICS,
+    PRIORITY_SERVICE_CHECKS,
+    Transaction,
+    TransactionManager,
+)
 from util import get_uuid
 from utils.net import DEFAULT_DNS_TTL, DNSCache
 
 
 
 from utils.hostname import get_hostname
+from utils.http import PAYLOAD_TYPE_HEADER
 from utils.logger import RedactedLogRecord
 from utils.watchdog import Watchdog
 
@@ -93,6 +107,75 @@ RESPONSES_TO_REJECT = [413, 400]
 
 THROTTLING_DELAY = timedelta(microseconds=1000000 / 2)  # 2 msg/second
 
+# Priority class of the intake payloads, by message type. The legacy payloads
+# (collector and dogstatsd) are mostly metrics: they're evicted first, like the
+# series payloads, rather than outranking metadata and service checks
+MSG_TYPE_PRIORITIES = {
+    "": PRIORITY_METRICS,
+    "metrics": PRIORITY_METRICS,
+    "metadata": PRIORITY_METADATA,
+}
+# Intake payloads that only hold one kind of data say so in a header, e.g. the
+# events posted by dogstatsd
+PAYLOAD_TYPE_PRIORITIES = {
+    "events": PRIORITY_EVENTS,
+}
+
+# Custom emitters
+DEFAULT_EMITTER_QUEUE_SIZE = 100  # payloads waiting for each custom emitter
+EMITTER_DROP_LOGGING_PERIOD = 100
+
+# Maximum size of a transaction built by merging queued series/check_run transactions
+MAX_COALESCED_SIZE = 2 << 20  # 2MB, same as the emitter's compressed payload limit
+
+
+def get_queue_shares(agentConfig):
+    """Parse the `forwarder_queue_shares` option, a list of `priority:percentage`
+    pairs, falling back to the default share of any missing or invalid class"""
+    shares = dict(DEFAULT_QUEUE_SHARES)
+    for item in agentConfig.get('forwarder_queue_shares', '').split(','):
+        if not item.strip():
+            continue
+        try:
+            priority, percentage = [x.strip() for x in item.split(':')]
+            if priority not in PRIORITIES:
+                raise ValueError("unknown priority class %r" % priority)
+            shares[priority] = float(percentage) / 100
+        except ValueError as e:
+            log.warning("Invalid forwarder_queue_shares item %r: %s", item, e)
+    return shares
+
+
+class EmitterPayload(object):
+    """A payload shared by all the custom emitters.
+
+    It's decompressed and decoded lazily, once, by the first emitter thread
+    that needs it, so that this work never happens on the IOLoop.
+    """
+
+    def __init__(self, data, headers=None):
+        self._raw = data
+        # Headers are modified by the transaction, only keep what we need
+        self._deflated = bool(headers) and headers.get('Content-Encoding') == 'deflate'
+        self._lock = threading.Lock()
+        self._decoded = None
+        self._error = None
+
+    def get(self):
+        with self._lock:
+            if self._raw is not None:
+                try:
+                    data = self._raw
+                    if self._deflated:
+                        data = zlib.decompress(data)
+                    self._decoded = json_decode(data)
+                except Exception as e:
+                    self._error = e
+                self._raw = None
+            if self._error is not None:
+                raise self._error
+            return self._decoded
+
 
 class EmitterThread(threading.Thread):
 
@@ -103,23 +186,41 @@ class EmitterThread(threading.Thread):
         self.__config = kwargs.pop('config')
         self.__max_queue_size = kwargs.pop('max_queue_size', 100)
         self.__queue = Queue(self.__max_queue_size)
+        self.handled_count = 0
+        self.dropped_count = 0
+        self.error_count = 0
         threading.Thread.__init__(self, *args, **kwargs)
         self.daemon = True
 
     def run(self):
         while True:
-            (data, headers) = self.__queue.get()
+            (payload, headers) = self.__queue.get()
             try:
                 self.__logger.debug('Emitter %r handling a packet', self.__name)
-                self.__emitter(data, self.__logger, self.__config)
+                self.__emitter(payload.get(), self.__logger, self.__config)
+                self.handled_count += 1
             except Exception:
+                self.error_count += 1
                 self.__logger.error('Failure during operation of emitter %r', self.__name, exc_info=True)
 
-    def enqueue(self, data, headers):
+    def enqueue(self, payload, headers):
         try:
-            self.__queue.put((data, headers), block=False)
+            self.__queue.put((payload, headers), block=False)
         except Full:
-            self.__logger.warn('Dropping packet for %r due to backlog', self.__name)
+            self.dropped_count += 1
+            # Don't flood the logs when the emitter is stuck
+            if self.dropped_count == 1 or self.dropped_count % EMITTER_DROP_LOGGING_PERIOD == 0:
+                self.__logger.warn('Dropping packet for %r due to backlog (%s dropped so far)',
+                                   self.__name, self.dropped_count)
+
+    def get_stats(self):
+        return {
+            'queue_size': self.__queue.qsize(),
+            'max_queue_size': self.__max_queue_size,
+            'handled': self.handled_count,
+            'dropped': self.dropped_count,
+            'errors': self.error_count,
+        }
 
 
 class EmitterManager(object):
@@ -128,6 +229,7 @@ class EmitterManager(object):
     def __init__(self, config):
         self.agentConfig = config
         self.emitterThreads = []
+        max_queue_size = int(self.agentConfig.get('custom_emitters_queue_size', DEFAULT_EMITTER_QUEUE_SIZE))
         for emitter_spec in [s.strip() for s in self.agentConfig.get('custom_emitters', '').split(',')]:
             if len(emitter_spec) == 0:
                 continue
@@ -138,6 +240,7 @@ class EmitterManager(object):
                     emitter=modules.load(emitter_spec, 'emitter'),
                     logger=logging,
                     config=config,
+                    max_queue_size=max_queue_size,
                 )
                 thread.start()
                 self.emitterThreads.append(thread)
@@ -148,12 +251,14 @@ class EmitterManager(object):
     def send(self, data, headers=None):
         if not self.emitterThreads:
             return  # bypass decompression/decoding
-        if headers and headers.get('Content-Encoding') == 'deflate':
-            data = zlib.decompress(data)
-        data = json_decode(data)
+        # Decoding is done by the emitter threads, not on the IOLoop
+        payload = EmitterPayload(data, headers)
         for emitterThread in self.emitterThreads:
-            logging.info('Queueing for emitter %r', emitterThread.name)
-            emitterThread.enqueue(data, headers)
+            logging.debug('Queueing for emitter %r', emitterThread.name)
+            emitterThread.enqueue(payload, headers)
+
+    def get_stats(self):
+        return dict((t.name, t.get_stats()) for t in self.emitterThreads)
 
 
 class AgentTransaction(Transaction):
@@ -211,6 +316,78 @@ class AgentTransaction(Transaction):
     def __sizeof__(self):
         return sys.getsizeof(self._data)
 
+    def get_priority(self):
+        payload_type = self._headers.get(PAYLOAD_TYPE_HEADER)
+        if payload_type in PAYLOAD_TYPE_PRIORITIES:
+            return PAYLOAD_TYPE_PRIORITIES[payload_type]
+        return MSG_TYPE_PRIORITIES.get(self._msg_type, PRIORITY_METRICS)
+
+    def _decode_data(self):
+        data = self._data
+        if self._headers.get('Content-Encoding') == 'deflate':
+            data = zlib.decompress(data)
+        return json.loads(data)
+
+    @classmethod
+    def _merged_headers(cls, transactions, data):
+        headers = dict(transactions[0]._headers)
+        headers['Content-Type'] = 'application/json'
+        headers['Content-Encoding'] = 'deflate'
+        if 'Content-MD5' in headers:
+            headers['Content-MD5'] = md5(data).hexdigest()
+        return headers
+
+    @classmethod
+    def _from_data(cls, data, headers, msg_type, endpoint, api_key):
+        """Build a transaction without queueing it nor sending it to emitters"""
+        tr = cls.__new__(cls)
+        tr._data = data
+        tr._headers = headers
+        tr._msg_type = msg_type
+        Transaction.__init__(tr)
+        tr._endpoint = endpoint
+        tr._api_key = api_key
+        return tr
+
+    @classmethod
+    def _merge_items(cls, transactions, prefix, suffix, get_items):
+        """Stream the JSON items of each transaction's payload into a single
+        compressed payload, decoding one transaction at a time. Transactions that
+        can't be decoded are left out, to be flushed on their own"""
+        compressor = zlib.compressobj()
+        chunks = [compressor.compress(prefix)]
+        raw_size = len(prefix) + len(suffix)
+        first = True
+        merged_transactions = []
+        for tr in transactions:
+            try:
+                items = get_items(tr._decode_data())
+            except Exception:
+                log.warning("Unable to decode transaction %s, it won't be merged", tr.get_id())
+                continue
+            merged_transactions.append(tr)
+            if not items:
+                continue
+            if not first:
+                chunks.append(compressor.compress(','))
+                raw_size += 1
+            # Strip the list brackets, the items are joined into the merged list
+            serialized = json.dumps(items)[1:-1]
+            chunks.append(compressor.compress(serialized))
+            raw_size += len(serialized)
+            first = False
+        chunks.append(compressor.compress(suffix))
+        chunks.append(compressor.flush())
+        data = ''.join(chunks)
+
+        if not merged_transactions:
+            return None, []
+        first_tr = merged_transactions[0]
+        merged = cls._from_data(data, cls._merged_headers(merged_transactions, data), first_tr._msg_type,
+                                first_tr._endpoint, first_tr._api_key)
+        merged._raw_size = raw_size
+        return merged, merged_transactions
+
     def get_url(self, endpoint, api_key):
         endpoint_base_url = get_url_endpoint(endpoint)
         if self._application.agent_dns_caching:
@@ -283,7 +460,7 @@ class AgentTransaction(Transaction):
             if response.code in RESPONSES_TO_REJECT:
                 self._trManager.tr_error_reject_request(self, response.code)
             else:
-                self._trManager.tr_error(self)
+                self._trManager.tr_error(self, response.code)
         else:
             self._trManager.tr_success(self)
 
@@ -305,6 +482,16 @@ class APIMetricTransaction(MetricTransaction):
     def get_data(self):
         return self._data
 
+    def get_priority(self):
+        return PRIORITY_METRICS
+
+    def get_coalesce_key(self):
+        return ('series', self._endpoint, self._api_key)
+
+    @classmethod
+    def merge(cls, transactions):
+        return cls._merge_items(transactions, '{"series":[', ']}', lambda payload: payload['series'])
+
 
 class APIServiceCheckTransaction(AgentTransaction):
     _type = "service checks"
@@ -315,6 +502,16 @@ class APIServiceCheckTransaction(AgentTransaction):
             endpoint_base_url = self._application.get_from_dns_cache(endpoint_base_url)
         return "{0}/api/v1/check_run/?api_key={1}".format(endpoint_base_url, api_key)
 
+    def get_priority(self):
+        return PRIORITY_SERVICE_CHECKS
+
+    def get_coalesce_key(self):
+        return ('check_run', self._endpoint, self._api_key)
+
+    @classmethod
+    def merge(cls, transactions):
+        return cls._merge_items(transactions, '[', ']', lambda payload: payload)
+
 
 class StatusHandler(tornado.web.RequestHandler):
 
@@ -335,6 +532,18 @@ class StatusHandler(tornado.web.RequestHandler):
                 self.set_status(503)
 
 
+class StatsHandler(tornado.web.RequestHandler):
+    """Machine-readable forwarder telemetry, doesn't depend on the queue length"""
+
+    def get(self):
+        stats = MetricTransaction.get_tr_manager().get_stats()
+        if AgentTransaction._emitter_manager is not None:
+            stats['custom_emitters'] = AgentTransaction._emitter_manager.get_stats()
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(stats))
+
+
 class AgentInputHandler(tornado.web.RequestHandler):
     _MSG_TYPE = ""
 
@@ -407,6 +616,7 @@ class Application(tornado.web.Application):
         self._port = int(port)
         self._agentConfig = agentConfig
         self._metrics = {}
+        self._graphite_series = None
         self._dns_cache = None
         AgentTransaction.set_application(self)
         AgentTransaction.set_endpoints(agentConfig['endpoints'])
@@ -419,9 +629,30 @@ class Application(tornado.web.Application):
         if len(agentConfig['endpoints']) > 1:
             max_parallelism = self.DEFAULT_PARALLELISM
 
+        throttler = None
+        if _is_affirmative(agentConfig.get('forwarder_adaptive_throttling', False)):
+            throttler = AdaptiveThrottler(
+                THROTTLING_DELAY,
+                min_parallelism=max_parallelism,
+                max_rate=float(agentConfig.get('forwarder_max_flush_rate', ADAPTIVE_MAX_RATE)),
+                max_parallelism=int(agentConfig.get('forwarder_max_parallelism', ADAPTIVE_MAX_PARALLELISM)))
+            log.info("Adaptive throttling enabled")
+
+        max_coalesced_size = None
+        if _is_affirmative(agentConfig.get('forwarder_coalesce_transactions', False)):
+            max_coalesced_size = int(agentConfig.get('forwarder_coalesce_max_size', MAX_COALESCED_SIZE))
+
+        max_flush_duration = None
+        if agentConfig.get('forwarder_max_flush_duration'):
+            max_flush_duration = timedelta(seconds=float(agentConfig['forwarder_max_flush_duration']))
+
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
                                               MAX_QUEUE_SIZE, THROTTLING_DELAY,
-                                              max_parallelism=max_parallelism)
+                                              max_parallelism=max_parallelism,
+                                              throttler=throttler,
+                                              max_coalesced_size=max_coalesced_size,
+                                              queue_shares=get_queue_shares(agentConfig),
+                                              max_flush_duration=max_flush_duration)
         AgentTransaction.set_tr_manager(self._tr_manager)
 
         self._watchdog = None
@@ -493,6 +724,16 @@ class Application(tornado.web.Application):
                               headers={'Content-Type': 'application/json'})
             self._metrics = {}
 
+    def _postGraphiteSeries(self):
+
+        if self._graphite_series:
+            point_count = self._graphite_series.point_count
+            series = self._graphite_series.flush()
+            log.debug("Posting %s graphite series (%s datapoints)", len(series), point_count)
+            APIMetricTransaction(zlib.compress(json.dumps({'series': series})),
+                                 headers={'Content-Type': 'application/json',
+                                          'Content-Encoding': 'deflate'})
+
     def run(self):
         handlers = [
             (r"/intake/?", AgentInputHandler),
@@ -501,6 +742,7 @@ class Application(tornado.web.Application):
             (r"/api/v1/series/?", ApiInputHandler),
             (r"/api/v1/check_run/?", ApiCheckRunHandler),
             (r"/status/?", StatusHandler),
+            (r"/stats/?", StatsHandler),
         ]
 
         settings = dict(
@@ -550,6 +792,7 @@ class Application(tornado.web.Application):
             if self._watchdog:
                 self._watchdog.reset()
             self._postMetrics()
+            self._postGraphiteSeries()
             self._tr_manager.flush()
 
         tr_sched = tornado.ioloop.PeriodicCallback(flush_trs, TRANSACTION_FLUSH_INTERVAL,
@@ -558,9 +801,16 @@ class Application(tornado.web.Application):
         # Register optional Graphite listener
         gport = self._agentConfig.get("graphite_listen_port", None)
         if gport is not None:
-            log.info("Starting graphite listener on port %s" % gport)
-            from graphite import GraphiteServer
-            gs = GraphiteServer(self, get_hostname(self._agentConfig), io_loop=self.mloop)
+            from graphite import GraphiteServer, PICKLE_PROTOCOL, PROTOCOLS, SeriesBuffer
+            protocol = self._agentConfig.get("graphite_protocol", PICKLE_PROTOCOL)
+            if protocol not in PROTOCOLS:
+                log.warning("Unknown graphite protocol %r, using %s", protocol, PICKLE_PROTOCOL)
+                protocol = PICKLE_PROTOCOL
+            if _is_affirmative(self._agentConfig.get("graphite_emit_series", False)):
+                self._graphite_series = SeriesBuffer()
+            log.info("Starting graphite listener on port %s (%s protocol)" % (gport, protocol))
+            gs = GraphiteServer(self, get_hostname(self._agentConfig), io_loop=self.mloop,
+                                protocol=protocol, series_buffer=self._graphite_series)
             if non_local_traffic is True:
                 gs.listen(gport)
             else:
@@ -28,7 +28,6 @@ import sys
 import threading
 from time import sleep, time
 from urllib import urlencode
-import zlib
 
 # For pickle & PID files, see issue 293
 os.umask(022)
@@ -54,8 +53,9 @@ from daemon import (
     ProcessRunner
 )
 from util import chunks, get_uuid, plural
+from utils.compression import get_compressor
 from utils.hostname import get_hostname
-from utils.http import get_expvar_stats
+from utils.http import PAYLOAD_TYPE_HEADER, get_expvar_stats
 from utils.net import inet_pton
 from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
 from utils.pidfile import PidFile
@@ -122,7 +122,7 @@ def unicode_metrics(metrics):
     return metrics
 
 
-def serialize_metrics(metrics, hostname):
+def serialize_metrics(metrics, hostname, compressor=None):
     try:
         metrics.append(add_serialization_status_metric("success", hostname))
         serialized = json.dumps({"series": metrics})
@@ -137,9 +137,10 @@ def serialize_metrics(metrics, hostname):
             serialized = json.dumps({"series": [add_serialization_status_metric("permanent_failure", hostname)]})
 
     if len(serialized) > COMPRESS_THRESHOLD:
+        compressor = compressor or get_compressor()
         headers = {'Content-Type': 'application/json',
-                   'Content-Encoding': 'deflate'}
-        serialized = zlib.compress(serialized)
+                   'Content-Encoding': compressor.content_encoding}
+        serialized = compressor.compress(serialized)
     else:
         headers = {'Content-Type': 'application/json'}
     return serialized, headers
@@ -205,7 +206,7 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None, hostname=None):
+                 use_watchdog=False, event_chunk_size=None, hostname=None, compressor=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
@@ -221,6 +222,7 @@ class Reporter(threading.Thread):
         self.api_key = api_key
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
+        self.compressor = compressor or get_compressor()
 
     def stop(self):
         log.info("Stopping reporter")
@@ -274,6 +276,10 @@ class Reporter(threading.Thread):
             if not should_log:
                 log_func = log.debug
             log_func("Flush #%s: flushed %s metric%s, %s event%s, and %s service check run%s" % (self.flush_count, count, plural(count), event_count, plural(event_count), service_check_count, plural(service_check_count)))
+            compression = self.compressor.flush()
+            if compression['payloads']:
+                log_func("Compressed %s payload%s: compression_ratio=%.3f, compression_time=%.3fs" % (
+                    compression['payloads'], plural(compression['payloads']), compression['ratio'], compression['time']))
             if self.flush_count == FLUSH_LOGGING_INITIAL:
                 log.info("First flushes done, %s flushes will be logged every %s flushes." % (FLUSH_LOGGING_COUNT, FLUSH_LOGGING_PERIOD))
 
@@ -295,7 +301,7 @@ class Reporter(threading.Thread):
                 log.exception("Error flushing metrics")
 
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics, self.hostname)
+        body, headers = serialize_metrics(metrics, self.hostname, self.compressor)
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
@@ -303,7 +309,7 @@ class Reporter(threading.Thread):
         self.submit_http(url, body, headers)
 
     def submit_events(self, events):
-        headers = {'Content-Type':'application/json'}
+        headers = {'Content-Type':'application/json', PAYLOAD_TYPE_HEADER: 'events'}
         event_chunk_size = self.event_chunk_size
 
         for chunk in chunks(events, event_chunk_size):
@@ -617,7 +623,8 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     )
 
     # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size, hostname)
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size, hostname,
+                        get_compressor(agent_config))
 
     # NOTICE: when `non_local_traffic` is passed we need to bind to any interface on the box. The forwarder uses
     # Tornado which takes care of sockets creation (more than one socket can be used at once depending on the
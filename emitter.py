@@ -4,11 +4,12 @@
 
 # stdlib
 from hashlib import md5
+from itertools import islice
 import logging
-import re
 import string
+import threading
+import time
 import zlib
-import unicodedata
 
 # 3p
 import requests
@@ -16,7 +17,14 @@ import simplejson as json
 
 # project
 from config import get_version
-
+from utils.strings import (  # noqa, imported here for backward compatibility
+    control_char_re,
+    remove_control_chars,
+    remove_undecodable_chars,
+    sanitize_string,
+)
+
+from utils.compression import get_compressor
 from utils.proxy import set_no_proxy_settings
 set_no_proxy_settings()
 
@@ -25,37 +33,27 @@ requests_log = logging.getLogger("requests.packages.urllib3")
 requests_log.setLevel(logging.WARN)
 requests_log.propagate = True
 
-# From http://stackoverflow.com/questions/92438/stripping-non-printable-characters-from-a-string-in-python
-control_chars = ''.join(map(unichr, range(0, 32) + range(127, 160)))
-control_char_re = re.compile('[%s]' % re.escape(control_chars))
+# Kept across runs so that connections to the intake are reused. The legacy, metrics and
+# check runs payloads are posted concurrently, the pool holds a connection for each of them.
+POST_TIMEOUT = 5  # seconds
+http_session = requests.Session()
+http_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=3))
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=3))
 
 
 # Only enforced for the metrics API on our end, for now
 MAX_COMPRESSED_SIZE = 2 << 20  # 2MB, the backend should accept up to 3MB but let's be conservative here
-# maximum depth of recursive calls to payload splitting function, a bit arbitrary (we don't want too much
-# depth in the recursive calls, but we want to give up only when some metrics are clearly too large)
-MAX_SPLIT_DEPTH = 2
-
-
-def remove_control_chars(s, log):
-    if isinstance(s, str):
-        sanitized = control_char_re.sub('', s)
-    elif isinstance(s, unicode):
-        sanitized = ''.join(['' if unicodedata.category(c) in ['Cc','Cf'] else c
-                            for c in u'{}'.format(s)])
-    if sanitized != s:
-        log.warning('Removed control chars from string: ' + s)
-    return sanitized
-
-def remove_undecodable_chars(s, log):
-    sanitized = s
-    if isinstance(s, str):
-        try:
-            s.decode('utf8')
-        except UnicodeDecodeError:
-            sanitized = s.decode('utf8', errors='ignore')
-            log.warning(u'Removed undecodable chars from string: ' + s.decode('utf8', errors='replace'))
-    return sanitized
+# Metrics payloads are built series by series, the tail covers the end of the JSON document
+# and the end of the compression stream
+METRICS_PAYLOAD_HEAD = '{"series": ['
+METRICS_PAYLOAD_TAIL = ']}'
+PAYLOAD_TAIL_SIZE = 64
+SERIES_BATCH_SIZE = 500
+
+# Endpoint of the payloads that only hold check metrics, streamed by the collector
+# ahead of the rest of the payload to the emitters that set `accepts_series`
+SERIES_ENDPOINT = 'series'
+
 
 def sanitize_payload(item, log, sanitize_func):
     if isinstance(item, dict):
@@ -85,7 +83,8 @@ def post_payload(url, message, serialize_func, agentConfig, log):
     log.debug('http_emitter: attempting postback to ' + string.split(url, "api_key=")[0])
 
     try:
-        payloads = serialize_func(message, MAX_COMPRESSED_SIZE, 0, log)
+        compressor = get_compressor(agentConfig)
+        payloads = serialize_func(message, MAX_COMPRESSED_SIZE, log, compressor)
     except UnicodeDecodeError:
         log.exception('http_emitter: Unable to convert message to json')
         # early return as we can't actually process the message
@@ -100,8 +99,8 @@ def post_payload(url, message, serialize_func, agentConfig, log):
 
     for payload in payloads:
         try:
-            headers = get_post_headers(agentConfig, payload)
-            r = requests.post(url, data=payload, timeout=5, headers=headers)
+            headers = get_post_headers(agentConfig, payload, compressor.content_encoding)
+            r = http_session.post(url, data=payload, timeout=POST_TIMEOUT, headers=headers)
 
             r.raise_for_status()
 
@@ -112,28 +111,58 @@ def post_payload(url, message, serialize_func, agentConfig, log):
             log.error("Unable to post payload: %s" % e.message)
 
 
+def repair_payload(item, log):
+    """
+    Return `item` with the strings that can't be serialized sanitized. Containers
+    that don't hold any of them are returned as is, the others are copied.
+    """
+    if isinstance(item, str):
+        return sanitize_string(item, log)
+    if isinstance(item, dict):
+        repaired = None
+        for k, v in item.iteritems():
+            newkey, newval = repair_payload(k, log), repair_payload(v, log)
+            if newkey is not k or newval is not v:
+                if repaired is None:
+                    repaired = dict(item)
+                del repaired[k]
+                repaired[newkey] = newval
+        return item if repaired is None else repaired
+    if isinstance(item, (list, tuple)):
+        repaired = None
+        for i, listitem in enumerate(item):
+            newitem = repair_payload(listitem, log)
+            if newitem is not listitem:
+                if repaired is None:
+                    repaired = list(item)
+                repaired[i] = newitem
+        if repaired is None:
+            return item
+        return tuple(repaired) if isinstance(item, tuple) else repaired
+
+    return item
+
+
 def serialize_payload(message, log):
-    payload = ""
+    # Names and tags submitted by checks are sanitized when they're first seen, so
+    # this only fails on other fields. Only the byte strings that aren't valid UTF-8
+    # are repaired then, and stripped of their control characters too. Valid strings
+    # are left alone: JSON escapes their control characters, and they used to be
+    # stripped only when another string of the payload happened to be undecodable.
     try:
-        payload = json.dumps(message)
+        return json.dumps(message)
     except UnicodeDecodeError:
-        newmessage = sanitize_payload(message, log, remove_control_chars)
-        try:
-            payload = json.dumps(newmessage)
-        except UnicodeDecodeError:
-            log.info('Removing undecodable characters from payload')
-            newmessage = sanitize_payload(newmessage, log, remove_undecodable_chars)
-            payload = json.dumps(newmessage)
+        log.info('Removing undecodable characters from payload')
+        return json.dumps(repair_payload(message, log))
 
-    return payload
 
-
-def serialize_and_compress_legacy_payload(legacy_payload, max_compressed_size, depth, log):
+def serialize_and_compress_legacy_payload(legacy_payload, max_compressed_size, log, compressor=None):
     """
     Serialize and compress the legacy payload
     """
+    compressor = compressor or get_compressor()
     serialized_payload = serialize_payload(legacy_payload, log)
-    zipped = zlib.compress(serialized_payload)
+    zipped = compressor.compress(serialized_payload)
     log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f"
               % (len(serialized_payload), len(zipped), float(len(serialized_payload))/float(len(zipped))))
 
@@ -147,57 +176,114 @@ def serialize_and_compress_legacy_payload(legacy_payload, max_compressed_size, d
     return compressed_payloads
 
 
-def serialize_and_compress_metrics_payload(metrics_payload, max_compressed_size, depth, log):
+class MetricsPayloadEncoder(object):
+    """
+    Compression stream of a metrics payload, built one serialized series at a time
+    The compressed size of the pending input isn't known until the stream is flushed,
+    so it's bounded by its uncompressed size and the stream is only flushed when
+    that bound gets close to the limit
     """
-    Serialize and compress the metrics payload
-    If the compressed payload is too big, we attempt to split it into smaller payloads and call this
-    function recursively on each smaller payload
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.stream = compressor.compressobj()
+        self.chunks = []
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.pending_size = 0
+        self.n_series = 0
+        self.compression_time = 0.0
+        self._write(METRICS_PAYLOAD_HEAD)
+
+    def _append(self, compress, *args):
+        start = time.time()
+        chunk = compress(*args)
+        self.compression_time += time.time() - start
+        self.chunks.append(chunk)
+        self.compressed_size += len(chunk)
+
+    def _write(self, data):
+        # Output can come out before all the input is compressed, so the pending
+        # size only goes back to zero on flushes
+        self._append(self.stream.compress, data)
+        self.raw_size += len(data)
+        self.pending_size += len(data)
+
+    def fits(self, serialized_series, max_compressed_size):
+        size = len(serialized_series) + PAYLOAD_TAIL_SIZE
+        if self.compressed_size + self.pending_size + size <= max_compressed_size:
+            return True
+
+        self._append(self.stream.flush, zlib.Z_SYNC_FLUSH)
+        self.pending_size = 0
+        return self.compressed_size + size <= max_compressed_size
+
+    def add(self, serialized_series, n_series=1):
+        if self.n_series:
+            self._write(", ")
+        self._write(serialized_series)
+        self.n_series += n_series
+
+    def close(self):
+        self._write(METRICS_PAYLOAD_TAIL)
+        self._append(self.stream.flush)
+        self.compressor.record(self.raw_size, self.compressed_size, self.compression_time)
+        return "".join(self.chunks)
+
+
+def serialize_and_compress_metrics_payload(metrics_payload, max_compressed_size, log, compressor=None):
     """
+    Serialize and compress the metrics payload in a single pass
+    Series are fed to a compression stream one by one, and a new payload is started
+    before the compressed size of the current one would go over the limit
+    """
+    compressor = compressor or get_compressor()
     compressed_payloads = []
+    encoder = MetricsPayloadEncoder(compressor)
+    # Series can be a generator, only a batch of them is materialized at a time
+    series = iter(metrics_payload["series"])
+
+    while True:
+        # Serializing series in batches is much cheaper than one by one, batches
+        # are only broken up when they don't fit in the current payload
+        batch = list(islice(series, SERIES_BATCH_SIZE))
+        if not batch:
+            break
+        serialized_batch = serialize_payload(batch, log)[1:-1]
+        if encoder.fits(serialized_batch, max_compressed_size):
+            encoder.add(serialized_batch, len(batch))
+            continue
+
+        for s in batch:
+            serialized_series = serialize_payload(s, log)
+            if encoder.n_series and not encoder.fits(serialized_series, max_compressed_size):
+                _close_metrics_payload(encoder, compressed_payloads, max_compressed_size, log)
+                encoder = MetricsPayloadEncoder(compressor)
+            encoder.add(serialized_series)
+
+    _close_metrics_payload(encoder, compressed_payloads, max_compressed_size, log)
 
-    serialized_payload = serialize_payload(metrics_payload, log)
-    zipped = zlib.compress(serialized_payload)
-    compression_ratio = float(len(serialized_payload))/float(len(zipped))
-    log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f"
-              % (len(serialized_payload), len(zipped), compression_ratio))
+    return compressed_payloads
 
-    if len(zipped) < max_compressed_size:
-        compressed_payloads.append(zipped)
-    else:
-        series = metrics_payload["series"]
-
-        if depth > MAX_SPLIT_DEPTH:
-            log.error("Maximum depth of payload splitting reached, dropping the %d metrics in this chunk", len(series))
-            return compressed_payloads
-
-        # Try to account for the compression when estimating the number of chunks needed to get small-enough chunks
-        n_chunks = len(zipped)/max_compressed_size + 1 + int(compression_ratio/2)
-        log.debug("payload is too big (%d bytes), splitting it in %d chunks", len(zipped), n_chunks)
-
-        series_per_chunk = len(series)/n_chunks + 1
-
-        for i in range(n_chunks):
-            # Create each chunk and make them go through this function recursively ; increment the `depth` of the recursive call
-            compressed_payloads.extend(
-                serialize_and_compress_metrics_payload(
-                    {
-                        "series": series[i*series_per_chunk:(i+1)*series_per_chunk]
-                    },
-                    max_compressed_size,
-                    depth+1,
-                    log
-                )
-            )
 
-    return compressed_payloads
+def _close_metrics_payload(encoder, compressed_payloads, max_compressed_size, log):
+    zipped = encoder.close()
+    log.debug("series=%d, compressed_size=%d" % (encoder.n_series, len(zipped)))
+
+    if len(zipped) > max_compressed_size:
+        # Only happens when a single series doesn't fit in a payload
+        log.error("Compressed size of %d series is above the limit of %dKB, dropping them",
+                  encoder.n_series, max_compressed_size/(1 << 10))
+    else:
+        compressed_payloads.append(zipped)
 
 
-def serialize_and_compress_checkruns_payload(checkruns_payload, max_compressed_size, depth, log):
+def serialize_and_compress_checkruns_payload(checkruns_payload, max_compressed_size, log, compressor=None):
     """
     Serialize and compress the checkruns payload
     """
+    compressor = compressor or get_compressor()
     serialized_payload = serialize_payload(checkruns_payload, log)
-    zipped = zlib.compress(serialized_payload)
+    zipped = compressor.compress(serialized_payload)
     log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f"
               % (len(serialized_payload), len(zipped), float(len(serialized_payload))/float(len(zipped))))
 
@@ -210,11 +296,13 @@ def serialize_and_compress_checkruns_payload(checkruns_payload, max_compressed_s
     return compressed_payloads
 
 
-def split_payload(legacy_payload):
-    metrics_payload = {"series": []}
-
+def iter_series(legacy_metrics, internal_hostname):
+    """
+    Convert the metrics of the legacy payload to series one at a time, as they're
+    serialized, so that the list of series never sits in memory next to the payload
+    """
     # See https://github.com/DataDog/dd-agent/blob/5.11.1/checks/__init__.py#L905-L926 for format
-    for ts in legacy_payload['metrics']:
+    for ts in legacy_metrics:
         sample = {
             "metric": ts[0],
             "points": [(ts[1], ts[2])],
@@ -227,7 +315,7 @@ def split_payload(legacy_payload):
                 sample['host'] = ts[3]['hostname']
             else:
                 # If not use the general payload one
-                sample['host'] = legacy_payload['internalHostname']
+                sample['host'] = internal_hostname
 
             if ts[3].get('type'):
                 sample['type'] = ts[3]['type']
@@ -236,7 +324,13 @@ def split_payload(legacy_payload):
             if ts[3].get('device_name'):
                 sample['device'] = ts[3]['device_name']
 
-        metrics_payload["series"].append(sample)
+        yield sample
+
+
+def split_payload(legacy_payload):
+    metrics_payload = {
+        "series": iter_series(legacy_payload['metrics'], legacy_payload.get('internalHostname')),
+    }
 
     del legacy_payload['metrics']
 
@@ -260,23 +354,50 @@ def http_emitter(message, log, agentConfig, endpoint):
     metrics_endpoint = "{0}/api/v1/series?api_key={1}".format(agentConfig['dd_url'], api_key)
     checkruns_endpoint = "{0}/api/v1/check_run?api_key={1}".format(agentConfig['dd_url'], api_key)
 
+    if endpoint == SERIES_ENDPOINT:
+        start = time.time()
+        metrics_payload = {"series": iter_series(message['metrics'], message.get('internalHostname'))}
+        post_payload(metrics_endpoint, metrics_payload, serialize_and_compress_metrics_payload, agentConfig, log)
+        return {'series': time.time() - start}
+
     legacy_payload, metrics_payload, checkruns_payload = split_payload(message)
 
-    # Post legacy payload
-    post_payload(legacy_url, legacy_payload, serialize_and_compress_legacy_payload, agentConfig, log)
+    # The payloads are independent, post them concurrently and return how long each one took
+    posts = [
+        ('intake', legacy_url, legacy_payload, serialize_and_compress_legacy_payload),
+        ('series', metrics_endpoint, metrics_payload, serialize_and_compress_metrics_payload),
+        ('check_run', checkruns_endpoint, checkruns_payload, serialize_and_compress_checkruns_payload),
+    ]
+    timings = {}
+
+    def _post(name, url, payload, serialize_func):
+        start = time.time()
+        try:
+            post_payload(url, payload, serialize_func, agentConfig, log)
+        finally:
+            timings[name] = time.time() - start
+
+    threads = []
+    for post in posts[1:]:
+        thread = threading.Thread(target=_post, args=post, name="http_emitter-%s" % post[0])
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    _post(*posts[0])
+    for thread in threads:
+        thread.join()
+
+    return timings
 
-    # Post metrics payload
-    post_payload(metrics_endpoint, metrics_payload, serialize_and_compress_metrics_payload, agentConfig, log)
 
-    # Post check runs payload
-    post_payload(checkruns_endpoint, checkruns_payload, serialize_and_compress_checkruns_payload, agentConfig, log)
+http_emitter.accepts_series = True
 
 
-def get_post_headers(agentConfig, payload):
+def get_post_headers(agentConfig, payload, content_encoding='deflate'):
     return {
         'User-Agent': 'Datadog Agent/%s' % agentConfig['version'],
         'Content-Type': 'application/json',
-        'Content-Encoding': 'deflate',
+        'Content-Encoding': content_encoding,
         'Accept': 'text/html, */*',
         'Content-MD5': md5(payload).hexdigest(),
         'DD-Collector-Version': get_version()
@@ -16,35 +16,104 @@ from utils.hostname import get_hostname
 
 log = logging.getLogger(__name__)
 
+PICKLE_PROTOCOL = 'pickle'
+PLAINTEXT_PROTOCOL = 'plaintext'
+PROTOCOLS = [PICKLE_PROTOCOL, PLAINTEXT_PROTOCOL]
+
+NO_DEVICE = "N/A"
+
+# Datapoints of a series received within the same interval are pre-aggregated,
+# only the last value is kept (graphite datapoints are gauges)
+AGGREGATION_INTERVAL = 10  # seconds
+
+# Largest pickle frame or plaintext line accepted from a client, anything
+# bigger is dropped instead of being buffered
+MAX_FRAME_SIZE = 1 << 20  # 1MB
+
+
+class SeriesBuffer(object):
+    """Pre-aggregates graphite datapoints into series payloads"""
+
+    def __init__(self, interval=AGGREGATION_INTERVAL):
+        self.interval = interval
+        self._series = {}
+        self.point_count = 0
+
+    def add(self, name, host, device, ts, value):
+        key = (name, host, device)
+        points = self._series.get(key)
+        if points is None:
+            points = self._series[key] = {}
+        points[int(ts) - int(ts) % self.interval] = value
+        self.point_count += 1
+
+    def __len__(self):
+        return len(self._series)
+
+    def flush(self):
+        """Return the buffered series in the `/api/v1/series` format and reset the buffer"""
+        series = []
+        for (name, host, device), points in self._series.iteritems():
+            serie = {
+                'metric': name,
+                'points': sorted(points.iteritems()),
+                'host': host,
+                'type': 'gauge',
+                'source_type_name': 'Graphite',
+            }
+            if device and device != NO_DEVICE:
+                serie['device'] = device
+            series.append(serie)
+        self._series = {}
+        self.point_count = 0
+        return series
+
 
 class GraphiteServer(TCPServer):
 
-    def __init__(self, app, hostname, io_loop=None, ssl_options=None, **kwargs):
+    def __init__(self, app, hostname, io_loop=None, ssl_options=None, protocol=PICKLE_PROTOCOL,
+                 series_buffer=None, **kwargs):
         log.warn('Graphite listener is started -- if you do not need graphite, turn it off in datadog.conf.')
-        log.warn('Graphite relay uses pickle to transport messages. Pickle is not secured against remote execution exploits.')
-        log.warn('See http://blog.nelhage.com/2011/03/exploiting-pickle/ for more details')
+        if protocol == PICKLE_PROTOCOL:
+            log.warn('Graphite relay uses pickle to transport messages. Pickle is not secured against remote execution exploits.')
+            log.warn('See http://blog.nelhage.com/2011/03/exploiting-pickle/ for more details')
         self.app = app
         self.hostname = hostname
+        self.protocol = protocol
+        self.series_buffer = series_buffer
         TCPServer.__init__(self, io_loop=io_loop, ssl_options=ssl_options, **kwargs)
 
     def handle_stream(self, stream, address):
-        GraphiteConnection(stream, address, self.app, self.hostname)
+        if self.protocol == PLAINTEXT_PROTOCOL:
+            PlaintextGraphiteConnection(stream, address, self.app, self.hostname, self.series_buffer)
+        else:
+            GraphiteConnection(stream, address, self.app, self.hostname, self.series_buffer)
 
 
 class GraphiteConnection(object):
 
-    def __init__(self, stream, address, app, hostname):
+    def __init__(self, stream, address, app, hostname, series_buffer=None):
         log.debug('received a new connection from %s', address)
         self.app = app
         self.stream = stream
         self.address = address
         self.hostname = hostname
+        self.series_buffer = series_buffer
         self.stream.set_close_callback(self._on_close)
+        self._start_reading()
+
+    def _start_reading(self):
         self.stream.read_bytes(4, self._on_read_header)
 
     def _on_read_header(self, data):
         try:
             size = struct.unpack("!L", data)[0]
+            if size > MAX_FRAME_SIZE:
+                # The stream can't be resynchronized without reading the frame
+                log.error("Graphite frame of %s bytes from %s is over the %s bytes limit, closing the connection",
+                          size, self.address, MAX_FRAME_SIZE)
+                self.stream.close()
+                return
             log.debug("Receiving a string of size:" + str(size))
             self.stream.read_bytes(size, self._on_read_line)
         except Exception as e:
@@ -82,18 +151,23 @@ class GraphiteConnection(object):
 
         ts = datapoint[0]
         value = datapoint[1]
-        if self.app is not None:
+        if self.series_buffer is not None:
+            self.series_buffer.add(name, host, device, ts, value)
+        elif self.app is not None:
             self.app.appendMetric("graphite", name, host, device, ts, value)
 
-    def _processMetric(self, metric, datapoint):
-        """Parse the metric name to fetch (host, metric, device) and
-            send the datapoint to datadog"""
-
-        log.debug("New metric: %s, values: %s" % (metric, datapoint))
-        (metric, host, device) = self._parseMetric(metric)
-        if metric is not None:
-            self._postMetric(metric, host, device, datapoint)
-            log.info("Posted metric: %s, host: %s, device: %s" % (metric, host, device))
+    def _processMetrics(self, datapoints):
+        """Parse the metric names to fetch (host, metric, device) and
+            send the datapoints to datadog"""
+        parse = self._parseMetric
+        post = self._postMetric
+        count = 0
+        for metric, datapoint in datapoints:
+            metric, host, device = parse(metric)
+            if metric is not None:
+                post(metric, host, device, datapoint)
+                count += 1
+        log.debug("Posted %s graphite datapoint(s) from %s", count, self.address)
 
     def _decode(self, data):
 
@@ -103,6 +177,7 @@ class GraphiteConnection(object):
             log.exception("Cannot decode grapite points")
             return
 
+        valid_datapoints = []
         for (metric, datapoint) in datapoints:
             try:
                 datapoint = (float(datapoint[0]), float(datapoint[1]))
@@ -110,10 +185,60 @@ class GraphiteConnection(object):
                 log.error(e)
                 continue
 
-            self._processMetric(metric, datapoint)
+            valid_datapoints.append((metric, datapoint))
+
+        self._processMetrics(valid_datapoints)
 
         self.stream.read_bytes(4, self._on_read_header)
 
+
+class PlaintextGraphiteConnection(GraphiteConnection):
+    """Graphite's line protocol: `metric.path value timestamp` per line.
+
+    Datapoints are processed in batches, one per chunk read from the socket."""
+
+    def _start_reading(self):
+        self._partial_line = ''
+        # Whether the rest of an oversized line is being skipped
+        self._skipping_line = False
+        self.stream.read_until_close(self._on_read_chunk, streaming_callback=self._on_read_chunk)
+
+    def _on_read_chunk(self, data):
+        if not data:
+            return
+        lines = (self._partial_line + data).split('\n')
+        if self._skipping_line and len(lines) > 1:
+            self._skipping_line = False
+            lines.pop(0)
+        # The last line is incomplete, keep it for the next chunk
+        self._partial_line = lines.pop()
+        if self._skipping_line:
+            self._partial_line = ''
+        elif len(self._partial_line) > MAX_FRAME_SIZE:
+            log.error("Graphite line from %s is over the %s bytes limit, dropping it", self.address, MAX_FRAME_SIZE)
+            self._partial_line = ''
+            self._skipping_line = True
+        self._processMetrics(self._parse_lines(lines))
+
+    def _on_close(self):
+        if self._partial_line:
+            self._processMetrics(self._parse_lines([self._partial_line]))
+            self._partial_line = ''
+        GraphiteConnection._on_close(self)
+
+    def _parse_lines(self, lines):
+        datapoints = []
+        for line in lines:
+            parts = line.split()
+            if not parts:
+                continue
+            try:
+                metric, value, ts = parts
+                datapoints.append((metric, (float(ts), float(value))))
+            except ValueError:
+                log.debug("Invalid graphite line from %s: %r", self.address, line)
+        return datapoints
+
 def start_graphite_listener(port):
     echo_server = GraphiteServer(None, get_hostname(None))
     echo_server.listen(port)
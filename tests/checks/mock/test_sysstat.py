@@ -1,14 +1,19 @@
 # stdlib
 import logging
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 import mock
 
 # project
 from checks.system.unix import (
+    Cpu,
     IO,
     Load,
     Memory,
+    Processes,
 )
 from checks.system.unix import System
 from config import get_system_stats
@@ -284,3 +289,100 @@ ad0        0.0   2.0     0.0    31.8    0   0.2   102
         expected = 0
         for res in results:
             self.assertEqual(results[res]['%util'], expected)
+
+
+class TestProcSystemChecks(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.proc)
+
+    def write_proc(self, name, content):
+        with open(os.path.join(self.proc, name), 'w') as f:
+            f.write(content)
+
+    @mock.patch('checks.system.unix.Platform.is_linux', return_value=True)
+    def testLinuxProcDiskstats(self, mock_is_linux):
+        checker = IO(logger)
+        config = {'procfs_path': self.proc}
+
+        self.write_proc('uptime', '100.00 350.00\n')
+        self.write_proc('diskstats',
+                        '   8       0 sda 1000 10 8000 500 2000 20 16000 1500 0 1000 2000\n'
+                        '   8       1 sda1 0 0 0 0 0 0 0 0 0 0 0\n')
+        # The first sample covers the time since boot
+        results = checker.check(config)
+        self.assertEqual(results.keys(), ['sda'])
+        self.assertEqual(results['sda']['r/s'], '10.00')
+        self.assertEqual(results['sda']['%util'], 1.0)
+
+        self.write_proc('uptime', '110.00 390.00\n')
+        self.write_proc('diskstats',
+                        '   8       0 sda 1100 10 8800 600 2100 20 17600 1800 0 1500 2500\n')
+        results = checker.check(config)
+        self.assertEqual(results['sda'], {
+            'rrqm/s': '0.00', 'wrqm/s': '0.00', 'r/s': '10.00', 'w/s': '10.00',
+            'rkB/s': '40.00', 'wkB/s': '80.00', 'avgrq-sz': '12.00', 'avgqu-sz': '0.05',
+            'await': '2.00', 'r_await': '1.00', 'w_await': '3.00', 'svctm': '2.50',
+            '%util': 5.0,
+        })
+
+    @mock.patch('checks.system.unix.Platform.is_linux', return_value=True)
+    def testLinuxProcCpu(self, mock_is_linux):
+        checker = Cpu(logger)
+        config = {'procfs_path': self.proc}
+
+        self.write_proc('stat', 'cpu  100 0 100 700 50 0 50 0 0 0\ncpu0 100 0 100 700 50 0 50 0 0 0\n')
+        results = checker.check(config)
+        self.assertEqual(results['cpuIdle'], 70.0)
+
+        # 10 of the 40 user jiffies were spent running a guest
+        self.write_proc('stat', 'cpu  140 0 130 800 60 5 55 10 10 0\n')
+        results = checker.check(config)
+        self.assertEqual(results, {
+            'cpuUser': 15.0, 'cpuSystem': 20.0, 'cpuWait': 5.0, 'cpuIdle': 50.0,
+            'cpuStolen': 5.0, 'cpuGuest': 5.0,
+        })
+
+    def write_pid(self, pid, stat, cmdline):
+        os.mkdir(os.path.join(self.proc, pid))
+        self.write_proc(os.path.join(pid, 'stat'), stat)
+        self.write_proc(os.path.join(pid, 'cmdline'), cmdline)
+
+    @mock.patch('checks.system.unix.Platform.is_linux', return_value=True)
+    @mock.patch('checks.system.unix.get_hostname', return_value='myhost')
+    @mock.patch('checks.system.unix.os.sysconf', side_effect=lambda name: {'SC_CLK_TCK': 100, 'SC_PAGE_SIZE': 4096}[name])
+    def testLinuxProcProcesses(self, *mocks):
+        checker = Processes(logger)
+        config = {'procfs_path': self.proc, 'api_key': 'apikey'}
+
+        self.write_proc('uptime', '1000.00 3500.00\n')
+        self.write_proc('meminfo', 'MemTotal:        1000000 kB\nMemFree:          500000 kB\n')
+        self.write_pid('1', '1 (init) S 0 1 1 0 -1 4194560 0 0 0 0 1000 500 0 0 20 0 1 0 1 '
+                       '204800 2500 18446744073709551615\n',
+                       '/sbin/init\0splash\0')
+        self.write_pid('42', '42 (my (weird) proc) R 1 42 7 34817 42 0 0 0 0 0 1 0 0 0 20 5 4 0 50000 '
+                       '0 0 18446744073709551615\n',
+                       '')
+
+        processes = sorted(checker.check(config)['processes'], key=lambda p: int(p[1]))
+        self.assertEqual(processes[0][1:], ['1', '1.5', '1.0', '200', '10000', '?', 'Ss', processes[0][8], '0:15',
+                                            '/sbin/init splash'])
+        self.assertEqual(processes[1][1:8], ['42', '0.0', '0.0', '0', '0', 'pts/1', 'RNl+'])
+        self.assertEqual(processes[1][10], '[my (weird) proc]')
+
+        # Command lines are read at every pass: exec and setproctitle keep the pid and start time
+        self.write_proc(os.path.join('1', 'cmdline'), 'init: rewritten title\0')
+        self.write_proc(os.path.join('42', 'stat'), '42 (new) S 1 42 42 0 -1 0 0 0 0 0 0 0 0 0 20 0 1 0 90000 '
+                        '0 0 18446744073709551615\n')
+        self.write_proc(os.path.join('42', 'cmdline'), 'new\0--arg\0')
+        processes = sorted(checker.check(config)['processes'], key=lambda p: int(p[1]))
+        self.assertEqual(processes[0][10], 'init: rewritten title')
+        self.assertEqual(processes[1][7], 'Ss')
+        self.assertEqual(processes[1][10], 'new --arg')
+
+        config['exclude_process_args'] = True
+        processes = sorted(checker.check(config)['processes'], key=lambda p: int(p[1]))
+        self.assertEqual([p[10] for p in processes], ['init: rewritten title', 'new'])
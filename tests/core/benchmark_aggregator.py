@@ -2,6 +2,10 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
+# stdlib
+import time
+
+# project
 from aggregator import MetricsAggregator, MetricsBucketAggregator
 
 
@@ -51,6 +55,25 @@ class TestAggregatorPerf(object):
                     ma.set('set.%s' % j, float(i))
             ma.flush()
 
+    def test_checksd_batch_submission_perf(self):
+        # A scraper submitting the same 10k gauges at every run, with shared tags
+        tags = ['instance:localhost:9090', 'env:bench', 'service:scraper']
+        samples = [('scraper.metric.%s' % i, i, ['label:%s' % (i % 10)]) for i in xrange(10000)]
+
+        for submit in ('per_call', 'batch'):
+            ma = MetricsAggregator('my.host')
+            elapsed = 0
+            for _ in xrange(self.FLUSH_COUNT):
+                start = time.time()
+                if submit == 'batch':
+                    ma.submit_metrics('g', samples, tags)
+                else:
+                    for name, value, sample_tags in samples:
+                        ma.gauge(name, value, tags + sample_tags)
+                elapsed += time.time() - start
+                ma.flush()
+            print "%s: %d calls/sec" % (submit, self.FLUSH_COUNT * len(samples) / elapsed)
+
     def create_event_packet(self, title, text):
         p = "_e{{{title_len},{text_len}}}:{title}|{text}".format(
             title_len=len(title),
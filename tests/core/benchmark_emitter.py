@@ -0,0 +1,86 @@
+"""
+Performance tests for the serialization and compression of metrics payloads.
+"""
+# stdlib
+import logging
+import os
+import random
+import time
+import zlib
+
+# 3p
+import simplejson as json
+
+# project
+from emitter import MAX_COMPRESSED_SIZE, serialize_and_compress_metrics_payload, serialize_payload
+from utils.compression import COMPRESSION_LEVELS, DeflateCompressor
+
+log = logging.getLogger(__name__)
+
+
+def recursive_split(metrics_payload, max_compressed_size, log, depth=0):
+    """
+    Former splitting strategy, kept for comparison: the whole payload is serialized
+    and compressed again for every level of splitting
+    """
+    serialized_payload = serialize_payload(metrics_payload, log)
+    zipped = zlib.compress(serialized_payload)
+    if len(zipped) < max_compressed_size:
+        return [zipped]
+
+    series = metrics_payload["series"]
+    if depth > 2:
+        return []
+
+    compression_ratio = float(len(serialized_payload))/float(len(zipped))
+    n_chunks = len(zipped)/max_compressed_size + 1 + int(compression_ratio/2)
+    series_per_chunk = len(series)/n_chunks + 1
+    compressed_payloads = []
+    for i in range(n_chunks):
+        compressed_payloads.extend(recursive_split(
+            {"series": series[i*series_per_chunk:(i+1)*series_per_chunk]}, max_compressed_size, log, depth+1))
+    return compressed_payloads
+
+
+class TestEmitterPerf(object):
+
+    SERIES_COUNT = 200000
+
+    def build_payload(self):
+        # Random tags and values compress about as badly as real payloads do
+        return {"series": [
+            {
+                "metric": "benchmark.metric.%d" % (i % 500),
+                "points": [(1500000000, random.random())],
+                "source_type_name": "System",
+                "host": "my.host",
+                "tags": ["container_id:%s" % os.urandom(8).encode('hex'), "env:bench"],
+            } for i in xrange(self.SERIES_COUNT)
+        ]}
+
+    def run_splitter(self, splitter, metrics_payload):
+        start = time.clock()
+        compressed_payloads = splitter(metrics_payload, MAX_COMPRESSED_SIZE, log)
+        cpu_time = time.clock() - start
+
+        sent = sum(len(json.loads(zlib.decompress(p))["series"]) for p in compressed_payloads)
+        print "%s: %d payloads, cpu_time=%.2fs, dropped=%d" % (
+            splitter.__name__, len(compressed_payloads), cpu_time, len(metrics_payload["series"]) - sent)
+        return sent
+
+    def test_split_perf(self):
+        metrics_payload = self.build_payload()
+
+        self.run_splitter(recursive_split, metrics_payload)
+        sent = self.run_splitter(serialize_and_compress_metrics_payload, metrics_payload)
+        assert sent == self.SERIES_COUNT
+
+    def test_compression_levels(self):
+        metrics_payload = self.build_payload()
+
+        for name, level in sorted(COMPRESSION_LEVELS.iteritems(), key=lambda l: l[1]):
+            compressor = DeflateCompressor(level)
+            serialize_and_compress_metrics_payload(metrics_payload, MAX_COMPRESSED_SIZE, log, compressor)
+            stats = compressor.flush()
+            print "%s (%d): %d payloads, compression_ratio=%.2f, compression_time=%.2fs" % (
+                name, level, stats['payloads'], stats['ratio'], stats['time'])
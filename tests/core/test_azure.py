@@ -7,10 +7,15 @@ import json
 import mock
 
 # project
-from utils.cloud_metadata import Azure
+from utils.cloud_metadata import Azure, cloud_detector
 
 
 class TestAzure(unittest.TestCase):
+    def setUp(self):
+        detected = mock.patch.object(cloud_detector, 'get_provider', return_value='azure')
+        detected.start()
+        self.addCleanup(detected.stop)
+
     @mock.patch('requests.get')
     def test_host_aliases(self, mock_get):
         resp = mock.Mock()
@@ -1,3 +1,6 @@
+# stdlib
+import time
+
 # 3p
 from nose.plugins.attrib import attr
 import nose.tools as nt
@@ -21,6 +24,16 @@ class DummyAgentCheck(AgentCheck):
             self.warning("warning")
         if not instance['pass']:
             raise Exception("failure")
+        for i in xrange(instance.get('metrics', 0)):
+            self.gauge('dummy.metric', i, tags=['metric:%s' % i])
+        if instance.get('busy'):
+            busy_loop(instance['busy'])
+
+
+def busy_loop(duration):
+    start = time.time()
+    while time.time() - start < duration:
+        pass
 
 
 def test_check_status_fail():
@@ -66,6 +79,41 @@ def test_check_status_warning():
     assert instance_statuses[2].status == STATUS_OK
 
 
+def test_instance_profile():
+    instances = [
+        {'pass': True, 'metrics': 3},
+        {'pass': False},
+    ]
+
+    check = DummyAgentCheck('dummy_agent_check', {}, {}, instances)
+    for _ in xrange(3):
+        instance_statuses = check.run()
+    profile = instance_statuses[0].profile
+    assert profile['runs'] == 3
+    assert profile['metric_count'] == {'last': 3, 'avg': 3.0, 'max': 3}
+    assert profile['wall_time']['max'] >= profile['wall_time']['avg'] >= 0
+    assert 'cpu_time' in profile
+    assert 'hotspots' not in profile
+    # Failed runs are profiled too
+    assert instance_statuses[1].profile['runs'] == 3
+
+    collector_status = CollectorStatus([CheckStatus('dummy_agent_check', instance_statuses)])
+    instances_info = collector_status.to_dict()['checks']['dummy_agent_check']['instances']
+    assert instances_info[0]['profile'] == profile
+    lines = CollectorStatus.check_status_lines(collector_status.check_statuses[0])
+    assert any(line.strip().startswith('Last 3 runs: wall time') for line in lines)
+
+
+def test_sampling_profiler():
+    check = DummyAgentCheck('dummy_agent_check', {'sampling_profiler': True, 'sampling_interval': 0.001}, {},
+                            [{'pass': True, 'busy': 0.2}])
+    profile = check.run()[0].profile
+    assert profile['hotspots']
+    location, self_share, total_share = profile['hotspots'][0]
+    assert location.endswith('(busy_loop)'), location
+    assert 0 < self_share <= total_share <= 1
+
+
 @attr(requires='core_integration')
 def test_persistence():
     i1 = InstanceStatus(1, STATUS_OK)
@@ -0,0 +1,113 @@
+# stdlib
+import time
+import unittest
+
+# 3p
+import mock
+
+# project
+from utils.cloud_metadata import EC2, CloudDetector, cloud_detector
+
+
+def absent():
+    time.sleep(0.2)
+    raise Exception("metadata endpoint timed out")
+
+
+def present():
+    pass
+
+
+class TestCloudDetector(unittest.TestCase):
+
+    def test_concurrent_probes(self):
+        probes = [('ec2', mock.Mock(side_effect=absent)), ('gce', mock.Mock(side_effect=absent)),
+                  ('azure', mock.Mock(side_effect=absent))]
+        detector = CloudDetector(probes)
+
+        start = time.time()
+        self.assertIsNone(detector.get_provider())
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_negative_cache(self):
+        probe = mock.Mock(side_effect=Exception("unreachable"))
+        detector = CloudDetector([('ec2', probe)])
+
+        now = 1000
+        with mock.patch('utils.cloud_metadata.time.time', return_value=now):
+            self.assertIsNone(detector.get_provider())
+            self.assertIsNone(detector.get_provider())
+        self.assertEqual(probe.call_count, 1)
+
+        # A negative result is retried with a backoff before being kept longer
+        for i, delay in enumerate(detector.NEGATIVE_RETRY_DELAYS):
+            with mock.patch('utils.cloud_metadata.time.time', return_value=now + delay - 1):
+                self.assertIsNone(detector.get_provider())
+            self.assertEqual(probe.call_count, i + 1)
+            now += delay
+            with mock.patch('utils.cloud_metadata.time.time', return_value=now):
+                self.assertIsNone(detector.get_provider())
+            self.assertEqual(probe.call_count, i + 2)
+
+        probes = probe.call_count
+        with mock.patch('utils.cloud_metadata.time.time', return_value=now + detector.NEGATIVE_TTL - 1):
+            self.assertIsNone(detector.get_provider())
+        self.assertEqual(probe.call_count, probes)
+        with mock.patch('utils.cloud_metadata.time.time', return_value=now + detector.NEGATIVE_TTL):
+            self.assertIsNone(detector.get_provider())
+        self.assertEqual(probe.call_count, probes + 1)
+
+    def test_late_endpoint(self):
+        probe = mock.Mock(side_effect=[Exception("not ready"), None])
+        detector = CloudDetector([('ec2', probe)])
+
+        with mock.patch('utils.cloud_metadata.time.time', return_value=1000):
+            self.assertIsNone(detector.get_provider())
+        with mock.patch('utils.cloud_metadata.time.time', return_value=1000 + detector.NEGATIVE_RETRY_DELAYS[0]):
+            self.assertEqual(detector.get_provider(), 'ec2')
+
+    @mock.patch('utils.cloud_metadata.time.sleep')
+    def test_confirm(self, sleep):
+        probe = mock.Mock(side_effect=Exception("unreachable"))
+        detector = CloudDetector([('ec2', probe)])
+
+        self.assertIsNone(detector.get_provider())
+        self.assertEqual(probe.call_count, 1)
+
+        # A negative result isn't trusted for the hostname until it's settled
+        self.assertIsNone(detector.get_provider(confirm=True))
+        self.assertEqual(probe.call_count, 1 + detector.CONFIRM_ROUNDS)
+
+        probe.reset_mock()
+        probe.side_effect = [Exception("not ready"), None]
+        self.assertEqual(detector.get_provider(confirm=True), 'ec2')
+        self.assertEqual(probe.call_count, 2)
+
+    def test_detected_provider(self):
+        ec2, gce = mock.Mock(side_effect=absent), mock.Mock(side_effect=present)
+        detector = CloudDetector([('ec2', ec2), ('gce', gce)])
+
+        self.assertEqual(detector.get_provider(), 'gce')
+        self.assertEqual(detector.get_provider(), 'gce')
+        self.assertEqual((ec2.call_count, gce.call_count), (1, 1))
+
+
+class TestProviderGating(unittest.TestCase):
+
+    def setUp(self):
+        cloud_detector.invalidate()
+
+    def tearDown(self):
+        cloud_detector.invalidate()
+
+    @mock.patch('requests.get', side_effect=Exception("unreachable"))
+    def test_no_queries_outside_cloud(self, get):
+        EC2.metadata = {}
+        config = {'collect_instance_metadata': True, 'openstack_use_metadata_tags': False}
+        self.assertEqual(EC2.get_metadata(config), {})
+        probes = get.call_count
+        self.assertEqual(probes, len(cloud_detector.probes))
+
+        self.assertEqual(EC2.get_metadata(config), {})
+        self.assertEqual(EC2.get_tags(config), [])
+        self.assertEqual(get.call_count, probes)
@@ -0,0 +1,319 @@
+# stdlib
+import threading
+import time
+import unittest
+
+# project
+from checks import AgentCheck
+from checks.check_status import STATUS_ERROR
+from checks.collector import Collector, MetadataRefresher
+from emitter import SERIES_ENDPOINT
+
+
+# Instances are deep-copied by AgentCheck.run, so blocking events are looked up by name
+EVENTS = {}
+
+AGENT_CONFIG = {
+    'api_key': 'test_apikey',
+    'version': 'test',
+}
+
+
+class SleepyCheck(AgentCheck):
+    def check(self, instance):
+        time.sleep(instance.get('sleep', 0))
+        if instance.get('block'):
+            EVENTS[instance['block']].wait()
+        self.gauge('sleepy.value', instance.get('value', 1), tags=instance.get('tags'))
+        if instance.get('version'):
+            self.service_metadata('version', instance['version'])
+
+
+def build_collector(**config):
+    agentConfig = dict(AGENT_CONFIG, **config)
+    return Collector(agentConfig, [], {}, 'myhost')
+
+
+def build_check(name, instance, init_config=None):
+    return SleepyCheck(name, init_config or {}, AGENT_CONFIG, [instance])
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+class TestCheckWorkers(unittest.TestCase):
+
+    def tearDown(self):
+        self.collector.stop()
+
+    def test_concurrent_ordered(self):
+        self.collector = build_collector(check_workers=4)
+        checks = [build_check('check_%d' % i, {'sleep': 0.3, 'value': i}) for i in xrange(4)]
+        self.collector.initialized_checks_d = checks
+
+        start = time.time()
+        check_runs = self.collector._run_checks_d(noop)
+        self.assertLess(time.time() - start, 1.0)
+
+        self.assertEqual([r.check for r in check_runs], checks)
+        self.assertEqual([r.metrics[0][2] for r in check_runs], [0, 1, 2, 3])
+
+    def test_serial_opt_out(self):
+        self.collector = build_collector(check_workers=2)
+        check = build_check('serial', {}, init_config={'run_serially': True})
+        self.collector.initialized_checks_d = [check]
+
+        threads = []
+        check.check = lambda instance: threads.append(threading.current_thread())
+        self.collector._run_checks_d(noop)
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_timeout(self):
+        self.collector = build_collector(check_workers=2, check_timeout=0.2)
+        block = EVENTS['slow'] = threading.Event()
+        slow = build_check('slow', {'block': 'slow'})
+        fast = build_check('fast', {})
+        self.collector.initialized_checks_d = [slow, fast]
+
+        check_runs = self.collector._run_checks_d(noop)
+        self.assertTrue(check_runs[0].timed_out)
+        self.assertFalse(check_runs[1].timed_out)
+        self.assertEqual(len(check_runs[1].metrics), 1)
+
+        service_checks = []
+        status = self.collector._timed_out_check_status(check_runs[0], service_checks)
+        self.assertEqual(status.status, STATUS_ERROR)
+        self.assertEqual(service_checks[0]['status'], AgentCheck.CRITICAL)
+
+        # The slow check isn't scheduled again while it's still running...
+        check_runs = self.collector._run_checks_d(noop)
+        self.assertTrue(check_runs[0].timed_out)
+
+        # ...and its results are picked up once it completes
+        block.set()
+        time.sleep(0.2)
+        check_runs = self.collector._run_checks_d(noop)
+        self.assertFalse(check_runs[0].timed_out)
+        self.assertEqual(len(check_runs[0].metrics), 1)
+
+
+class TestCheckTimeouts(unittest.TestCase):
+
+    def tearDown(self):
+        self.collector.stop()
+        EVENTS['hung'].set()
+
+    def test_instance_timeout(self):
+        # A single worker is replaced when its check hangs
+        self.collector = build_collector()
+        EVENTS['hung'] = threading.Event()
+        hung = SleepyCheck('hung', {}, AGENT_CONFIG, [
+            {'tags': ['instance:0']},
+            {'tags': ['instance:1'], 'block': 'hung', 'check_timeout': 0.2},
+            {'tags': ['instance:2']},
+        ])
+        other = build_check('other', {})
+        self.collector.initialized_checks_d = [hung, other]
+
+        start = time.time()
+        check_runs = self.collector._run_checks_d(noop)
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(check_runs[0].timed_out)
+        self.assertEqual(len(check_runs[1].metrics), 1)
+
+        service_checks = []
+        status = self.collector._timed_out_check_status(check_runs[0], service_checks)
+        self.assertEqual([s.status for s in status.instance_statuses], ['OK', STATUS_ERROR])
+        self.assertIn('Instance #1 timed out', status.instance_statuses[1].error)
+        self.assertEqual(service_checks[0]['tags'], ['check:hung'])
+
+        EVENTS['hung'].set()
+        time.sleep(0.2)
+        check_runs = self.collector._run_checks_d(noop)
+        self.assertEqual([s.instance_id for s in check_runs[0].instance_statuses], [0, 1, 2])
+        self.assertEqual(len(check_runs[0].metrics), 3)
+
+
+class TestScheduledChecks(unittest.TestCase):
+
+    def test_runs_between_collections(self):
+        collector = build_collector(check_freq=15, short_check_intervals=True)
+        fast = build_check('fast', {'min_collection_interval': 5})
+        default = build_check('default', {})
+        collector.initialized_checks_d = [fast, default]
+
+        now = time.time()
+        collector._run_checks_d(noop, now)
+        for offset in (5, 10):
+            collector.run_scheduled_checks(now=now + offset)
+        check_runs = collector._run_checks_d(noop, now + 15)
+
+        self.assertEqual(len(check_runs[0].metrics), 3)
+        self.assertEqual(len(check_runs[1].metrics), 1)
+        self.assertEqual([s.instance_id for s in check_runs[0].instance_statuses], [0])
+
+        # Nothing is due right after a collection, every check keeps its last statuses
+        check_runs = collector._run_checks_d(noop, now + 16)
+        self.assertEqual([r.check for r in check_runs], [fast, default])
+        self.assertEqual(check_runs[0].metrics, [])
+        self.assertTrue(all(r.skipped for r in check_runs))
+        self.assertEqual([s.instance_id for s in check_runs[1].instance_statuses], [0])
+
+    def test_minimum_interval(self):
+        # Without short_check_intervals, min_collection_interval is only a minimum
+        collector = build_collector(check_freq=15)
+        fast = build_check('fast', {'min_collection_interval': 5})
+        collector.initialized_checks_d = [fast]
+
+        now = time.time()
+        collector._run_checks_d(noop, now)
+        collector.run_scheduled_checks(now=now + 5)
+        check_runs = collector._run_checks_d(noop, now + 15)
+        self.assertEqual(len(check_runs[0].metrics), 1)
+
+    def test_one_run_per_check(self):
+        collector = build_collector()
+        runs = []
+
+        class BatchedCheck(SleepyCheck):
+            def run(self, instance_ids=None, progress=None):
+                runs.append(instance_ids)
+                return SleepyCheck.run(self, instance_ids=instance_ids, progress=progress)
+
+        class LegacyCheck(SleepyCheck):
+            # Overrides `run` without the arguments of the scheduler
+            def run(self):
+                return SleepyCheck.run(self)
+
+        batched = BatchedCheck('batched', {}, AGENT_CONFIG, [{}, {}, {}])
+        legacy = LegacyCheck('legacy', {}, AGENT_CONFIG, [{}, {}])
+        collector.initialized_checks_d = [batched, legacy]
+
+        check_runs = collector._run_checks_d(noop)
+        self.assertEqual(runs, [[0, 1, 2]])
+        self.assertEqual([s.instance_id for s in check_runs[0].instance_statuses], [0, 1, 2])
+        self.assertEqual([s.instance_id for s in check_runs[1].instance_statuses], [0, 1])
+
+
+class TestServiceMetadata(unittest.TestCase):
+
+    def test_skipped_check_metadata(self):
+        collector = build_collector(collect_ec2_tags=False, collect_orchestrator_tags=False,
+                                    collect_instance_metadata=False, create_dd_check_tags=False, tags='')
+        check = build_check('slow', {'min_collection_interval': 60, 'version': '1.2'})
+        checksd = {'initialized_checks': [check], 'init_failed_checks': {}}
+        collector.scheduler.jitter = False
+        try:
+            collector.run(checksd)
+            # The check isn't due on the next run, but the agent checks metadata is
+            collector.push_times['agent_checks']['start'] = 0
+            payload = collector.run(checksd)
+        finally:
+            collector.stop()
+
+        self.assertEqual([c[:4] + c[5:] for c in payload['agent_checks']],
+                         [('slow', 'slow', 0, 'OK', {'version': u'1.2'})])
+
+
+class TestMetricsStreaming(unittest.TestCase):
+
+    def test_stream_check_metrics(self):
+        collector = build_collector(stream_check_metrics=True, stream_batch_size=3)
+        emitted = []
+
+        def emitter(payload, log, config, endpoint):
+            emitted.append((endpoint, payload))
+        emitter.accepts_series = True
+        collector.emitters = [emitter]
+        checks = [build_check('check_%d' % i, {'tags': ['check:%d' % i]}) for i in xrange(4)]
+        collector.initialized_checks_d = checks
+
+        check_runs = collector._run_checks_d(noop)
+        # The first three checks filled a batch, the last one waits for the payload
+        self.assertEqual(len(emitted), 1)
+        endpoint, payload = emitted[0]
+        self.assertEqual(endpoint, SERIES_ENDPOINT)
+        self.assertEqual(payload['apiKey'], 'test_apikey')
+        self.assertEqual(len(payload['metrics']), 3)
+        self.assertEqual(len(collector._streamed_metrics), 1)
+        tags = [m[3]['tags'] for m in payload['metrics'] + collector._streamed_metrics]
+        self.assertEqual(sorted(tags), [('check:%d' % i,) for i in xrange(4)])
+
+        self.assertEqual([r.metrics for r in check_runs], [[], [], [], []])
+        self.assertEqual([r.metric_count for r in check_runs], [1, 1, 1, 1])
+
+    def test_emitter_opt_in(self):
+        # An emitter that doesn't accept partial payloads gets every metric with the payload
+        collector = build_collector(stream_check_metrics=True, stream_batch_size=1)
+        collector.emitters = [lambda *args: self.fail("Nothing is streamed")]
+        collector.initialized_checks_d = [build_check('check', {})]
+
+        check_runs = collector._run_checks_d(noop)
+        self.assertEqual(len(check_runs[0].metrics), 1)
+        self.assertEqual(collector._streamed_metrics, [])
+
+    def test_stream_disabled(self):
+        collector = build_collector()
+        collector.emitters = [lambda *args: self.fail("Nothing is streamed")]
+        collector.initialized_checks_d = [build_check('check', {})]
+
+        check_runs = collector._run_checks_d(noop)
+        self.assertEqual(len(check_runs[0].metrics), 1)
+        self.assertEqual(collector._streamed_metrics, [])
+
+
+class TestMetadataRefresher(unittest.TestCase):
+
+    def test_refresh(self):
+        values = iter(xrange(100))
+        push_time = {'start': time.time(), 'interval': 0.5}
+        refresher = MetadataRefresher({'counter': (lambda: next(values), push_time)})
+        refresher.MIN_WAIT = 0.05
+
+        # Gathered right away the first time, then only read
+        self.assertEqual(refresher.get('counter'), 0)
+        self.assertEqual(refresher.get('counter'), 0)
+
+        refresher.start()
+        try:
+            # Refreshed once, ahead of the send
+            time.sleep(0.4)
+            self.assertEqual(refresher.get('counter'), 0)
+            time.sleep(0.3)
+            self.assertEqual(refresher.get('counter'), 1)
+            self.assertLess(refresher._last_refresh['counter'], push_time['start'] + push_time['interval'])
+
+            # Then again ahead of the following one, once sent
+            push_time['start'] = time.time()
+            time.sleep(0.6)
+            self.assertEqual(refresher.get('counter'), 2)
+        finally:
+            refresher.stop()
+        refresher.join(2)
+        self.assertFalse(refresher.is_alive())
+
+    def test_error(self):
+        def fail():
+            raise Exception("unreachable metadata endpoint")
+        refresher = MetadataRefresher({'failing': (fail, {'start': time.time(), 'interval': 60})})
+        self.assertIsNone(refresher.get('failing'))
+
+    def test_payload_uses_snapshot(self):
+        collector = build_collector(tags='env:test', collect_ec2_tags=False, collect_orchestrator_tags=False,
+                                    create_dd_check_tags=False)
+        collector._collect_host_metadata = lambda: {
+            'systemStats': {'cpuCores': 2},
+            'meta': {'hostname': 'myhost'},
+            'host_tags': ['cloud:tag'],
+            'gce_tags': None,
+        }
+        collector._metadata_refresher._sources['host_metadata'] = (
+            collector._collect_host_metadata, collector.push_times['host_metadata'])
+        collector.run_count = 1
+
+        payload = {'events': {}, 'host-tags': {}}
+        collector._populate_payload_metadata(payload, [], start_event=False)
+        self.assertEqual(payload['meta'], {'hostname': 'myhost'})
+        self.assertEqual(payload['systemStats'], {'cpuCores': 2})
+        self.assertEqual(payload['host-tags']['system'], [u'env:test', 'cloud:tag'])
@@ -1,9 +1,13 @@
 # stdlib
 import logging
 import os
+import re
 import time
 import unittest
 
+# 3p
+from mock import patch
+
 # project
 from aggregator import MetricsAggregator
 from checks import (
@@ -121,6 +125,41 @@ class TestCore(unittest.TestCase):
         self.assertEqual(self.ac.normalize("Metric.wordThatShouldBeSeparated", "prefix", fix_case = True), "prefix.metric.word_that_should_be_separated")
         self.assertEqual(self.ac.normalize_device_name(",@+*-()[]{}//device@name"), "___________//device_name")
 
+    def test_normalize_cache(self):
+        self.setUpAgentCheck()
+        self.assertEqual(self.ac.normalize("abc.metric(a+b)", "prefix"), "prefix.abc.metric_a_b")
+        self.assertEqual(self.ac.normalize("abc.metric(a+b)", "prefix"), "prefix.abc.metric_a_b")
+        self.assertEqual(self.ac.normalize("abc.metric(a+b)", "prefix", fix_case=True), "prefix.abc.metric_a_b")
+        self.assertEqual(self.ac.normalize(u"caf\xe9.metric"), "cafe.metric")
+        self.assertEqual((self.ac._normalize_cache_hits, self.ac._normalize_cache_misses), (1, 3))
+
+        # The cache starts over once full
+        with patch('checks.NORMALIZE_CACHE_SIZE', 3):
+            self.assertEqual(self.ac.normalize("other"), "other")
+        self.assertEqual(self.ac._normalize_cache, {("other", None, False): "other"})
+
+        self.ac.allow_profiling = True
+        self.ac._set_internal_profiling_stats({}, {})
+        stats = self.ac._get_internal_profiling_stats()
+        self.assertEqual(stats['normalize_cache'], {'hits': 1, 'misses': 4, 'size': 1})
+
+    def test_normalize_patterns_override(self):
+        class SlashCheck(AgentCheck):
+            # Keep the slashes of the metric names
+            METRIC_CHARS_RE = re.compile(r"[,\@\+\*\-()\[\]{}\s]")
+
+        check = SlashCheck('test', {}, {'checksd_hostname': "foo"})
+        self.assertEqual(check.normalize("abc/metric(a)"), "abc/metric_a")
+
+        class PrivateCheck(AgentCheck):
+            # Keep the leading underscores of the metric names
+            LEADING_UNDERSCORE_RE = re.compile(r"^(?!)")
+
+        check = PrivateCheck('test', {}, {'checksd_hostname': "foo"})
+        self.assertEqual(check.normalize("__abc.metric"), "_abc.metric")
+        self.setUpAgentCheck()
+        self.assertEqual(self.ac.normalize("abc/metric(a)"), "abc_metric_a")
+
     def test_service_check(self):
         check_name = 'test.service_check'
         status = AgentCheck.CRITICAL
@@ -234,6 +273,48 @@ class TestCore(unittest.TestCase):
             })
 
 
+class InstanceCheck(AgentCheck):
+    def check(self, instance):
+        self.seen = getattr(self, 'seen', []) + [instance]
+        tags = instance.get('tags', [])
+        if instance.get('modify'):
+            tags.append('added')
+        self.gauge('instance.tags', len(tags))
+
+
+class TestInstanceCopies(unittest.TestCase):
+
+    def test_not_copied(self):
+        instance = {'tags': ['a', 'b'], 'whitelist': range(1000)}
+        check = InstanceCheck('test', {}, {'checksd_hostname': 'foo'}, [instance])
+        check.run()
+        check.run()
+
+        self.assertIs(check.seen[1], instance)
+        self.assertFalse(check.deepcopy_instances)
+        self.assertGreater(check.instance_copy_saved, 0)
+
+    def test_modified_instance(self):
+        instance = {'tags': ['a'], 'modify': True}
+        check = InstanceCheck('test', {}, {'checksd_hostname': 'foo'}, [instance])
+        for _ in xrange(3):
+            check.run()
+        values = [m[2] for m in check.get_metrics()]
+
+        # The instance is restored after the first run, and copied afterwards
+        self.assertTrue(check.deepcopy_instances)
+        self.assertEqual(check.instances[0], {'tags': ['a'], 'modify': True})
+        self.assertIsNot(check.seen[2], check.instances[0])
+        self.assertEqual(values, [2])
+        self.assertEqual([len(i['tags']) for i in check.seen], [2, 2, 2])
+
+    def test_opt_out(self):
+        check = InstanceCheck('test', {'deepcopy_instances': True}, {'checksd_hostname': 'foo'}, [{}])
+        check.run()
+        self.assertIsNot(check.seen[0], check.instances[0])
+        self.assertEqual(check.instance_copy_saved, 0)
+
+
 class TestCollectionInterval(unittest.TestCase):
 
     def test_min_collection_interval(self):
@@ -381,3 +462,27 @@ class TestAggregator(unittest.TestCase):
         self.assertEquals(len(self.aggr.metrics), 1, self.aggr.metrics)
         metric = self.aggr.metrics.values()[0]
         self.assertEquals(metric.value, 2)
+
+    def test_batch_submission(self):
+        check = AgentCheck('test', {}, {'checksd_hostname': 'foo'})
+        samples = [('metric.a', 1), ('metric.b', 2, ['b', 'shared']), ('metric.c', 3, ['c'])]
+        check.gauges(samples, tags=['shared', 'env'])
+        check.gauges([('metric.d', 4)])
+
+        reference = AgentCheck('test', {}, {'checksd_hostname': 'foo'})
+        for name, value, tags in [('metric.a', 1, ['shared', 'env']), ('metric.b', 2, ['b', 'shared', 'env']),
+                                  ('metric.c', 3, ['c', 'shared', 'env']), ('metric.d', 4, None)]:
+            reference.gauge(name, value, tags)
+
+        self.assertEquals(sorted(check.get_metrics()), sorted(reference.get_metrics()))
+
+    def test_batch_submission_counts(self):
+        check = AgentCheck('test', {}, {'checksd_hostname': 'foo'})
+        check.monotonic_counts([('metric.a', 1)], tags=['a'])
+        check.monotonic_counts([('metric.a', 4)], tags=['a'])
+        check.counts([('metric.b', 2)])
+        metrics = dict((m[0], m) for m in check.get_metrics())
+
+        self.assertEquals(metrics['metric.a'][2], 3)
+        self.assertEquals(metrics['metric.a'][3]['tags'], ('a',))
+        self.assertEquals(metrics['metric.b'][2], 2)
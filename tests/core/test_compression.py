@@ -0,0 +1,57 @@
+# stdlib
+import unittest
+import zlib
+
+# 3p
+import mock
+import simplejson as json
+
+# project
+from dogstatsd import serialize_metrics
+from emitter import serialize_and_compress_metrics_payload
+from utils.compression import DeflateCompressor, get_compressor, parse_compression_level
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_levels(self):
+        self.assertEqual(parse_compression_level(None), 6)
+        self.assertEqual(parse_compression_level('fast'), 1)
+        self.assertEqual(parse_compression_level('Small'), 9)
+        self.assertEqual(parse_compression_level('3'), 3)
+        self.assertEqual(parse_compression_level('42'), 6)
+        self.assertEqual(parse_compression_level('fastest'), 6)
+
+        self.assertIs(get_compressor({'compression_level': 'fast'}), get_compressor({'compression_level': '1'}))
+        self.assertEqual(get_compressor({'compression_level': 'small'}).level, 9)
+
+    def test_stats(self):
+        compressor = DeflateCompressor(1)
+        data = 'metric.name ' * 1000
+        self.assertEqual(zlib.decompress(compressor.compress(data)), data)
+        compressor.compress(data)
+
+        stats = compressor.flush()
+        self.assertEqual(stats['payloads'], 2)
+        self.assertEqual(stats['raw_bytes'], 2 * len(data))
+        self.assertGreater(stats['ratio'], 10)
+        self.assertEqual(compressor.flush()['payloads'], 0)
+
+    def test_streamed_payload_stats(self):
+        compressor = DeflateCompressor(9)
+        metrics_payload = {"series": [{"metric": "metric.%d" % i, "points": [(i, i)]} for i in xrange(100)]}
+        payloads = serialize_and_compress_metrics_payload(metrics_payload, 2 << 20, mock.Mock(), compressor)
+
+        stats = compressor.flush()
+        self.assertEqual(stats['payloads'], 1)
+        self.assertEqual(stats['compressed_bytes'], len(payloads[0]))
+        self.assertEqual(stats['raw_bytes'], len(zlib.decompress(payloads[0])))
+
+    def test_dogstatsd_compressor(self):
+        compressor = DeflateCompressor(1)
+        metrics = [{"metric": "metric.%d" % i, "points": [(i, i)]} for i in xrange(100)]
+        body, headers = serialize_metrics(metrics, 'my.host', compressor)
+
+        self.assertEqual(headers['Content-Encoding'], 'deflate')
+        self.assertEqual(len(json.loads(zlib.decompress(body))['series']), 101)
+        self.assertEqual(compressor.flush()['payloads'], 1)
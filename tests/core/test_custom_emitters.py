@@ -0,0 +1,72 @@
+# stdlib
+import logging
+import threading
+import time
+import unittest
+import zlib
+
+# 3p
+import mock
+import simplejson as json
+
+# project
+from ddagent import EmitterManager, EmitterPayload, EmitterThread
+
+
+class TestEmitterPayload(unittest.TestCase):
+
+    def test_decode_once(self):
+        data = zlib.compress(json.dumps({'foo': 'bar'}))
+        payload = EmitterPayload(data, {'Content-Encoding': 'deflate'})
+
+        with mock.patch('ddagent.json_decode', wraps=json.loads) as json_decode:
+            self.assertEqual(payload.get(), {'foo': 'bar'})
+            self.assertIs(payload.get(), payload.get())
+            self.assertEqual(json_decode.call_count, 1)
+
+    def test_decode_error(self):
+        payload = EmitterPayload('not json')
+        self.assertRaises(ValueError, payload.get)
+        self.assertRaises(ValueError, payload.get)
+
+
+class TestEmitterManager(unittest.TestCase):
+
+    def test_send_does_not_decode(self):
+        manager = EmitterManager({})
+        thread = mock.Mock()
+        manager.emitterThreads = [thread]
+
+        with mock.patch('ddagent.json_decode') as json_decode:
+            manager.send(zlib.compress('{}'), {'Content-Encoding': 'deflate'})
+            self.assertFalse(json_decode.called)
+
+        payload = thread.enqueue.call_args[0][0]
+        self.assertEqual(payload.get(), {})
+
+    def test_bounded_queue(self):
+        blocked = threading.Event()
+        received = []
+
+        def emitter():
+            def emit(data, log, config):
+                blocked.wait()
+                received.append(data)
+            return emit
+
+        thread = EmitterThread(name='slow', emitter=emitter, logger=logging, config={}, max_queue_size=2)
+        for i in xrange(5):
+            thread.enqueue(EmitterPayload(json.dumps(i)), {})
+
+        stats = thread.get_stats()
+        self.assertEqual(stats['queue_size'], 2)
+        self.assertEqual(stats['dropped'], 3)
+
+        thread.start()
+        blocked.set()
+        for _ in xrange(50):
+            if thread.handled_count == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(received, [0, 1])
+        self.assertEqual(thread.get_stats()['handled'], 2)
@@ -3,11 +3,17 @@
 import mock
 import unittest
 import simplejson as json
+import time
+import zlib
 
 # project
+from checks.check_status import EmitterStatus
 from emitter import (
+    SERIES_ENDPOINT,
+    http_emitter,
     remove_control_chars,
     remove_undecodable_chars,
+    repair_payload,
     sanitize_payload,
     serialize_and_compress_metrics_payload,
     split_payload,
@@ -103,9 +109,23 @@ class TestEmitter(unittest.TestCase):
             self.assertEqual(good, remove_undecodable_chars(bad, log))
             self.assertEqual(log_called, log.warning.called)
 
-    # Make compression a no-op for the tests
-    @mock.patch('zlib.compress', side_effect=lambda x: x)
-    def test_metrics_payload_chunks(self, compress_mock):
+    def test_repair_payload(self):
+        log = mock.Mock()
+        good = {'metric': 'good\tname', 'tags': ['env:prod']}
+        bad = {'metric': 'bad', 'tags': ('\xe9\tdevice', 'env:prod')}
+        payload = {'series': [good, bad], 'uuid': 'abc'}
+
+        repaired = repair_payload(payload, log)
+
+        self.assertEqual(repaired, {'series': [good, {'metric': 'bad', 'tags': (u'device', 'env:prod')}],
+                                    'uuid': 'abc'})
+        # Only the values holding undecodable strings are copied
+        self.assertIs(repaired['series'][0], good)
+        self.assertIsNot(repaired['series'][1], bad)
+        self.assertEqual(bad['tags'][0], '\xe9\tdevice')
+        self.assertIs(repair_payload(good, log), good)
+
+    def test_metrics_payload_chunks(self):
         log = mock.Mock()
         nb_series = 10000
         max_compressed_size = 1 << 10  # 1KB, well below the original size of our payload of 10000 metrics
@@ -118,7 +138,7 @@ class TestEmitter(unittest.TestCase):
             } for i in xrange(nb_series)
         ]}
 
-        compressed_payloads = serialize_and_compress_metrics_payload(metrics_payload, max_compressed_size, 0, log)
+        compressed_payloads = serialize_and_compress_metrics_payload(metrics_payload, max_compressed_size, log)
 
         # check that all the payloads are smaller than the max size
         for compressed_payload in compressed_payloads:
@@ -127,10 +147,87 @@ class TestEmitter(unittest.TestCase):
         # check that all the series are there (correct number + correct metric names)
         series_after = []
         for compressed_payload in compressed_payloads:
-            series_after.extend(json.loads(compressed_payload)["series"])
+            series_after.extend(json.loads(zlib.decompress(compressed_payload))["series"])
 
         self.assertEqual(nb_series, len(series_after))
 
         metrics_sorted = sorted([int(metric["metric"]) for metric in series_after])
         for i, metric_name in enumerate(metrics_sorted):
             self.assertEqual(i, metric_name)
+
+        # payloads are filled up to the limit, not split in fixed-size chunks
+        self.assertGreater(len(compressed_payloads[0]), max_compressed_size * 3 / 4)
+
+    def test_metrics_payload_oversized_series(self):
+        log = mock.Mock()
+        max_compressed_size = 1 << 10
+        metrics_payload = {"series": [
+            {"metric": "small.1", "points": [(1, 1)]},
+            {"metric": "huge", "points": [(1, 1)], "tags": [os.urandom(16).encode('hex') for _ in xrange(100)]},
+            {"metric": "small.2", "points": [(1, 1)]},
+        ]}
+
+        compressed_payloads = serialize_and_compress_metrics_payload(metrics_payload, max_compressed_size, log)
+
+        metrics = [s["metric"] for p in compressed_payloads for s in json.loads(zlib.decompress(p))["series"]]
+        self.assertEqual(metrics, ["small.1", "small.2"])
+        self.assertTrue(log.error.called)
+
+    def test_metrics_payload_empty(self):
+        compressed_payloads = serialize_and_compress_metrics_payload({"series": []}, 1 << 10, mock.Mock())
+        self.assertEqual([json.loads(zlib.decompress(p)) for p in compressed_payloads], [{"series": []}])
+
+    @mock.patch('emitter.http_session.post')
+    def test_http_emitter_concurrent_posts(self, post):
+        def slow_post(url, **kwargs):
+            time.sleep(0.3)
+            return mock.Mock(status_code=202)
+        post.side_effect = slow_post
+
+        message = {
+            'apiKey': 'api_key',
+            'internalHostname': 'my.host',
+            'metrics': [('my.metric', 1, 1, {'type': 'gauge'})],
+            'service_checks': [],
+        }
+        agentConfig = {'dd_url': 'https://app.datadoghq.com', 'version': 'test'}
+
+        start = time.time()
+        timings = http_emitter(message, mock.Mock(), agentConfig, 'metrics')
+        self.assertLess(time.time() - start, 0.8)
+
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(sorted(timings), ['check_run', 'intake', 'series'])
+        self.assertEqual(EmitterStatus('http_emitter', timings=timings).timings, timings)
+
+    @mock.patch('emitter.http_session.post', return_value=mock.Mock(status_code=202))
+    def test_http_emitter_series_only(self, post):
+        message = {
+            'apiKey': 'api_key',
+            'internalHostname': 'my.host',
+            'metrics': [('my.metric', 1, 1, {'type': 'gauge'})],
+        }
+        agentConfig = {'dd_url': 'https://app.datadoghq.com', 'version': 'test'}
+
+        timings = http_emitter(message, mock.Mock(), agentConfig, SERIES_ENDPOINT)
+        self.assertEqual(sorted(timings), ['series'])
+        self.assertEqual(post.call_count, 1)
+        url = post.call_args[0][0]
+        self.assertTrue(url.startswith('https://app.datadoghq.com/api/v1/series'), url)
+        series = json.loads(zlib.decompress(post.call_args[1]['data']))['series']
+        self.assertEqual([s['metric'] for s in series], ['my.metric'])
+
+    def test_split_payload_streams_series(self):
+        legacy_payload = {
+            'internalHostname': 'my.host',
+            'metrics': [('my.metric.%d' % i, 1, i, {'type': 'gauge'}) for i in xrange(1200)],
+            'service_checks': [],
+        }
+        _, metrics_payload, _ = split_payload(legacy_payload)
+        self.assertFalse(isinstance(metrics_payload['series'], list))
+
+        compressed_payloads = serialize_and_compress_metrics_payload(metrics_payload, 2 << 20, mock.Mock())
+        series = json.loads(zlib.decompress(compressed_payloads[0]))['series']
+        self.assertEqual(len(series), 1200)
+        self.assertEqual(series[-1], {'metric': 'my.metric.1199', 'points': [[1, 1199]],
+                                      'source_type_name': 'System', 'host': 'my.host', 'type': 'gauge'})
@@ -60,7 +60,8 @@ def mocked_strftime(t):
 
 
 def mocked_os_remove(path):
-    if 'datadog-agent-1.tar.bz2' not in path:
+    # Temp files left in the fixtures dir are already removed by `FlareTest.tearDown`
+    if 'datadog-agent-1.tar.bz2' not in path and os.path.exists(path):
         os.remove(path)
 
 
@@ -78,6 +79,14 @@ class FakeResponse(object):
 
 class FlareTest(unittest.TestCase):
 
+    def setUp(self):
+        self._fixtures = set(os.listdir(get_mocked_temp()))
+
+    def tearDown(self):
+        # Flares write their permissions log to the mocked temp dir, the fixtures dir
+        for name in set(os.listdir(get_mocked_temp())) - self._fixtures:
+            os.remove(os.path.join(get_mocked_temp(), name))
+
     @mock.patch('os.remove', side_effect=mocked_os_remove)
     @mock.patch('utils.flare.strftime', side_effect=mocked_strftime)
     @mock.patch('tempfile.gettempdir', side_effect=get_mocked_temp)
@@ -0,0 +1,80 @@
+# stdlib
+import cPickle as pickle
+import struct
+import unittest
+
+# 3p
+import mock
+
+# project
+from graphite import GraphiteConnection, PlaintextGraphiteConnection, SeriesBuffer
+
+
+class TestSeriesBuffer(unittest.TestCase):
+
+    def test_pre_aggregation(self):
+        buf = SeriesBuffer(interval=10)
+        buf.add('foo.bar', 'myhost', 'N/A', 1000, 1.0)
+        buf.add('foo.bar', 'myhost', 'N/A', 1005, 2.0)
+        buf.add('foo.bar', 'myhost', 'N/A', 1010, 3.0)
+        buf.add('foo.baz', 'myhost', 'sda', 1000, 4.0)
+
+        self.assertEqual(len(buf), 2)
+        self.assertEqual(buf.point_count, 4)
+        series = sorted(buf.flush(), key=lambda s: s['metric'])
+        self.assertEqual(len(buf), 0)
+
+        self.assertEqual(series[0]['metric'], 'foo.bar')
+        self.assertEqual(series[0]['points'], [(1000, 2.0), (1010, 3.0)])
+        self.assertEqual(series[0]['host'], 'myhost')
+        self.assertNotIn('device', series[0])
+        self.assertEqual(series[1]['device'], 'sda')
+
+
+class TestGraphiteConnection(unittest.TestCase):
+
+    def test_pickle_batch(self):
+        app = mock.Mock()
+        conn = GraphiteConnection(mock.Mock(), ('127.0.0.1', 1234), app, 'myhost')
+        conn._decode(pickle.dumps([('foo.bar', (1000, 1)), ('foo.baz', ('bad', 2))]))
+
+        app.appendMetric.assert_called_once_with('graphite', 'foo.bar', 'myhost', 'N/A', 1000.0, 1.0)
+
+    def test_plaintext(self):
+        buf = SeriesBuffer()
+        conn = PlaintextGraphiteConnection(mock.Mock(), ('127.0.0.1', 1234), None, 'myhost', buf)
+
+        conn._on_read_chunk('foo.bar 1 1000\nfoo.baz 2 10')
+        self.assertEqual(buf.point_count, 1)
+        conn._on_read_chunk('00\ninvalid line\n\nfoo.qux 3 1000')
+        self.assertEqual(buf.point_count, 2)
+        conn._on_close()
+        self.assertEqual(buf.point_count, 3)
+
+        series = dict((s['metric'], s['points']) for s in buf.flush())
+        self.assertEqual(series, {
+            'foo.bar': [(1000, 1.0)],
+            'foo.baz': [(1000, 2.0)],
+            'foo.qux': [(1000, 3.0)],
+        })
+
+    @mock.patch('graphite.MAX_FRAME_SIZE', 20)
+    def test_plaintext_oversized_line(self):
+        buf = SeriesBuffer()
+        conn = PlaintextGraphiteConnection(mock.Mock(), ('127.0.0.1', 1234), None, 'myhost', buf)
+
+        conn._on_read_chunk('foo.bar 1 1000\n' + 'x' * 30)
+        self.assertEqual(conn._partial_line, '')
+        # The rest of the dropped line is skipped too
+        conn._on_read_chunk('y' * 30)
+        conn._on_read_chunk('yyy 1 1000\nfoo.baz 2 1000\n')
+        series = dict((s['metric'], s['points']) for s in buf.flush())
+        self.assertEqual(series, {'foo.bar': [(1000, 1.0)], 'foo.baz': [(1000, 2.0)]})
+
+    @mock.patch('graphite.MAX_FRAME_SIZE', 20)
+    def test_pickle_oversized_frame(self):
+        stream = mock.Mock()
+        conn = GraphiteConnection(stream, ('127.0.0.1', 1234), mock.Mock(), 'myhost')
+        conn._on_read_header(struct.pack('!L', 21))
+        self.assertTrue(stream.close.called)
+        self.assertEqual(stream.read_bytes.call_count, 1)
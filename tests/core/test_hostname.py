@@ -0,0 +1,46 @@
+# stdlib
+import unittest
+
+# 3p
+import mock
+
+# project
+from utils.hostname import get_hostname, hostname_cache, invalidate_hostname_cache
+
+
+class TestHostnameCache(unittest.TestCase):
+
+    def setUp(self):
+        invalidate_hostname_cache()
+
+    def tearDown(self):
+        invalidate_hostname_cache()
+
+    @mock.patch('utils.hostname._resolve_hostname', return_value='resolved-host')
+    def test_resolved_once(self, resolve):
+        self.assertEqual(get_hostname({}), 'resolved-host')
+        self.assertEqual(get_hostname({}), 'resolved-host')
+        self.assertEqual(resolve.call_count, 1)
+
+        # Requests without a config don't parse it once the host name is known
+        with mock.patch('config.get_config') as get_config:
+            self.assertEqual(get_hostname(), 'resolved-host')
+            self.assertFalse(get_config.called)
+
+        invalidate_hostname_cache()
+        get_hostname({})
+        self.assertEqual(resolve.call_count, 2)
+
+    @mock.patch('utils.hostname._resolve_hostname', return_value='resolved-host')
+    def test_ttl(self, resolve):
+        with mock.patch('utils.hostname.time.time', return_value=1000):
+            get_hostname({})
+        with mock.patch('utils.hostname.time.time', return_value=1000 + hostname_cache.ttl + 1):
+            get_hostname({})
+        self.assertEqual(resolve.call_count, 2)
+
+    @mock.patch('utils.hostname._resolve_hostname')
+    def test_config_hostname(self, resolve):
+        self.assertEqual(get_hostname({'hostname': 'config-host'}), 'config-host')
+        self.assertEqual(get_hostname(), 'config-host')
+        self.assertFalse(resolve.called)
@@ -0,0 +1,72 @@
+# stdlib
+import unittest
+
+# 3p
+import mock
+
+# project
+from checks.scheduler import CheckScheduler, next_deadline
+
+
+def build_check(name, instances, min_collection_interval=0):
+    check = mock.Mock(instances=instances, min_collection_interval=min_collection_interval)
+    check.name = name
+    return check
+
+
+class TestCheckScheduler(unittest.TestCase):
+
+    def test_next_deadline(self):
+        # Drift-free: a late run doesn't shift the grid
+        self.assertEqual(next_deadline(100, 15, 103), 115)
+        # Missed deadlines are skipped
+        self.assertEqual(next_deadline(100, 15, 146), 160)
+
+    def test_minimum_intervals(self):
+        # Shorter intervals than the default one are a minimum, as before
+        scheduler = CheckScheduler(15, jitter=False)
+        fast = build_check('fast', [{'min_collection_interval': 5}])
+        scheduler.sync([fast], now=1000)
+        self.assertEqual(scheduler.pop_due(now=1000), [(fast, [0])])
+        self.assertEqual(scheduler.next_run(), 1015)
+
+    def test_intervals(self):
+        scheduler = CheckScheduler(15, jitter=False, short_intervals=True)
+        fast = build_check('fast', [{'min_collection_interval': 5}])
+        default = build_check('default', [{}])
+        slow = build_check('slow', [{}, {'min_collection_interval': 15}], min_collection_interval=60)
+        scheduler.sync([fast, default, slow], now=1000)
+
+        due = scheduler.pop_due(now=1000)
+        self.assertEqual(sorted((c.name, ids) for c, ids in due),
+                         [('default', [0]), ('fast', [0]), ('slow', [0, 1])])
+        self.assertEqual(scheduler.next_run(), 1005)
+
+        runs = {}
+        for now in xrange(1005, 1061, 5):
+            for check, instance_ids in scheduler.pop_due(now=now):
+                runs.setdefault(check.name, []).append((now, instance_ids))
+
+        self.assertEqual(len(runs['fast']), 12)
+        self.assertEqual(runs['default'], [(1015, [0]), (1030, [0]), (1045, [0]), (1060, [0])])
+        self.assertEqual(runs['slow'][-1], (1060, [0, 1]))
+        self.assertEqual(len(runs['slow']), 4)
+
+    def test_jitter(self):
+        scheduler = CheckScheduler(15)
+        slow = build_check('slow', [{'min_collection_interval': 60}])
+        default = build_check('default', [{}])
+        with mock.patch('checks.scheduler.random.uniform', return_value=42):
+            scheduler.sync([slow, default], now=1000)
+
+        self.assertEqual([c.name for c, _ in scheduler.pop_due(now=1000)], ['default'])
+        self.assertEqual([c.name for c, _ in scheduler.pop_due(now=1030)], ['default'])
+        self.assertEqual([c.name for c, _ in scheduler.pop_due(now=1042)], ['slow'])
+
+    def test_sync_removes_checks(self):
+        scheduler = CheckScheduler(15, jitter=False)
+        first, second = build_check('first', [{}]), build_check('second', [{}])
+        scheduler.sync([first, second], now=1000)
+        scheduler.sync([second], now=1000)
+
+        self.assertEqual(scheduler.pop_due(now=1000), [(second, [0])])
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# stdlib
+import unittest
+
+# 3p
+import mock
+import simplejson as json
+
+# project
+from aggregator import MetricsAggregator
+from emitter import serialize_payload
+from utils.strings import StringValidator, sanitize_string
+
+
+class TestStringValidator(unittest.TestCase):
+
+    def test_sanitize_string(self):
+        log = mock.Mock()
+        self.assertEqual(sanitize_string('valid\r\n', log), 'valid\r\n')
+        self.assertEqual(sanitize_string(u'☢', log), u'☢')
+        self.assertEqual(sanitize_string('in\xe9valid\r\n', log), u'invalid')
+        self.assertTrue(log.warning.called)
+
+    def test_cache(self):
+        validator = StringValidator(max_size=2)
+        with mock.patch('utils.strings.sanitize_string', side_effect=lambda s, log: s) as sanitize:
+            self.assertEqual(validator.validate_tags(('a:1', 'b:2')), ('a:1', 'b:2'))
+            validator.validate('a:1')
+            self.assertEqual(sanitize.call_count, 2)
+
+            # Starts over when full
+            validator.validate('c:3')
+            validator.validate('a:1')
+            self.assertEqual(sanitize.call_count, 4)
+
+    def test_aggregator_validates_contexts(self):
+        aggregator = MetricsAggregator('my.host')
+        aggregator.gauge('my.metric\xe9', 1, tags=['env:prod', 'bad:\xff'])
+        metric = aggregator.flush()[0]
+
+        self.assertEqual(metric['metric'], u'my.metric')
+        self.assertEqual(metric['tags'], ('bad:', 'env:prod'))
+        json.dumps(metric)
+
+
+class TestSerializePayload(unittest.TestCase):
+
+    def test_only_offending_fields(self):
+        log = mock.Mock()
+        payload = {'valid': 'with control chars\r\n', 'invalid': ['\xff\r\n', u'☢']}
+
+        self.assertEqual(json.loads(serialize_payload(payload, log)),
+                         {'valid': 'with control chars\r\n', 'invalid': ['', u'☢']})
@@ -0,0 +1,81 @@
+# stdlib
+import logging
+import threading
+import time
+import unittest
+
+# project
+from utils.subprocess_output import (
+    get_subprocess_output,
+    SubprocessOutputEmptyError,
+    SubprocessOutputTimeoutError,
+    subprocess_stats,
+)
+from utils.platform import Platform
+
+log = logging.getLogger(__name__)
+
+
+@unittest.skipIf(Platform.is_windows(), "Relies on a POSIX shell")
+class TestSubprocessOutput(unittest.TestCase):
+
+    def setUp(self):
+        subprocess_stats.flush()
+
+    def test_output(self):
+        out, err, returncode = get_subprocess_output(['sh', '-c', 'echo out; echo err >&2; exit 2'], log)
+        self.assertEqual((out, err, returncode), ('out\n', 'err\n', 2))
+
+        self.assertRaises(SubprocessOutputEmptyError, get_subprocess_output, ['true'], log)
+        self.assertEqual(get_subprocess_output(['true'], log, raise_on_empty_output=False), ('', '', 0))
+
+    def test_large_output(self):
+        # Both pipes hold more than a pipe buffer, draining them one by one would block
+        command = ['sh', '-c', 'head -c 1000000 /dev/zero >&2; head -c 1000000 /dev/zero']
+        out, err, _ = get_subprocess_output(command, log)
+        self.assertEqual((len(out), len(err)), (1000000, 1000000))
+
+        out, err, _ = get_subprocess_output(command, log, max_output_size=1000)
+        self.assertEqual((len(out), len(err)), (1000, 1000))
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(SubprocessOutputTimeoutError, get_subprocess_output, ['sleep', '10'], log, timeout=0.2)
+        self.assertLess(time.time() - start, 5)
+
+    def test_background_child(self):
+        # The child keeps stdout open, the command is still done once it exits
+        start = time.time()
+        out, _, returncode = get_subprocess_output(['sh', '-c', 'echo done; sleep 10 &'], log, timeout=5)
+        self.assertEqual((out, returncode), ('done\n', 0))
+        self.assertLess(time.time() - start, 4)
+
+    def test_timeout_background_child(self):
+        # The pipe readers don't outlive the command, even if its child holds the pipes
+        def readers():
+            return [t for t in threading.enumerate() if t.name == 'SubprocessPipeReader']
+
+        self.assertRaises(SubprocessOutputTimeoutError, get_subprocess_output,
+                          ['sh', '-c', 'sleep 10 & sleep 10'], log, timeout=0.2)
+        time.sleep(0.2)
+        self.assertEqual(readers(), [])
+
+        get_subprocess_output(['sh', '-c', 'echo done; sleep 10 &'], log, timeout=5)
+        time.sleep(0.2)
+        self.assertEqual(readers(), [])
+
+    def test_stats(self):
+        get_subprocess_output(['sh', '-c', 'echo; exit 1'], log)
+        get_subprocess_output(['sh', '-c', 'echo'], log)
+        self.assertRaises(SubprocessOutputTimeoutError, get_subprocess_output, ['sleep', '10'], log, timeout=0.1)
+
+        stats = subprocess_stats.flush()
+        self.assertEqual(stats['sh']['count'], 2)
+        self.assertEqual(stats['sh']['errors'], 1)
+        self.assertEqual(stats['sleep']['timeouts'], 1)
+        self.assertGreater(stats['sleep']['run_time'], 0.1)
+        self.assertEqual(subprocess_stats.flush(), {})
+
+    def test_stats_string_command(self):
+        subprocess_stats.record('/bin/ls -l', 0.1, 0)
+        self.assertEqual(subprocess_stats.flush().keys(), ['ls'])
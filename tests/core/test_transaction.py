@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 import threading
 import time
 import unittest
+import zlib
 
 # 3rd party
 from nose.plugins.attrib import attr
@@ -15,25 +16,43 @@ from config import get_version
 from ddagent import (
     APIMetricTransaction,
     APIServiceCheckTransaction,
+    MAX_COALESCED_SIZE,
     MAX_QUEUE_SIZE,
     MetricTransaction,
     THROTTLING_DELAY,
 )
-from transaction import Transaction, TransactionManager
+from transaction import (
+    ADAPTIVE_MAX_FLUSH_DURATION,
+    AdaptiveThrottler,
+    LatencyHistogram,
+    PRIORITY_EVENTS,
+    PRIORITY_METADATA,
+    PRIORITY_METRICS,
+    PRIORITY_SERVICE_CHECKS,
+    Transaction,
+    TransactionManager,
+)
+from utils.http import PAYLOAD_TYPE_HEADER
 
 
 class memTransaction(Transaction):
-    def __init__(self, size, manager):
+    def __init__(self, size, manager, priority=PRIORITY_METRICS):
         Transaction.__init__(self)
         self._trManager = manager
         self._size = size
         self._flush_count = 0
         self._endpoint = 'https://example.com'
         self._api_key = 'a' * 32
+        self._priority = priority
+        self.flush_order = []
 
         self.is_flushable = False
 
+    def get_priority(self):
+        return self._priority
+
     def flush(self):
+        self.flush_order.append(self.get_id())
         self._flush_count = self._flush_count + 1
         if self.is_flushable:
             self._trManager.tr_success(self)
@@ -349,3 +368,313 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(len(trManager._transactions), 2)
         self.assertEqual(trManager._transactions[0]._endpoint, 'https://app.datadoghq.com')
         self.assertEqual(trManager._transactions[1]._endpoint, 'https://app.example.com')
+
+
+class TestAdaptiveThrottler(unittest.TestCase):
+
+    def test_additive_increase(self):
+        throttler = AdaptiveThrottler(THROTTLING_DELAY, max_rate=10, max_parallelism=3)
+        self.assertEqual(throttler.get_rate(), 2)
+        self.assertEqual(throttler.get_parallelism(), 1)
+
+        for _ in xrange(20):
+            throttler.on_success(0.1)
+
+        self.assertEqual(throttler.get_rate(), 10)
+        self.assertEqual(throttler.get_parallelism(), 3)
+        self.assertEqual(throttler.get_delay(), timedelta(seconds=0.1))
+
+    def test_multiplicative_decrease(self):
+        throttler = AdaptiveThrottler(THROTTLING_DELAY, min_parallelism=2, max_rate=10, max_parallelism=8)
+        for _ in xrange(50):
+            throttler.on_success(0.1)
+        self.assertEqual(throttler.get_parallelism(), 8)
+
+        throttler.on_error(0.1)
+        self.assertEqual(throttler.get_rate(), 5)
+        self.assertEqual(throttler.get_parallelism(), 4)
+
+        # Never below a quarter of the configured rate, nor below the base parallelism
+        for _ in xrange(10):
+            throttler.on_error()
+        self.assertEqual(throttler.get_rate(), 0.5)
+        self.assertEqual(throttler.get_parallelism(), 2)
+
+    def test_latency_growth(self):
+        throttler = AdaptiveThrottler(THROTTLING_DELAY, max_rate=10)
+        for _ in xrange(10):
+            throttler.on_success(1.5)
+        self.assertEqual(throttler.get_rate(), 10)
+
+        # Slow, but under the latency floor
+        throttler = AdaptiveThrottler(THROTTLING_DELAY, max_rate=10)
+        throttler.on_success(0.1)
+        throttler.on_success(0.9)
+        self.assertEqual(throttler.get_rate(), 4)
+
+        # Much slower than the average
+        throttler.on_success(5)
+        self.assertEqual(throttler.get_rate(), 2)
+
+    def test_transaction_manager(self):
+        throttler = AdaptiveThrottler(timedelta(seconds=0.1), max_rate=100, max_parallelism=5)
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       timedelta(seconds=0.1), max_endpoint_errors=100,
+                                       throttler=throttler)
+        trManager._flush_without_ioloop = True  # Use blocking API to emulate tornado ioloop
+
+        step = 20
+        for i in xrange(step):
+            tr = memTransaction(1, trManager)
+            tr.is_flushable = True
+            trManager.append(tr)
+
+        before = datetime.utcnow()
+        trManager.flush()
+        after = datetime.utcnow()
+
+        self.assertEqual(len(trManager._transactions), 0)
+        # A fixed 100ms delay would take 2 seconds
+        self.assertTrue((after - before) < timedelta(seconds=1.5))
+        self.assertEqual(trManager.get_max_parallelism(), 5)
+        self.assertTrue(trManager.get_flush_rate() > 10)
+        self.assertEqual(trManager.get_flush_rate(), throttler.get_rate())
+        self.assertEqual(trManager._MAX_FLUSH_DURATION, ADAPTIVE_MAX_FLUSH_DURATION)
+
+    def test_error_codes(self):
+        throttler = AdaptiveThrottler(THROTTLING_DELAY, max_rate=10)
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY,
+                                       max_endpoint_errors=100, throttler=throttler)
+        for _ in xrange(8):
+            throttler.on_success(0.1)
+        self.assertEqual(throttler.get_rate(), 10)
+
+        # Rejected payloads and client errors don't slow down the flushes
+        tr = memTransaction(1, trManager)
+        trManager.append(tr)
+        trManager._running_flushes = 1
+        trManager.tr_error_reject_request(tr, 400)
+        self.assertEqual(throttler.get_rate(), 10)
+        for code in (403, 404):
+            tr = memTransaction(1, trManager)
+            trManager.append(tr)
+            trManager._running_flushes = 1
+            trManager.tr_error(tr, code)
+        self.assertEqual(throttler.get_rate(), 10)
+
+        # Overload, server errors and timeouts do
+        for code, rate in ((429, 5), (503, 2.5), (599, 1.25)):
+            tr = memTransaction(1, trManager)
+            trManager.append(tr)
+            trManager._running_flushes = 1
+            trManager.tr_error(tr, code)
+            self.assertEqual(throttler.get_rate(), rate)
+
+
+def get_queueing_manager():
+    """
+    Transaction manager that the agent transactions are queued to, without
+    being flushed
+    """
+    config = {
+        "endpoints": {"https://app.datadoghq.com": ['api_key']},
+        "dd_url": "https://app.datadoghq.com",
+        "api_key": 'api_key',
+        "use_dd": True
+    }
+    app = Application()
+    app.skip_ssl_validation = False
+    app.agent_dns_caching = False
+    app._agentConfig = config
+    app.use_simple_http_client = True
+
+    trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                   THROTTLING_DELAY, max_endpoint_errors=100,
+                                   max_coalesced_size=MAX_COALESCED_SIZE)
+    for cls in (MetricTransaction, APIMetricTransaction, APIServiceCheckTransaction):
+        cls._trManager = trManager
+        cls.set_application(app)
+        cls.set_endpoints(config['endpoints'])
+    trManager.flush = lambda: None
+    return trManager
+
+
+class TestCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.trManager = get_queueing_manager()
+
+    def tearDown(self):
+        del self.trManager.flush
+
+    def _decode(self, tr):
+        return json.loads(zlib.decompress(tr._data))
+
+    def test_merge_series(self):
+        APIMetricTransaction(json.dumps({'series': [{'metric': 'foo', 'points': [[1, 1]]}]}),
+                             {'Content-Type': 'application/json'})
+        APIMetricTransaction(zlib.compress(json.dumps({'series': [{'metric': 'bar', 'points': [[1, 2]]},
+                                                                  {'metric': 'baz', 'points': [[1, 3]]}]})),
+                             {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'})
+        APIServiceCheckTransaction(json.dumps([{'check': 'foo', 'status': 0}]), {'Content-Type': 'application/json'})
+        APIServiceCheckTransaction(json.dumps([{'check': 'bar', 'status': 2}]), {'Content-Type': 'application/json'})
+
+        to_flush = self.trManager._coalesce(self.trManager.get_transactions())
+
+        self.assertEqual(len(to_flush), 2)
+        self.assertEqual(len(self.trManager.get_transactions()), 2)
+        self.assertEqual(self.trManager._total_count, 2)
+        self.assertEqual(self.trManager._transactions_coalesced, 4)
+        self.assertTrue(self.trManager.get_stats()['compression_ratio'] > 0)
+
+        series = [tr for tr in to_flush if isinstance(tr, APIMetricTransaction)][0]
+        self.assertEqual(series._headers['Content-Encoding'], 'deflate')
+        self.assertEqual([s['metric'] for s in self._decode(series)['series']], ['foo', 'bar', 'baz'])
+
+        check_runs = [tr for tr in to_flush if isinstance(tr, APIServiceCheckTransaction)][0]
+        self.assertEqual([c['check'] for c in self._decode(check_runs)], ['foo', 'bar'])
+
+    def test_size_limit(self):
+        self.trManager._MAX_COALESCED_SIZE = 500
+        payload = json.dumps({'series': [{'metric': 'a' * 100, 'points': [[1, 1]]}]})
+        for _ in xrange(4):
+            APIMetricTransaction(payload, {'Content-Type': 'application/json'})
+
+        to_flush = self.trManager._coalesce(self.trManager.get_transactions())
+        self.assertEqual(len(to_flush), 2)
+        for tr in to_flush:
+            self.assertEqual(len(self._decode(tr)['series']), 2)
+
+    def test_undecodable_payload(self):
+        APIMetricTransaction('not json', {'Content-Type': 'application/json'})
+        APIMetricTransaction(json.dumps({'series': []}), {'Content-Type': 'application/json'})
+
+        to_flush = self.trManager._coalesce(self.trManager.get_transactions())
+        self.assertEqual(len(to_flush), 2)
+        self.assertEqual(self.trManager._transactions_coalesced, 0)
+
+    def test_undecodable_payload_left_out(self):
+        APIMetricTransaction(json.dumps({'series': [{'metric': 'foo', 'points': [[1, 1]]}]}),
+                             {'Content-Type': 'application/json'})
+        APIMetricTransaction('not json', {'Content-Type': 'application/json'})
+        APIMetricTransaction(json.dumps({'series': [{'metric': 'bar', 'points': [[1, 2]]}]}),
+                             {'Content-Type': 'application/json'})
+
+        to_flush = self.trManager._coalesce(self.trManager.get_transactions())
+        self.assertEqual(len(to_flush), 2)
+        self.assertEqual(self.trManager._transactions_coalesced, 2)
+        self.assertEqual([s['metric'] for s in self._decode(to_flush[0])['series']], ['foo', 'bar'])
+        self.assertEqual(to_flush[1]._data, 'not json')
+        self.assertEqual(len(self.trManager.get_transactions()), 2)
+
+
+class TestPriorities(unittest.TestCase):
+
+    def test_eviction(self):
+        trManager = TransactionManager(timedelta(seconds=0), 1000, timedelta(seconds=0),
+                                       max_endpoint_errors=100)
+        # Metrics fill the queue
+        for i in xrange(10):
+            trManager.append(memTransaction(100, trManager))
+        # Service checks and events push metrics out
+        for i in xrange(2):
+            trManager.append(memTransaction(50, trManager, PRIORITY_SERVICE_CHECKS))
+        for i in xrange(2):
+            trManager.append(memTransaction(100, trManager, PRIORITY_EVENTS))
+
+        stats = trManager.get_priority_stats()
+        self.assertEqual(stats[PRIORITY_SERVICE_CHECKS]['count'], 2)
+        self.assertEqual(stats[PRIORITY_EVENTS]['count'], 2)
+        self.assertEqual(stats[PRIORITY_METRICS]['count'], 7)
+        self.assertEqual(stats[PRIORITY_METRICS]['evicted'], 3)
+        self.assertEqual(trManager._total_size, 1000)
+
+        # Once metrics are within their budget (60%), events over their own budget are evicted
+        for i in xrange(3):
+            trManager.append(memTransaction(100, trManager, PRIORITY_EVENTS))
+        stats = trManager.get_priority_stats()
+        self.assertEqual(stats[PRIORITY_METRICS]['count'], 6)
+        self.assertEqual(stats[PRIORITY_EVENTS]['count'], 3)
+        self.assertEqual(stats[PRIORITY_METRICS]['evicted'], 4)
+        self.assertEqual(stats[PRIORITY_EVENTS]['evicted'], 2)
+        self.assertEqual(stats[PRIORITY_SERVICE_CHECKS]['evicted'], 0)
+
+    def test_msg_type_priorities(self):
+        priorities = [
+            MetricTransaction._from_data('{}', {}, msg_type, 'https://example.com', 'a' * 32).get_priority()
+            for msg_type in ('', 'metrics', 'metadata')
+        ]
+        self.assertEqual(priorities, [PRIORITY_METRICS, PRIORITY_METRICS, PRIORITY_METADATA])
+
+    def test_payload_priorities(self):
+        trManager = get_queueing_manager()
+        trManager.flush_next = lambda: None
+        MetricTransaction(json.dumps({'systemStats': {}}), {}, 'metadata')
+        APIMetricTransaction(json.dumps({'series': []}), {'Content-Type': 'application/json'})
+        # Events posted by dogstatsd to the legacy intake
+        MetricTransaction(json.dumps({'events': {'api': []}}),
+                          {'Content-Type': 'application/json', PAYLOAD_TYPE_HEADER: 'events'})
+        MetricTransaction(json.dumps({'metrics': []}), {})
+
+        stats = trManager.get_priority_stats()
+        self.assertEqual([stats[p]['count'] for p in (PRIORITY_EVENTS, PRIORITY_METADATA, PRIORITY_METRICS)],
+                         [1, 1, 2])
+
+        # Transactions are popped from the end of the flush list
+        del trManager.flush
+        trManager.flush()
+        priorities = [tr.get_priority() for tr in reversed(trManager._trs_to_flush)]
+        self.assertEqual(priorities, [PRIORITY_EVENTS, PRIORITY_METADATA, PRIORITY_METRICS, PRIORITY_METRICS])
+
+    def test_flush_order(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       timedelta(seconds=0), max_endpoint_errors=100)
+        flush_order = []
+        for priority in (PRIORITY_METRICS, PRIORITY_EVENTS, PRIORITY_SERVICE_CHECKS, PRIORITY_METRICS):
+            tr = memTransaction(1, trManager, priority)
+            tr.flush_order = flush_order
+            tr.is_flushable = True
+            trManager.append(tr)
+
+        trManager.flush()
+        self.assertEqual(flush_order, [3, 2, 4, 1])
+        self.assertEqual(trManager.get_priority_stats()[PRIORITY_METRICS]['flushed'], 2)
+
+
+class TestStats(unittest.TestCase):
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram(buckets=[0.1, 1])
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.add(value)
+
+        stats = histogram.to_dict()
+        self.assertEqual(stats['count'], 4)
+        self.assertEqual(stats['max'], 2)
+        self.assertEqual(stats['avg'], 0.6625)
+        self.assertEqual([b['count'] for b in stats['buckets']], [2, 1, 1])
+        self.assertEqual([b['le'] for b in stats['buckets']], ['0.1', '1', '+Inf'])
+
+    def test_manager_stats(self):
+        trManager = TransactionManager(timedelta(seconds=0), 1000, timedelta(seconds=0),
+                                       max_endpoint_errors=100)
+        for i in xrange(12):
+            trManager.append(memTransaction(100, trManager))
+        trManager.flush()
+        for tr in trManager.get_transactions():
+            tr.is_flushable = True
+        trManager.flush()
+
+        stats = trManager.get_stats()
+        self.assertEqual(stats['queue_length'], 0)
+        self.assertEqual(stats['transactions_received'], 12)
+        self.assertEqual(stats['transactions_flushed'], 10)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['retries'], 10)
+        self.assertEqual(stats['bytes_in'], 1200)
+        self.assertEqual(stats['bytes_out'], 1000)
+        self.assertEqual(stats['request_latency']['https://example.com']['count'], 20)
+        self.assertEqual(stats['queued_time']['count'], 10)
+        self.assertIs(stats['compression_ratio'], None)
+        # Must be serializable as is
+        json.dumps(stats)
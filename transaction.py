@@ -3,6 +3,7 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
+from bisect import bisect_left
 from datetime import datetime, timedelta
 import logging
 from operator import attrgetter
@@ -21,6 +22,42 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
 
+# Priority classes, from the highest priority to the lowest one. Higher priority
+# transactions are flushed first and evicted last when the queue is full.
+PRIORITY_SERVICE_CHECKS = 'service_checks'
+PRIORITY_EVENTS = 'events'
+PRIORITY_METADATA = 'metadata'
+PRIORITY_METRICS = 'metrics'
+PRIORITIES = [PRIORITY_SERVICE_CHECKS, PRIORITY_EVENTS, PRIORITY_METADATA, PRIORITY_METRICS]
+
+# Share of the queue's byte budget guaranteed to each priority class
+DEFAULT_QUEUE_SHARES = {
+    PRIORITY_SERVICE_CHECKS: 0.1,
+    PRIORITY_EVENTS: 0.2,
+    PRIORITY_METADATA: 0.1,
+    PRIORITY_METRICS: 0.6,
+}
+
+# Upper bounds (in seconds) of the latency histograms buckets
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900]
+
+# Adaptive throttling defaults
+ADAPTIVE_MAX_RATE = 50.0  # transactions/second
+ADAPTIVE_MAX_PARALLELISM = 10
+ADAPTIVE_RATE_INCREASE = 1.0  # transactions/second added per fast success
+ADAPTIVE_DECREASE_FACTOR = 0.5
+ADAPTIVE_LATENCY_FACTOR = 2.0  # a response this many times slower than average is congestion
+ADAPTIVE_LATENCY_FLOOR = 1.0  # seconds, responses faster than this are never congestion
+ADAPTIVE_LATENCY_WEIGHT = 0.2
+# Response codes telling that the intake is overloaded, on top of the 5xx ones.
+# Other errors, e.g. a payload rejected as malformed, don't slow down the flushes.
+THROTTLING_RESPONSE_CODES = frozenset([429])
+
+# Time after which a flush is stopped, the rest of its transactions wait for the next one.
+# Adaptive throttling sends faster, flushes can drain more of the backlog at once.
+MAX_FLUSH_DURATION = timedelta(seconds=10)
+ADAPTIVE_MAX_FLUSH_DURATION = timedelta(seconds=60)
+
 class Transaction(object):
 
     def __init__(self):
@@ -29,6 +66,10 @@ class Transaction(object):
         self._error_count = 0
         self._next_flush = datetime.utcnow()
         self._size = None
+        self._flush_started = None
+        self._created_at = time.time()
+        # Uncompressed size of the payload, when known
+        self._raw_size = None
 
     def get_id(self):
         return self._id
@@ -68,21 +109,158 @@ class Transaction(object):
     def flush(self):
         raise NotImplementedError("To be implemented in a subclass")
 
+    def get_priority(self):
+        """Priority class of the transaction, one of PRIORITIES"""
+        return PRIORITY_METRICS
+
+    def get_coalesce_key(self):
+        """Transactions sharing the same non-None key can be merged together"""
+        return None
+
+    @classmethod
+    def merge(cls, transactions):
+        """Return a single transaction carrying the payloads of `transactions`, and
+        the transactions it carries. The others are flushed on their own."""
+        raise NotImplementedError("To be implemented in a subclass")
+
+class LatencyHistogram(object):
+    """Fixed-buckets histogram, constant memory and O(log(buckets)) per sample"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        bounds = [str(b) for b in self._buckets] + ['+Inf']
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else None,
+            'max': round(self.max, 6),
+            'buckets': [{'le': le, 'count': count} for le, count in zip(bounds, self._counts)],
+        }
+
+
+class AdaptiveThrottler(object):
+    """AIMD controller for the forwarder's send rate and parallelism.
+
+    The rate and the parallelism grow additively while responses come back
+    quickly, and are cut multiplicatively on errors or when the response
+    latency grows well above its moving average.
+    """
+
+    def __init__(self, throttling_delay, min_parallelism=1,
+                 max_rate=ADAPTIVE_MAX_RATE, max_parallelism=ADAPTIVE_MAX_PARALLELISM,
+                 rate_increase=ADAPTIVE_RATE_INCREASE, decrease_factor=ADAPTIVE_DECREASE_FACTOR,
+                 latency_factor=ADAPTIVE_LATENCY_FACTOR, latency_floor=ADAPTIVE_LATENCY_FLOOR):
+        delay = throttling_delay.total_seconds()
+        # The configured delay is the baseline, never go below a quarter of it
+        self._base_rate = 1.0 / delay if delay > 0 else max_rate
+        self._min_rate = min(self._base_rate / 4, max_rate)
+        self._max_rate = max(max_rate, self._min_rate)
+        self._min_parallelism = min_parallelism
+        self._max_parallelism = max(max_parallelism, min_parallelism)
+        self._rate_increase = rate_increase
+        self._decrease_factor = decrease_factor
+        self._latency_factor = latency_factor
+        self._latency_floor = latency_floor
+
+        self._rate = min(self._base_rate, self._max_rate)
+        self._parallelism = self._min_parallelism
+        self._successes_in_window = 0
+        self._avg_latency = None
+
+    def get_rate(self):
+        return self._rate
+
+    def get_delay(self):
+        return timedelta(seconds=1.0 / self._rate)
+
+    def get_parallelism(self):
+        return self._parallelism
+
+    def get_avg_latency(self):
+        return self._avg_latency
+
+    def on_success(self, latency=None):
+        if latency is not None and self._is_congested(latency):
+            log.debug("Response took %.2fs (average %.2fs), slowing down", latency, self._avg_latency)
+            self._decrease()
+        else:
+            self._increase()
+        self._update_latency(latency)
+
+    def on_error(self, latency=None):
+        self._decrease()
+        self._update_latency(latency)
+
+    def _is_congested(self, latency):
+        if self._avg_latency is None or latency < self._latency_floor:
+            return False
+        return latency > self._avg_latency * self._latency_factor
+
+    def _update_latency(self, latency):
+        if latency is None:
+            return
+        if self._avg_latency is None:
+            self._avg_latency = latency
+        else:
+            self._avg_latency += ADAPTIVE_LATENCY_WEIGHT * (latency - self._avg_latency)
+
+    def _increase(self):
+        self._rate = min(self._rate + self._rate_increase, self._max_rate)
+        # One more concurrent flush once a full window of flushes succeeded
+        self._successes_in_window += 1
+        if self._successes_in_window >= self._parallelism:
+            self._successes_in_window = 0
+            self._parallelism = min(self._parallelism + 1, self._max_parallelism)
+
+    def _decrease(self):
+        self._rate = max(self._rate * self._decrease_factor, self._min_rate)
+        self._parallelism = max(int(self._parallelism * self._decrease_factor), self._min_parallelism)
+        self._successes_in_window = 0
+
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
        are all commited, without exceeding parameters (throttling, memory consumption) """
 
     def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
-                 max_parallelism=1, max_endpoint_errors=4):
+                 max_parallelism=1, max_endpoint_errors=4, throttler=None,
+                 max_coalesced_size=None, queue_shares=None, max_flush_duration=None):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
         self._MAX_PARALLELISM = max_parallelism
         self._MAX_ENDPOINT_ERRORS = max_endpoint_errors
-        self._MAX_FLUSH_DURATION = timedelta(seconds=10)
 
         self._flush_without_ioloop = False # useful for tests
 
+        # Optional AdaptiveThrottler, overrides throttling delay and parallelism
+        self._throttler = throttler
+
+        if max_flush_duration is None:
+            max_flush_duration = MAX_FLUSH_DURATION if throttler is None else ADAPTIVE_MAX_FLUSH_DURATION
+        self._MAX_FLUSH_DURATION = max_flush_duration
+
+        # Merge small transactions up to this size before flushing them (disabled if None)
+        self._MAX_COALESCED_SIZE = max_coalesced_size
+
+        # Byte budget of each priority class, classes over budget are evicted first
+        queue_shares = queue_shares or DEFAULT_QUEUE_SHARES
+        self._QUEUE_BUDGETS = dict(
+            (priority, queue_shares.get(priority, 0) * max_queue_size) for priority in PRIORITIES
+        )
+
         self._transactions = []  # List of all non commited transactions
         self._total_count = 0  # Maintain size/count not to recompute it everytime
         self._total_size = 0
@@ -92,6 +270,21 @@ class TransactionManager(object):
         self._transactions_flushed = 0
 
         self._transactions_rejected = 0
+        self._transactions_coalesced = 0
+
+        # Queue statistics per priority class
+        self._priority_stats = dict(
+            (priority, {'count': 0, 'size': 0, 'flushed': 0, 'evicted': 0}) for priority in PRIORITIES
+        )
+
+        # Internal telemetry, cheap to update and to read whatever the queue length
+        self._latency_histograms = {}  # Per endpoint
+        self._queued_time_histogram = LatencyHistogram()
+        self._bytes_received = 0
+        self._bytes_flushed = 0
+        self._retries = 0
+        self._coalesced_raw_bytes = 0
+        self._coalesced_bytes = 0
 
         # Global counter to assign a number to each transaction: we may have an issue
         #  if this overlaps
@@ -110,6 +303,39 @@ class TransactionManager(object):
     def get_transactions(self):
         return self._transactions
 
+    def get_throttling_delay(self):
+        if self._throttler is not None:
+            return self._throttler.get_delay()
+        return self._THROTTLING_DELAY
+
+    def get_max_parallelism(self):
+        if self._throttler is not None:
+            return self._throttler.get_parallelism()
+        return self._MAX_PARALLELISM
+
+    def get_flush_rate(self):
+        """Current maximum number of transactions sent per second
+
+        Flushes start one throttling delay apart whatever the parallelism, which
+        only lets slow requests overlap."""
+        delay = self.get_throttling_delay().total_seconds()
+        if delay <= 0:
+            return None
+        return round(1 / delay, 2)
+
+    def _persist_status(self):
+        ForwarderStatus(
+            queue_length=self._total_count,
+            queue_size=self._total_size,
+            flush_count=self._flush_count,
+            transactions_received=self._transactions_received,
+            transactions_flushed=self._transactions_flushed,
+            transactions_rejected=self._transactions_rejected,
+            transactions_coalesced=self._transactions_coalesced,
+            priority_stats=self.get_priority_stats(),
+            flush_rate=self.get_flush_rate(),
+            max_parallelism=self.get_max_parallelism()).persist()
+
     def print_queue_stats(self):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" %
             (time.time(), self._total_count, (self._total_size/1024)))
@@ -131,21 +357,134 @@ class TransactionManager(object):
 
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._remove(tr2)
-                    log.warn("Removed transaction %s from queue" % tr2.get_id())
+            self._evict(tr_size)
 
         # Done
-        self._transactions.append(tr)
-        self._total_count += 1
+        self._add(tr)
         self._transactions_received += 1
-        self._total_size = self._total_size + tr_size
+        self._bytes_received += tr_size
 
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
 
+    def get_stats(self):
+        """Counters and latency histograms of the forwarder, as a dict"""
+        stats = {
+            'queue_length': self._total_count,
+            'queue_size': self._total_size,
+            'flush_count': self._flush_count,
+            'transactions_received': self._transactions_received,
+            'transactions_flushed': self._transactions_flushed,
+            'transactions_rejected': self._transactions_rejected,
+            'transactions_coalesced': self._transactions_coalesced,
+            'retries': self._retries,
+            'evictions': sum(p['evicted'] for p in self._priority_stats.itervalues()),
+            'bytes_in': self._bytes_received,
+            'bytes_out': self._bytes_flushed,
+            'compression_ratio': None,
+            'flush_rate': self.get_flush_rate(),
+            'max_parallelism': self.get_max_parallelism(),
+            'priorities': self.get_priority_stats(),
+            'request_latency': dict(
+                (endpoint, h.to_dict()) for endpoint, h in self._latency_histograms.iteritems()
+            ),
+            'queued_time': self._queued_time_histogram.to_dict(),
+        }
+        if self._coalesced_bytes:
+            stats['compression_ratio'] = round(float(self._coalesced_raw_bytes) / self._coalesced_bytes, 3)
+        return stats
+
+    def get_priority_stats(self):
+        return dict((priority, dict(stats)) for priority, stats in self._priority_stats.iteritems())
+
+    def _add(self, tr):
+        self._transactions.append(tr)
+        self._total_count += 1
+        self._total_size += tr.get_size()
+        stats = self._priority_stats[tr.get_priority()]
+        stats['count'] += 1
+        stats['size'] += tr.get_size()
+
+    def _evict(self, tr_size):
+        """Remove transactions until `tr_size` bytes fit in the queue.
+
+        Classes using more than their share of the queue are evicted first,
+        lowest priority first, then the lowest priority transactions.
+        Within a class, transactions scheduled to be flushed last go first."""
+        candidates = dict((priority, []) for priority in PRIORITIES)
+        for tr in sorted(self._transactions, key=attrgetter('_next_flush'), reverse=True):
+            candidates[tr.get_priority()].append(tr)
+        for trs in candidates.itervalues():
+            trs.reverse()  # pop() from the end
+
+        lowest_first = PRIORITIES[::-1]
+        while (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+            over_budget = [p for p in lowest_first
+                           if candidates[p] and self._priority_stats[p]['size'] > self._QUEUE_BUDGETS[p]]
+            non_empty = [p for p in lowest_first if candidates[p]]
+            if over_budget:
+                priority = over_budget[0]
+            elif non_empty:
+                priority = non_empty[0]
+            else:
+                break
+
+            tr2 = candidates[priority].pop()
+            self._remove(tr2)
+            self._priority_stats[priority]['evicted'] += 1
+            log.warn("Removed transaction %s (%s) from queue" % (tr2.get_id(), priority))
+
+    def _coalesce(self, to_flush):
+        """Replace groups of mergeable transactions in `to_flush` (and in the queue)
+        by merged transactions of at most _MAX_COALESCED_SIZE bytes"""
+        groups = {}
+        result = []
+        for tr in to_flush:
+            key = tr.get_coalesce_key()
+            if key is None:
+                result.append(tr)
+            else:
+                groups.setdefault(key, []).append(tr)
+
+        for group in groups.itervalues():
+            batches = []
+            batch, batch_size = [], 0
+            for tr in sorted(group, key=attrgetter('_id')):
+                if batch and batch_size + tr.get_size() > self._MAX_COALESCED_SIZE:
+                    batches.append(batch)
+                    batch, batch_size = [], 0
+                batch.append(tr)
+                batch_size += tr.get_size()
+            batches.append(batch)
+
+            for batch in batches:
+                merged, merged_batch = None, []
+                if len(batch) > 1:
+                    try:
+                        merged, merged_batch = type(batch[0]).merge(batch)
+                    except Exception:
+                        log.exception("Unable to merge %s transactions, flushing them separately", len(batch))
+                if merged is None or len(merged_batch) < 2:
+                    result.extend(batch)
+                    continue
+
+                for tr in merged_batch:
+                    self._remove(tr)
+                merged.set_id(self.get_tr_id())
+                merged._error_count = max(tr.get_error_count() for tr in merged_batch)
+                merged._created_at = min(tr._created_at for tr in merged_batch)
+                if merged._raw_size is not None:
+                    self._coalesced_raw_bytes += merged._raw_size
+                    self._coalesced_bytes += merged.get_size()
+                self._add(merged)
+                self._transactions_coalesced += len(merged_batch)
+                log.debug("Merged %s transactions into transaction %s", len(merged_batch), merged.get_id())
+                result.append(merged)
+                # Transactions that couldn't be merged, e.g. undecodable ones
+                result.extend(tr for tr in batch if tr not in merged_batch)
+
+        return result
+
     def _remove(self, tr):
         '''Safely remove transaction from list'''
         try:
@@ -156,6 +495,9 @@ class TransactionManager(object):
         else:
             self._total_count -= 1
             self._total_size -= tr.get_size()
+            stats = self._priority_stats[tr.get_priority()]
+            stats['count'] -= 1
+            stats['size'] -= tr.get_size()
 
     def flush(self):
 
@@ -170,6 +512,9 @@ class TransactionManager(object):
             if tr.time_to_flush(now):
                 to_flush.append(tr)
 
+        if self._MAX_COALESCED_SIZE and len(to_flush) > 1:
+            to_flush = self._coalesce(to_flush)
+
         count = len(to_flush)
         should_log = self._flush_count + 1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
         if count > 0:
@@ -181,8 +526,9 @@ class TransactionManager(object):
             self._endpoints_errors = {}
             self._finished_flushes = 0
 
-            # We sort LIFO-style, taking into account errors
-            self._trs_to_flush = sorted(to_flush, key=lambda tr: (- tr._error_count, tr._id))
+            # We sort LIFO-style, by priority class, taking into account errors
+            self._trs_to_flush = sorted(to_flush, key=lambda tr: (- PRIORITIES.index(tr.get_priority()),
+                                                                  - tr._error_count, tr._id))
             self._flush_time = datetime.utcnow()
             self.flush_next()
         else:
@@ -196,20 +542,15 @@ class TransactionManager(object):
 
         self._flush_count += 1
 
-        ForwarderStatus(
-            queue_length=self._total_count,
-            queue_size=self._total_size,
-            flush_count=self._flush_count,
-            transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed,
-            transactions_rejected=self._transactions_rejected).persist()
+        self._persist_status()
 
     def flush_next(self):
 
         if self._trs_to_flush is not None and len(self._trs_to_flush) > 0:
             # Running for too long?
             if datetime.utcnow() - self._flush_time >= self._MAX_FLUSH_DURATION:
-                log.warn('Flush %s is taking more than 10s, stopping it', self._flush_count)
+                log.warn('Flush %s is taking more than %ss, stopping it', self._flush_count,
+                         self._MAX_FLUSH_DURATION.total_seconds())
                 for tr in self._trs_to_flush:
                     # Recompute these transactions' next flush so that if we hit the max queue size
                     # newer transactions are preserved
@@ -217,13 +558,15 @@ class TransactionManager(object):
                 self._trs_to_flush = []
                 return self.flush_next()
 
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
+            td = self._last_flush + self.get_throttling_delay() - datetime.utcnow()
             delay = td.total_seconds()
+            max_parallelism = self.get_max_parallelism()
 
-            if delay <= 0 and self._running_flushes < self._MAX_PARALLELISM:
+            if delay <= 0 and self._running_flushes < max_parallelism:
                 tr = self._trs_to_flush.pop()
                 self._running_flushes += 1
                 self._last_flush = datetime.utcnow()
+                tr._flush_started = time.time()
                 log.debug("Flushing transaction %d", tr.get_id())
                 try:
                     tr.flush()
@@ -234,7 +577,7 @@ class TransactionManager(object):
             # Every running flushes relaunches a flush once it's finished
             # If we are already at MAX_PARALLELISM, do nothing
             # Otherwise, schedule a flush as soon as possible (throttling)
-            elif self._running_flushes < self._MAX_PARALLELISM:
+            elif self._running_flushes < max_parallelism:
                 # Wait a little bit more
                 tornado_ioloop = ioloop.IOLoop.current()
                 if tornado_ioloop._running:
@@ -256,9 +599,30 @@ class TransactionManager(object):
         else:
             log.debug("Flush in progress, %s flushes running", self._running_flushes)
 
-    def tr_error(self, tr):
+    def _record_response(self, tr):
+        """Record the request latency of a flushed transaction and return it"""
+        if tr._flush_started is None:
+            return None
+        latency = time.time() - tr._flush_started
+        endpoint = getattr(tr, '_endpoint', None)
+        if endpoint not in self._latency_histograms:
+            self._latency_histograms[endpoint] = LatencyHistogram()
+        self._latency_histograms[endpoint].add(latency)
+        return latency
+
+    def _record_done(self, tr):
+        self._queued_time_histogram.add(time.time() - tr._created_at)
+
+    def tr_error(self, tr, response_code=None):
         self._running_flushes -= 1
         self._finished_flushes += 1
+        self._retries += 1
+        latency = self._record_response(tr)
+        if self._throttler is not None:
+            # Timeouts and connection errors come with a 599 code, failures without
+            # a response code are counted too
+            if response_code is None or response_code >= 500 or response_code in THROTTLING_RESPONSE_CODES:
+                self._throttler.on_error(latency)
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
         log.warn("Transaction %d in error (%s error%s), it will be replayed after %s",
@@ -285,6 +649,9 @@ class TransactionManager(object):
     def tr_error_reject_request(self, tr, response_code):
         self._running_flushes -= 1
         self._finished_flushes += 1
+        # The payload itself was rejected, which says nothing about the intake's load
+        self._record_response(tr)
+        self._record_done(tr)
         tr.inc_error_count()
         log.warn("Transaction %d has been rejected (code %d, size %sKB), it will not be replayed",
                  tr.get_id(),
@@ -294,18 +661,18 @@ class TransactionManager(object):
         self._transactions_flushed += 1
         self.print_queue_stats()
         self._transactions_rejected += 1
-        ForwarderStatus(
-            queue_length=self._total_count,
-            queue_size=self._total_size,
-            flush_count=self._flush_count,
-            transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed,
-            transactions_rejected=self._transactions_rejected).persist()
+        self._persist_status()
 
     def tr_success(self, tr):
         self._running_flushes -= 1
         self._finished_flushes += 1
+        latency = self._record_response(tr)
+        if self._throttler is not None:
+            self._throttler.on_success(latency)
+        self._record_done(tr)
         log.debug("Transaction %d completed",  tr.get_id())
         self._remove(tr)
+        self._priority_stats[tr.get_priority()]['flushed'] += 1
         self._transactions_flushed += 1
+        self._bytes_flushed += tr.get_size()
         self.print_queue_stats()
@@ -7,6 +7,8 @@ import logging
 import types
 import os
 import socket
+import threading
+import time
 
 # 3rd party
 import requests
@@ -26,6 +28,9 @@ class Azure(object):
             log.info("Instance metadata collection is disabled: not collecting Azure metadata.")
             return {}
 
+        if cloud_detector.get_provider() != 'azure':
+            return None
+
         try:
             r = requests.get(
                 Azure.URL,
@@ -38,6 +43,11 @@ class Azure(object):
             log.debug("Collecting Azure Metadata failed %s", str(e))
             return None
 
+    @staticmethod
+    def _probe():
+        r = requests.get(Azure.URL, timeout=CloudDetector.PROBE_TIMEOUT, headers={'Metadata': 'true'})
+        r.raise_for_status()
+
     @staticmethod
     def get_host_aliases(agentConfig):
         try:
@@ -48,6 +58,7 @@ class Azure(object):
 
 class GCE(object):
     URL = "http://169.254.169.254/computeMetadata/v1/?recursive=true"
+    PROBE_URL = "http://169.254.169.254/computeMetadata/v1/instance/id"
     TIMEOUT = 0.3 # second
     SOURCE_TYPE_NAME = 'google cloud platform'
     metadata = None
@@ -65,6 +76,9 @@ class GCE(object):
             GCE.metadata = {}
             return {}
 
+        if cloud_detector.get_provider() != 'gce':
+            return {}
+
         try:
             r = requests.get(
                 GCE.URL,
@@ -79,7 +93,10 @@ class GCE(object):
 
         return GCE.metadata.copy()
 
-
+    @staticmethod
+    def _probe():
+        r = requests.get(GCE.PROBE_URL, timeout=CloudDetector.PROBE_TIMEOUT, headers={'Metadata-Flavor': 'Google'})
+        r.raise_for_status()
 
     @staticmethod
     def get_tags(agentConfig):
@@ -158,6 +175,12 @@ class EC2(object):
                 return True
         return False
 
+    @staticmethod
+    def _probe():
+        # OpenStack serves the same endpoint, it's told apart in `get_metadata`
+        r = requests.get(EC2.METADATA_URL_BASE + "/instance-id", timeout=CloudDetector.PROBE_TIMEOUT)
+        r.raise_for_status()
+
     @staticmethod
     def get_iam_role():
         """
@@ -183,6 +206,9 @@ class EC2(object):
             log.info("Instance metadata collection is disabled. Not collecting it.")
             return []
 
+        if cloud_detector.get_provider() != 'ec2':
+            return []
+
         EC2_tags = []
 
         try:
@@ -243,7 +269,7 @@ class EC2(object):
         return EC2_tags
 
     @staticmethod
-    def get_metadata(agentConfig):
+    def get_metadata(agentConfig, confirm=False):
         """Use the ec2 http service to introspect the instance. This adds latency if not running on EC2
         """
         # >>> import requests
@@ -258,6 +284,9 @@ class EC2(object):
             log.info("Instance metadata collection is disabled. Not collecting it.")
             return {}
 
+        if cloud_detector.get_provider(confirm=confirm) != 'ec2':
+            return EC2.metadata.copy()
+
         for k in ('instance-id', 'hostname', 'local-hostname', 'public-hostname', 'ami-id', 'local-ipv4', 'public-keys/', 'public-ipv4', 'reservation-id', 'security-groups'):
             try:
                 url = EC2.METADATA_URL_BASE + "/" + unicode(k)
@@ -300,7 +329,8 @@ class EC2(object):
     @staticmethod
     def get_instance_id(agentConfig):
         try:
-            return EC2.get_metadata(agentConfig).get("instance-id", None)
+            # The hostname sticks, don't give up on EC2 after a single probe
+            return EC2.get_metadata(agentConfig, confirm=True).get("instance-id", None)
         except Exception:
             return None
 
@@ -330,3 +360,109 @@ class CloudFoundry(object):
         elif os.environ.get("CLOUD_FOUNDRY"):
             return True
         return False
+
+
+
+class CloudDetector(object):
+    """
+    Find out which cloud provider, if any, the host runs on.
+
+    The metadata endpoints of all the providers are probed concurrently, and the
+    provider that answers is remembered for good. A metadata endpoint can be slow
+    or not ready yet when the agent starts, so when none answers the probes are
+    retried after each of the `NEGATIVE_RETRY_DELAYS`, and only then is the
+    negative result kept for `NEGATIVE_TTL` seconds, so that hosts outside of a
+    cloud don't wait for every endpoint to time out at every metadata collection.
+    """
+    PROBE_TIMEOUT = 0.3  # second
+    NEGATIVE_RETRY_DELAYS = (10, 30, 60, 120)  # seconds
+    NEGATIVE_TTL = 3600  # seconds
+    # Rounds of probes, one second apart, run before a negative result is used
+    # to resolve the hostname
+    CONFIRM_ROUNDS = 3
+
+    def __init__(self, probes):
+        # (provider name, probe) pairs by order of precedence, probes raise when
+        # the provider isn't there
+        self.probes = probes
+        self._lock = threading.Lock()
+        self._provider = None
+        self._probed_at = None
+        self._misses = 0
+
+    def get_provider(self, confirm=False):
+        """
+        Name of the cloud provider the host runs on, None outside of a cloud.
+
+        With `confirm`, a negative result that is still being retried is probed
+        again, up to `CONFIRM_ROUNDS` times, instead of being served from cache.
+        """
+        with self._lock:
+            if self._provider is not None:
+                return self._provider
+
+            settled = self._misses > len(self.NEGATIVE_RETRY_DELAYS)
+            if self._probed_at is not None and (settled or not confirm) \
+                    and time.time() - self._probed_at < self._negative_ttl():
+                return None
+
+            rounds = self.CONFIRM_ROUNDS if confirm and not settled else 1
+            for i in xrange(rounds):
+                if i:
+                    time.sleep(1)
+                self._provider = self._probe_all()
+                if self._provider is not None:
+                    break
+            self._probed_at = time.time()
+
+            if self._provider is None:
+                self._misses += 1
+                log.info(u"No cloud provider detected, not probing metadata endpoints for %ss", self._negative_ttl())
+            else:
+                log.info(u"Detected cloud provider: %s", self._provider)
+            return self._provider
+
+    def invalidate(self):
+        with self._lock:
+            self._provider = None
+            self._probed_at = None
+            self._misses = 0
+
+    def _negative_ttl(self):
+        if 0 < self._misses <= len(self.NEGATIVE_RETRY_DELAYS):
+            return self.NEGATIVE_RETRY_DELAYS[self._misses - 1]
+        return self.NEGATIVE_TTL
+
+    def _probe_all(self):
+        found = set()
+
+        def probe(name, func):
+            try:
+                func()
+                found.add(name)
+            except Exception as e:
+                log.debug(u"Probing %s metadata failed: %s", name, e)
+
+        threads = []
+        for name, func in self.probes:
+            thread = threading.Thread(target=probe, args=(name, func), name="probe-%s" % name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # Probes have their own timeout, this only bounds the wait on a stuck one
+        deadline = time.time() + 2 * self.PROBE_TIMEOUT
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+        for name, _ in self.probes:
+            if name in found:
+                return name
+        return None
+
+
+cloud_detector = CloudDetector([
+    ('ec2', EC2._probe),
+    ('gce', GCE._probe),
+    ('azure', Azure._probe),
+])
@@ -0,0 +1,106 @@
+# (C) Datadog, Inc. 2010-2017
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+# stdlib
+import logging
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+# `compression_level` accepts these names or a zlib level from 1 to 9
+COMPRESSION_LEVELS = {
+    'fast': 1,
+    'default': 6,
+    'small': 9,
+}
+DEFAULT_COMPRESSION_LEVEL = COMPRESSION_LEVELS['default']
+
+
+class DeflateCompressor(object):
+    """
+    Compress payloads with zlib at a given level, and keep track of the
+    compression ratio and of the time spent compressing until flushed.
+
+    No zlib state is kept from one payload to the next: the intake decodes
+    each payload as a standalone deflate stream, so every payload gets its
+    own stream. Only the level and the stats are shared.
+    """
+    content_encoding = 'deflate'
+
+    def __init__(self, level=DEFAULT_COMPRESSION_LEVEL):
+        self.level = level
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._payloads = 0
+        self._raw_bytes = 0
+        self._compressed_bytes = 0
+        self._time = 0.0
+
+    def compress(self, data):
+        start = time.time()
+        compressed = zlib.compress(data, self.level)
+        self.record(len(data), len(compressed), time.time() - start)
+        return compressed
+
+    def compressobj(self):
+        """
+        New compression stream, for a payload built piece by piece. Report it with `record`.
+        """
+        return zlib.compressobj(self.level)
+
+    def record(self, raw_size, compressed_size, duration):
+        with self._lock:
+            self._payloads += 1
+            self._raw_bytes += raw_size
+            self._compressed_bytes += compressed_size
+            self._time += duration
+
+    def flush(self):
+        """ Return the compression stats since the last flush, and reset them. """
+        with self._lock:
+            stats = {
+                'payloads': self._payloads,
+                'raw_bytes': self._raw_bytes,
+                'compressed_bytes': self._compressed_bytes,
+                'ratio': float(self._raw_bytes) / self._compressed_bytes if self._compressed_bytes else 0.0,
+                'time': self._time,
+            }
+            self._reset()
+        return stats
+
+
+# Compressors by codec and level, shared by the whole process for their stats
+CODECS = {
+    'deflate': DeflateCompressor,
+}
+_compressors = {}
+_compressors_lock = threading.Lock()
+
+
+def parse_compression_level(value):
+    if value is None or value == '':
+        return DEFAULT_COMPRESSION_LEVEL
+    if str(value).lower() in COMPRESSION_LEVELS:
+        return COMPRESSION_LEVELS[str(value).lower()]
+    try:
+        level = int(value)
+    except (TypeError, ValueError):
+        level = None
+    if level is None or not 1 <= level <= 9:
+        log.warning("Invalid compression_level %r, using %s", value, DEFAULT_COMPRESSION_LEVEL)
+        return DEFAULT_COMPRESSION_LEVEL
+    return level
+
+
+def get_compressor(agentConfig=None, codec='deflate'):
+    """ Compressor of `codec` at the `compression_level` of the configuration. """
+    level = parse_compression_level((agentConfig or {}).get('compression_level'))
+    with _compressors_lock:
+        if (codec, level) not in _compressors:
+            _compressors[(codec, level)] = CODECS[codec](level)
+        return _compressors[(codec, level)]
@@ -6,6 +6,8 @@
 import logging
 import re
 import socket
+import threading
+import time
 
 # project
 from utils.cloud_metadata import EC2, GCE
@@ -16,9 +18,49 @@ from utils.subprocess_output import get_subprocess_output
 
 VALID_HOSTNAME_RFC_1123_PATTERN = re.compile(r"^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
 MAX_HOSTNAME_LEN = 255
+# Seconds for which a resolved host name is reused
+HOSTNAME_CACHE_TTL = 10 * 60
 
 log = logging.getLogger(__name__)
 
+
+class HostnameCache(object):
+    """
+    Process-wide cache of the host name. Resolving it can run a subprocess,
+    create Docker and Kubernetes clients, query cloud metadata endpoints, and
+    even parse the configuration when it's requested without one.
+    """
+    def __init__(self, ttl=HOSTNAME_CACHE_TTL):
+        self.ttl = ttl
+        # Held while resolving, so that concurrent callers wait for a single resolution
+        self.lock = threading.RLock()
+        self._hostname = None
+        self._expires_at = 0
+
+    def get(self):
+        with self.lock:
+            if self._hostname is not None and time.time() < self._expires_at:
+                return self._hostname
+            return None
+
+    def set(self, hostname):
+        with self.lock:
+            self._hostname = hostname
+            self._expires_at = time.time() + self.ttl
+
+    def invalidate(self):
+        with self.lock:
+            self._hostname = None
+
+
+hostname_cache = HostnameCache()
+
+
+def invalidate_hostname_cache():
+    """ Make the next `get_hostname` call resolve the host name again """
+    hostname_cache.invalidate()
+
+
 def is_valid_hostname(hostname):
     if hostname.lower() in set([
         'localhost',
@@ -55,17 +97,33 @@ def get_hostname(config=None):
       * agent config (datadog.conf, "hostname:")
       * 'hostname -f' (on unix)
       * socket.gethostname()
-    """
-    hostname = None
 
+    The result is cached for `HOSTNAME_CACHE_TTL` seconds, see
+    `invalidate_hostname_cache`.
+    """
     # first, try the config
     if config is None:
+        hostname = hostname_cache.get()
+        if hostname is not None:
+            return hostname
         from config import get_config
         config = get_config(parse_args=True)
     config_hostname = config.get('hostname')
     if config_hostname and is_valid_hostname(config_hostname):
+        hostname_cache.set(config_hostname)
         return config_hostname
 
+    with hostname_cache.lock:
+        hostname = hostname_cache.get()
+        if hostname is None:
+            hostname = _resolve_hostname(config)
+            hostname_cache.set(hostname)
+    return hostname
+
+
+def _resolve_hostname(config):
+    hostname = None
+
     # Try to get GCE instance name
     gce_hostname = GCE.get_hostname(config)
     if gce_hostname is not None:
@@ -7,6 +7,9 @@ import requests
 
 DEFAULT_TIMEOUT = 10
 
+# Tells the forwarder what an intake payload holds, when its URL doesn't
+PAYLOAD_TYPE_HEADER = 'DD-Payload-Type'
+
 
 def retrieve_json(url, timeout=DEFAULT_TIMEOUT, verify=True):
     r = requests.get(url, timeout=timeout, verify=verify)
@@ -3,15 +3,41 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
+from collections import defaultdict, deque
 import cProfile  # noqa, it seems that import-names thinks it's not stdlib
 from cStringIO import StringIO
 import logging
 import os
 import pstats  # noqa, same here
+import sys
 import tempfile
+import threading
+import timeit
+
+# 3p
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# project
+from utils.platform import Platform
 
 log = logging.getLogger('collector')
 
+# Number of runs of a check instance kept in its profile
+PROFILE_WINDOW = 20
+# Seconds between two samples of the sampling profiler
+SAMPLING_INTERVAL = 0.005
+# Number of functions reported by the sampling profiler
+HOTSPOTS_LIMIT = 5
+# Linux only, and missing from the resource module of Python 2
+RUSAGE_THREAD = 1
+
 
 class AgentProfiler(object):
     PSTATS_LIMIT = 20
@@ -85,6 +111,201 @@ class AgentProfiler(object):
 
         return wrapped_func
 
+def _cpu_time():
+    """
+    CPU time of the current thread on Linux, of the whole process elsewhere.
+    """
+    if resource is not None and Platform.is_linux():
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    times = os.times()
+    return times[0] + times[1]
+
+
+_process = None
+
+
+def _rss():
+    """
+    RSS of the process in bytes, when psutil is available.
+    """
+    global _process
+    if psutil is None:
+        return None
+    # The agent may have forked since the last call
+    if _process is None or _process.pid != os.getpid():
+        _process = psutil.Process()
+    return _process.memory_info().rss
+
+
+def _peak_memory():
+    """
+    Peak RSS of the process in bytes, on Linux only.
+    """
+    if resource is not None and Platform.is_linux():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+class SamplingProfiler(object):
+    """
+    Sample the stack of a thread from a background thread at a fixed interval,
+    and count the functions it's found in. Unlike cProfile it doesn't trace
+    every call, so it's cheap enough to profile checks in production.
+    """
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.self_counts = defaultdict(int)
+        self.total_counts = defaultdict(int)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id=None):
+        thread_id = thread_id or threading.current_thread().ident
+        self._thread = threading.Thread(target=self._sample, args=(thread_id,), name='SamplingProfiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample(self, thread_id):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            self.samples += 1
+            self.self_counts[self._location(frame)] += 1
+            seen = set()
+            while frame is not None:
+                location = self._location(frame)
+                if location not in seen:
+                    seen.add(location)
+                    self.total_counts[location] += 1
+                frame = frame.f_back
+
+    @staticmethod
+    def _location(frame):
+        code = frame.f_code
+        return "%s:%s(%s)" % (code.co_filename, code.co_firstlineno, code.co_name)
+
+    def hotspots(self, limit=HOTSPOTS_LIMIT):
+        """
+        The functions the thread was most often found running, with the share of
+        samples they were running in, and of samples they were in the stack of.
+        """
+        if not self.samples:
+            return []
+        top = sorted(self.self_counts.iteritems(), key=lambda item: item[1], reverse=True)[:limit]
+        return [
+            (location, float(count) / self.samples, float(self.total_counts[location]) / self.samples)
+            for location, count in top
+        ]
+
+
+class InstanceProfile(object):
+    """
+    Cost of the last runs of a check instance: wall and CPU time, number of
+    metric samples submitted and growth of the memory of the process. Memory is
+    process-wide, so it's only indicative when checks run concurrently.
+    """
+    FIELDS = ('wall_time', 'cpu_time', 'metric_count', 'memory_growth', 'peak_memory_growth')
+
+    def __init__(self, window=PROFILE_WINDOW):
+        self.runs = deque(maxlen=window)
+        self.hotspots = None
+        self._start = None
+        self._sampler = None
+
+    def start(self, sampling_interval=None):
+        self._start = (timeit.default_timer(), _cpu_time(), _rss(), _peak_memory())
+        self._sampler = None
+        if sampling_interval:
+            self._sampler = SamplingProfiler(sampling_interval)
+            self._sampler.start()
+
+    def stop(self, metric_count):
+        wall_start, cpu_start, rss_start, peak_start = self._start
+        run = {
+            'wall_time': timeit.default_timer() - wall_start,
+            'cpu_time': _cpu_time() - cpu_start,
+            'metric_count': metric_count,
+            'memory_growth': None,
+            'peak_memory_growth': None,
+        }
+        if rss_start is not None:
+            run['memory_growth'] = _rss() - rss_start
+        if peak_start is not None:
+            run['peak_memory_growth'] = _peak_memory() - peak_start
+
+        if self._sampler is not None:
+            self._sampler.stop()
+            self.hotspots = self._sampler.hotspots()
+            self._sampler = None
+        self.runs.append(run)
+        return run
+
+    def summary(self):
+        """
+        Last, average and max value of every field over the window.
+        """
+        if not self.runs:
+            return None
+        summary = {'runs': len(self.runs)}
+        for field in self.FIELDS:
+            values = [run[field] for run in self.runs if run[field] is not None]
+            if values:
+                summary[field] = {
+                    'last': self.runs[-1][field],
+                    'avg': float(sum(values)) / len(values),
+                    'max': max(values),
+                }
+        if self.hotspots is not None:
+            summary['hotspots'] = self.hotspots
+        return summary
+
+
+def _format_bytes(value):
+    sign = '-' if value < 0 else '+'
+    value = abs(value)
+    for unit in ('B', 'KB', 'MB'):
+        if value < 1024:
+            return "%s%.0f%s" % (sign, value, unit)
+        value /= 1024.0
+    return "%s%.1fGB" % (sign, value)
+
+
+def pretty_instance_profile(profile):
+    """
+    Lines describing the summary of an `InstanceProfile`.
+    """
+    if not profile or 'wall_time' not in profile:
+        return []
+    parts = [
+        "wall time %.3fs avg, %.3fs max" % (profile['wall_time']['avg'], profile['wall_time']['max']),
+        "cpu time %.3fs avg" % profile['cpu_time']['avg'],
+        "%.0f metrics avg" % profile['metric_count']['avg'],
+    ]
+    if 'memory_growth' in profile:
+        parts.append("memory %s max" % _format_bytes(profile['memory_growth']['max']))
+    if 'peak_memory_growth' in profile and profile['peak_memory_growth']['max'] > 0:
+        parts.append("peak memory %s max" % _format_bytes(profile['peak_memory_growth']['max']))
+    lines = ["Last %s runs: %s" % (profile['runs'], ", ".join(parts))]
+    lines.extend("  " + line for line in pretty_hotspots(profile.get('hotspots') or []))
+    return lines
+
+
+def pretty_hotspots(hotspots):
+    return [
+        "%4.1f%% (%4.1f%% cumulative) %s" % (self_share * 100, total_share * 100, location)
+        for location, self_share, total_share in hotspots
+    ]
+
+
 def pretty_statistics(stats):
     #FIXME: This should really be clever enough to handle more varied statistics
     # Right now memory_info is the only one that we will predictably have 'before' and 'after'
@@ -96,6 +317,13 @@ def pretty_statistics(stats):
     mem_before = before.get('memory_info')
     mem_after = after.get('memory_info')
 
+    normalize_cache = stats.get('normalize_cache')
+    cache_stats = ""
+    if normalize_cache:
+        cache_stats = """
+            Normalized names cache: {0} hits, {1} misses, {2} entries
+            """.format(normalize_cache['hits'], normalize_cache['misses'], normalize_cache['size'])
+
     if mem_before and mem_after:
         return """
             Memory Before (RSS): {0}
@@ -105,6 +333,6 @@ def pretty_statistics(stats):
             Memory After (VMS): {4}
             Difference (VMS): {5}
             """.format(mem_before['rss'], mem_after['rss'], mem_after['rss'] - mem_before['rss'],
-                       mem_before['vms'], mem_after['vms'], mem_after['vms'] - mem_before['vms'])
+                       mem_before['vms'], mem_after['vms'], mem_after['vms'] - mem_before['vms']) + cache_stats
     else:
-        return ""
+        return cache_stats
@@ -0,0 +1,89 @@
+# (C) Datadog, Inc. 2010-2017
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+# stdlib
+import logging
+import re
+import unicodedata
+
+log = logging.getLogger(__name__)
+
+# From http://stackoverflow.com/questions/92438/stripping-non-printable-characters-from-a-string-in-python
+control_chars = ''.join(map(unichr, range(0, 32) + range(127, 160)))
+control_char_re = re.compile('[%s]' % re.escape(control_chars))
+
+# Number of distinct strings remembered by the validator, it starts over once full
+STRING_CACHE_SIZE = 100000
+
+
+def remove_control_chars(s, log):
+    if isinstance(s, str):
+        sanitized = control_char_re.sub('', s)
+    elif isinstance(s, unicode):
+        sanitized = ''.join(['' if unicodedata.category(c) in ['Cc','Cf'] else c
+                            for c in u'{}'.format(s)])
+    if sanitized != s:
+        log.warning('Removed control chars from string: ' + s)
+    return sanitized
+
+
+def remove_undecodable_chars(s, log):
+    sanitized = s
+    if isinstance(s, str):
+        try:
+            s.decode('utf8')
+        except UnicodeDecodeError:
+            sanitized = s.decode('utf8', errors='ignore')
+            log.warning(u'Removed undecodable chars from string: ' + s.decode('utf8', errors='replace'))
+    return sanitized
+
+
+def sanitize_string(s, log):
+    """
+    Return a version of `s` that can be serialized to JSON: byte strings that
+    aren't valid UTF-8 are stripped of their control and undecodable characters,
+    everything else is returned as is.
+    """
+    if isinstance(s, str):
+        try:
+            s.decode('utf8')
+        except UnicodeDecodeError:
+            return remove_undecodable_chars(control_char_re.sub('', s), log)
+    return s
+
+
+class StringValidator(object):
+    """
+    Sanitize the names and tags submitted by checks when they're first seen,
+    so that payloads can be serialized in a single pass.
+
+    Checks submit the same names and tags at every run, so every string is
+    only validated once and looked up afterwards.
+    """
+    def __init__(self, max_size=STRING_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache = {}
+
+    def validate(self, s):
+        if not isinstance(s, str):
+            return s
+        try:
+            return self._cache[s]
+        except KeyError:
+            pass
+
+        if len(self._cache) >= self.max_size:
+            self._cache = {}
+        sanitized = self._cache[s] = sanitize_string(s, log)
+        return sanitized
+
+    def validate_tags(self, tags):
+        if not tags:
+            return tags
+        validate = self.validate
+        validated = [validate(tag) for tag in tags]
+        return tuple(validated) if isinstance(tags, tuple) else validated
+
+
+string_validator = StringValidator()
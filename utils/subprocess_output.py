@@ -3,42 +3,187 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
+from collections import defaultdict
 from functools import wraps
 import logging
+import os
+import select
 import subprocess
-import tempfile
+import threading
+import time
+
+# project
+from utils.platform import Platform
 
 log = logging.getLogger(__name__)
 
+# Wall-clock time after which a command is killed
+DEFAULT_TIMEOUT = 300
+# Output kept per stream, the rest is read and discarded
+DEFAULT_MAX_OUTPUT_SIZE = 64 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+# Time given to the pipe readers once the command exited. A background child
+# inheriting its stdout or stderr keeps them open after that.
+READERS_JOIN_TIMEOUT = 1.0
+
 
 class SubprocessOutputEmptyError(Exception):
     pass
 
 
-def get_subprocess_output(command, log, raise_on_empty_output=True):
+class SubprocessOutputTimeoutError(Exception):
+    pass
+
+
+def _command_name(command):
+    """ Executable of a command given as a list of arguments or as a string """
+    if isinstance(command, basestring):
+        command = command.split()
+    return os.path.basename(command[0]) if command else ''
+
+
+class SubprocessStats(object):
+    """
+    Number of runs, failures (non-zero exit status), timeouts and total run
+    time of the commands run through `get_subprocess_output`, per executable.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'count': 0, 'errors': 0, 'timeouts': 0, 'run_time': 0.0})
+
+    def record(self, command, duration, returncode=None, timed_out=False):
+        name = _command_name(command)
+        with self._lock:
+            stats = self._stats[name]
+            stats['count'] += 1
+            stats['run_time'] += duration
+            if timed_out:
+                stats['timeouts'] += 1
+            elif returncode:
+                stats['errors'] += 1
+
+    def flush(self):
+        """ Return the stats accumulated since the last flush and reset them """
+        with self._lock:
+            stats, self._stats = self._stats, defaultdict(self._stats.default_factory)
+        return dict(stats)
+
+
+subprocess_stats = SubprocessStats()
+
+
+class _PipeReader(threading.Thread):
+    """
+    Drain a pipe into memory, keeping at most `max_size` bytes so that a
+    verbose command can neither fill the pipe and block, nor use all memory.
+
+    A background child of the command can keep the pipe open long after the
+    command is gone, `stop` makes the reader give up on it.
+    """
+    def __init__(self, pipe, max_size):
+        threading.Thread.__init__(self, name='SubprocessPipeReader')
+        self.daemon = True
+        self.pipe = pipe
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+        self.truncated = False
+        # Closing the write end wakes up the reader. Windows can't select on pipes,
+        # a reader there keeps going until the pipe is closed on the other end.
+        self._wakeup_r, self._wakeup_w = (None, None) if Platform.is_windows() else os.pipe()
+
+    def run(self):
+        try:
+            # os.read returns what's available, file.read would wait for a full chunk
+            fd = self.pipe.fileno()
+            while True:
+                if self._wakeup_r is not None and self._wakeup_r in select.select([fd, self._wakeup_r], [], [])[0]:
+                    break
+                chunk = os.read(fd, READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if self.size < self.max_size:
+                    chunk = chunk[:self.max_size - self.size]
+                    self.chunks.append(chunk)
+                    self.size += len(chunk)
+                else:
+                    self.truncated = True
+        except (IOError, OSError, ValueError, select.error):
+            # The pipe was closed after the process got killed
+            pass
+        finally:
+            self.pipe.close()
+            if self._wakeup_r is not None:
+                os.close(self._wakeup_r)
+
+    def stop(self):
+        """ Stop reading, and release the pipe once the reader got the message. """
+        if self._wakeup_w is not None:
+            os.close(self._wakeup_w)
+            self._wakeup_w = None
+
+    def get_output(self):
+        return ''.join(self.chunks)
+
+
+def get_subprocess_output(command, log, raise_on_empty_output=True,
+                          timeout=DEFAULT_TIMEOUT, max_output_size=DEFAULT_MAX_OUTPUT_SIZE):
     """
     Run the given subprocess command and return its output. Raise an Exception
-    if an error occurs.
+    if an error occurs, SubprocessOutputTimeoutError if it didn't complete
+    within `timeout` seconds. Output beyond `max_output_size` bytes per stream
+    is discarded.
     """
-    return subprocess_output(command, raise_on_empty_output)
+    return subprocess_output(command, raise_on_empty_output, timeout, max_output_size)
 
 
-def subprocess_output(command, raise_on_empty_output):
+def subprocess_output(command, raise_on_empty_output, timeout=DEFAULT_TIMEOUT,
+                      max_output_size=DEFAULT_MAX_OUTPUT_SIZE):
     """
     Run the given subprocess command and return its output. This is a private method
     and should not be called directly, use `get_subprocess_output` instead.
     """
+    start = time.time()
+
+    # Both pipes are drained at the same time by threads: reading one after the
+    # other could deadlock once the other one is full.
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    readers = [_PipeReader(proc.stdout, max_output_size), _PipeReader(proc.stderr, max_output_size)]
+    for reader in readers:
+        reader.start()
+
+    # Completion is decided by the process exiting, not by its pipes closing
+    waiter = threading.Thread(target=proc.wait, name='SubprocessWaiter')
+    waiter.daemon = True
+    waiter.start()
+    waiter.join(timeout or None)
+    if waiter.is_alive():
+        try:
+            proc.kill()
+        except OSError:
+            # It exited in the meantime
+            pass
+        waiter.join()
+        # Its own children may still hold the pipes
+        for reader in readers:
+            reader.stop()
+        subprocess_stats.record(command, time.time() - start, timed_out=True)
+        raise SubprocessOutputTimeoutError(
+            "%s didn't complete within %ss and was killed" % (_command_name(command), timeout))
+
+    subprocess_stats.record(command, time.time() - start, proc.returncode)
+
+    join_deadline = time.time() + READERS_JOIN_TIMEOUT
+    for reader in readers:
+        reader.join(max(join_deadline - time.time(), 0))
+        reader.stop()
+    if any(reader.is_alive() for reader in readers):
+        log.debug("Output pipes of %s are still open after it exited, returning the output read so far",
+                  _command_name(command))
 
-    # Use tempfile, allowing a larger amount of memory. The subprocess.Popen
-    # docs warn that the data read is buffered in memory. They suggest not to
-    # use subprocess.PIPE if the data size is large or unlimited.
-    with tempfile.TemporaryFile() as stdout_f, tempfile.TemporaryFile() as stderr_f:
-        proc = subprocess.Popen(command, stdout=stdout_f, stderr=stderr_f)
-        proc.wait()
-        stderr_f.seek(0)
-        err = stderr_f.read()
-        stdout_f.seek(0)
-        output = stdout_f.read()
+    output, err = readers[0].get_output(), readers[1].get_output()
+    if any(reader.truncated for reader in readers):
+        log.warning("Output of %s exceeded %s bytes and was truncated", _command_name(command), max_output_size)
 
     if not output and raise_on_empty_output:
         raise SubprocessOutputEmptyError("get_subprocess_output expected output but had none.")